@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+from trill.utils import ann_index
+from trill.utils.ann_index import EmbeddingSource, IVFIndex, build_ivf_index, distance_batch_rows, exact_search
+from trill.utils.embedding_store import write_embedding_store
+
+
+def embedding_source(tmp_path, n=600, dim=16, seed=0):
+    x = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    path = str(tmp_path / "db.npy")
+    write_embedding_store(path, x, [f"p{i}" for i in range(n)])
+    return EmbeddingSource(path), x
+
+
+@pytest.mark.parametrize("metric", ["cosine", "L2"])
+def test_probing_every_cell_matches_exact_search(tmp_path, metric):
+    source, x = embedding_source(tmp_path)
+    index = build_ivf_index(source, str(tmp_path / "index"), metric=metric, nlist=12)
+    queries = np.random.default_rng(1).normal(size=(20, x.shape[1]))
+    scores, rows = index.search(queries, k=5, nprobe=12)
+    exact_scores, exact_rows = exact_search(source, queries, k=5, metric=metric, chunk_size=128)
+    assert (rows == exact_rows).all()
+    assert np.allclose(scores, exact_scores, atol=1e-4)
+
+
+def test_index_round_trip(tmp_path):
+    source, x = embedding_source(tmp_path)
+    build_ivf_index(source, str(tmp_path / "index"), nlist=8, half=True, chunk_size=100)
+    index = IVFIndex(str(tmp_path / "index"))
+    assert index.labels == source.labels and index.meta["n"] == len(x)
+    assert sorted(np.asarray(index.ids).tolist()) == list(range(len(x)))
+    _, rows = index.search(x[:10], k=1, nprobe=8)
+    assert rows[:, 0].tolist() == list(range(10))
+    assert index.matches_source(source.path)
+    # A database written after the index was built is refused
+    os.utime(source.path, (0, 0))
+    assert not index.matches_source(source.path)
+
+
+def test_distances_and_training_stay_within_budget(tmp_path, monkeypatch):
+    assert distance_batch_rows(28000) * 28000 * 4 <= ann_index.DISTANCE_BUDGET
+    monkeypatch.setattr(ann_index, "TRAIN_BUDGET", 64 * 16 * 4)
+    sampled = []
+    rows = EmbeddingSource.rows
+    monkeypatch.setattr(EmbeddingSource, "rows", lambda self, idx: sampled.append(len(idx)) or rows(self, idx))
+    source, _ = embedding_source(tmp_path)
+    index = build_ivf_index(source, str(tmp_path / "index"))
+    assert sampled == [64] and index.meta["nlist"] == 64 // ann_index.MIN_TRAIN_PER_CELL
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from trill.utils import cache
+from trill.utils.cache import FileLock, populate
+
+
+def slow_fill(tmp_path, log_path):
+    with open(log_path, "a") as f:
+        f.write("fill\n")
+    os.makedirs(tmp_path)
+    time.sleep(0.5)
+    with open(os.path.join(tmp_path, "model.pt"), "w") as f:
+        f.write("weights")
+
+
+def worker(entry, log_path):
+    path = populate(entry, lambda tmp: slow_fill(tmp, log_path))
+    with open(os.path.join(path, "model.pt")) as f:
+        assert f.read() == "weights"
+
+
+def test_populate_fills_once_across_processes(tmp_path):
+    entry, log_path = str(tmp_path / "Model"), str(tmp_path / "fills.log")
+    procs = [multiprocessing.Process(target=worker, args=(entry, log_path)) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert all(proc.exitcode == 0 for proc in procs)
+    with open(log_path) as f:
+        assert f.read().count("fill") == 1
+    assert sorted(os.listdir(tmp_path)) == ["Model", "fills.log"]
+
+
+def test_failed_after_step_is_retried(tmp_path):
+    entry, calls = str(tmp_path / "Repo"), []
+
+    def failing_install(path):
+        calls.append("after")
+        raise RuntimeError("pip install failed")
+
+    with pytest.raises(RuntimeError):
+        populate(entry, lambda tmp: (calls.append("fill"), os.makedirs(tmp)), after=failing_install)
+    assert os.path.isdir(entry) and not os.path.exists(f"{entry}.done")
+    for _ in range(2):
+        populate(entry, lambda tmp: calls.append("fill"), after=lambda path: calls.append("after"))
+    assert calls == ["fill", "after", "after"]
+    assert os.path.exists(f"{entry}.done")
+
+
+def test_stale_lock_is_broken(tmp_path):
+    lock_path = tmp_path / "entry.lock"
+    lock_path.write_text("crashed job\n")
+    os.utime(lock_path, (time.time() - 3600, time.time() - 3600))
+    with FileLock(str(lock_path), poll=0.01, stale=60, timeout=5):
+        assert lock_path.exists()
+    assert not lock_path.exists()
+
+
+def test_shared_cache_is_consulted_first(tmp_path, monkeypatch):
+    user_cache, shared = tmp_path / "user", tmp_path / "shared"
+    (shared / "Model").mkdir(parents=True)
+    monkeypatch.setattr(cache, "CACHE_DIR", str(user_cache))
+    monkeypatch.setenv(cache.SHARED_CACHE_ENV, str(shared))
+    path = populate(str(user_cache / "Model"), lambda tmp: (_ for _ in ()).throw(AssertionError("fetched")))
+    assert path == str(shared / "Model")
+    assert cache.cache_root(str(user_cache), "Model") == str(shared)
+    assert cache.cache_root(str(user_cache), "Model", "Weights") == str(user_cache)
+
+
+def test_install_step_runs_on_the_shared_copy_until_installed(tmp_path, monkeypatch):
+    user_cache, shared = tmp_path / "user", tmp_path / "shared"
+    (shared / "Repo").mkdir(parents=True)
+    monkeypatch.setattr(cache, "CACHE_DIR", str(user_cache))
+    monkeypatch.setenv(cache.SHARED_CACHE_ENV, str(shared))
+    installs = []
+    for _ in range(2):
+        path = populate(str(user_cache / "Repo"), lambda tmp: (_ for _ in ()).throw(AssertionError("fetched")),
+                        after=installs.append, installed=lambda path: path in installs)
+    assert path == str(shared / "Repo")
+    assert installs == [str(shared / "Repo")]
+    assert not os.path.exists(user_cache / "Repo.done")
+
+
+def test_pip_installed_checks_the_running_environment(tmp_path):
+    assert cache.pip_installed()
+    assert not cache.pip_installed(str(tmp_path))
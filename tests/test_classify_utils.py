@@ -0,0 +1,63 @@
+import esm
+import numpy as np
+from datasets import Dataset
+from transformers import EsmConfig, EsmForSequenceClassification, EsmTokenizer, TrainingArguments
+
+from trill.utils.classify_utils import TokenBudgetTrainer, token_budget_batches
+
+SEQS = ["MKTAYIAKQR", "MK", "MKVLAAGIVALLLAAGCSS", "ACDE", "MKTAYIAKQRQISFVKSHFSRQ", "MKV", "GGGGGGGG", "MPEP"]
+
+
+def tiny_esm_classifier(tmp_path):
+    vocab = tmp_path / "vocab.txt"
+    vocab.write_text("\n".join(esm.data.Alphabet.from_architecture("ESM-1b").all_toks))
+    tokenizer = EsmTokenizer(str(vocab))
+    config = EsmConfig(vocab_size=tokenizer.vocab_size, hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+                       intermediate_size=32, max_position_embeddings=64, pad_token_id=tokenizer.pad_token_id,
+                       mask_token_id=tokenizer.mask_token_id, position_embedding_type="rotary", num_labels=2)
+    return EsmForSequenceClassification(config), tokenizer
+
+
+def test_batches_respect_token_budget_and_sequence_cap():
+    lengths = [len(seq) for seq in SEQS]
+    batches = token_budget_batches(lengths, 60, max_seqs=3)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(SEQS)))
+    assert all(len(batch) <= 3 and len(batch) * (max(lengths[i] for i in batch) + 2) <= 60 for batch in batches)
+
+
+def test_trainer_caps_training_batches_at_batch_size(tmp_path):
+    model, tokenizer = tiny_esm_classifier(tmp_path)
+    dataset = Dataset.from_dict(tokenizer(SEQS)).add_column("label", [[i % 2] for i in range(len(SEQS))])
+    dataset = dataset.add_column("Label", [f"p{i}" for i in range(len(SEQS))])
+    config = TrainingArguments(str(tmp_path / "out"), per_device_train_batch_size=2, per_device_eval_batch_size=2,
+                               use_cpu=True, report_to=[])
+    trainer = TokenBudgetTrainer(model, config, train_dataset=dataset, eval_dataset=dataset, tokenizer=tokenizer,
+                                 toks_per_batch=100)
+    train_batches = list(trainer.get_train_dataloader())
+    assert all(len(batch["input_ids"]) <= 2 and "Label" not in batch for batch in train_batches)
+    assert sum(len(batch["input_ids"]) for batch in train_batches) == len(SEQS)
+    # Evaluation only follows the token budget
+    assert max(len(batch["input_ids"]) for batch in trainer.get_eval_dataloader()) > 2
+
+
+def test_throughput_counts_the_sequences_trained_on(tmp_path):
+    model, tokenizer = tiny_esm_classifier(tmp_path)
+    dataset = Dataset.from_dict(tokenizer(SEQS)).add_column("label", [[i % 2] for i in range(len(SEQS))])
+    config = TrainingArguments(str(tmp_path / "out"), per_device_train_batch_size=4, num_train_epochs=2,
+                               save_strategy="no", use_cpu=True, report_to=[])
+    trainer = TokenBudgetTrainer(model, config, train_dataset=dataset, tokenizer=tokenizer, toks_per_batch=30)
+    metrics = trainer.train().metrics
+    assert trainer._train_sampler.n_yielded == 2 * len(SEQS)
+    assert abs(metrics["train_samples_per_second"] * metrics["train_runtime"] - 2 * len(SEQS)) < 0.1
+
+
+def test_predictions_keep_dataset_order_with_several_processes(tmp_path, monkeypatch):
+    model, tokenizer = tiny_esm_classifier(tmp_path)
+    dataset = Dataset.from_dict(tokenizer(SEQS)).add_column("label", [[i % 2] for i in range(len(SEQS))])
+    config = TrainingArguments(str(tmp_path / "out"), per_device_eval_batch_size=2, use_cpu=True, report_to=[])
+    trainer = TokenBudgetTrainer(model, config, tokenizer=tokenizer, toks_per_batch=100)
+    single = trainer.predict(dataset).predictions
+    monkeypatch.setattr(TrainingArguments, "world_size", property(lambda self: 2))
+    batches = list(trainer.get_test_dataloader(dataset))
+    assert [len(batch["input_ids"]) for batch in batches] == [2] * 4 and trainer._test_order is None
+    assert np.allclose(trainer.predict(dataset).predictions, single, atol=1e-5)
@@ -0,0 +1,41 @@
+import esm
+import numpy as np
+import pytest
+import torch
+
+from trill.utils.dms_utils import DMS_AMINO_ACIDS, marginal_matrix, score_mutants, single_mutants
+
+SEQ = "MKTAYIAKQRQISFVKSHFSRQ"
+
+
+def tiny_esm2():
+    torch.manual_seed(0)
+    alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+    return esm.model.esm2.ESM2(num_layers=2, embed_dim=32, attention_heads=4, alphabet=alphabet).eval(), alphabet
+
+
+def test_masked_marginal_rows_match_masking_each_position():
+    model, alphabet = tiny_esm2()
+    matrix = marginal_matrix(model, alphabet, SEQ, toks_per_batch=100)
+    _, _, tokens = alphabet.get_batch_converter()([("wt", SEQ)])
+    aa_idx = [alphabet.get_idx(aa) for aa in DMS_AMINO_ACIDS]
+    for pos in range(len(SEQ)):
+        masked = tokens.clone()
+        masked[0, pos + 1] = alphabet.mask_idx
+        with torch.no_grad():
+            expected = torch.log_softmax(model(masked)["logits"][0, pos + 1], -1)[aa_idx]
+        assert np.allclose(matrix[pos], expected.numpy(), atol=1e-4)
+
+
+def test_mutant_scores_are_summed_lookups():
+    model, alphabet = tiny_esm2()
+    matrices = np.stack([marginal_matrix(model, alphabet, SEQ, scoring="wt_marginal"),
+                         marginal_matrix(model, alphabet, SEQ)])
+    singles = single_mutants(SEQ)
+    assert len(singles) == 19 * len(SEQ)
+    single_scores = dict(zip(singles, score_mutants(matrices, SEQ, singles)))
+    double = score_mutants(matrices, SEQ, ["M1A:K2W"])[0]
+    assert np.allclose(double, single_scores["M1A"] + single_scores["K2W"])
+    with pytest.raises(ValueError):
+        score_mutants(matrices, SEQ, ["A1G"])
+    assert score_mutants(matrices, SEQ, []).shape == (0, 2)
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from trill.utils.download import download, DownloadError
+
+PAYLOAD = os.urandom(5 * 1024 * 1024 + 123)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''Serves PAYLOAD, honouring single byte ranges unless the server disables them'''
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get("Range"))
+        data = PAYLOAD
+        range_header = self.headers.get("Range")
+        if self.server.ranges and range_header:
+            start, stop = range_header.split("=")[1].split("-")
+            start, stop = int(start), min(int(stop), len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{stop}/{len(data)}")
+            data = data[start:stop + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(params=[True, False], ids=["ranges", "no_ranges"])
+def server(request):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.ranges = request.param
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url_of(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/weights.pt"
+
+
+def test_download_verifies_and_moves_into_place(server, tmp_path):
+    dest = tmp_path / "cache" / "weights.pt"
+    sha = hashlib.sha256(PAYLOAD).hexdigest()
+    download(url_of(server), str(dest), sha256=sha, n_workers=4, chunk_size=1024 * 1024)
+    assert dest.read_bytes() == PAYLOAD
+    assert (tmp_path / "cache" / "weights.pt.sha256").read_text().split()[0] == sha
+    assert not os.path.exists(f"{dest}.part")
+    assert not os.path.exists(f"{dest}.part.json")
+
+
+def test_download_rejects_bad_checksum(server, tmp_path):
+    dest = tmp_path / "weights.pt"
+    with pytest.raises(DownloadError):
+        download(url_of(server), str(dest), sha256="0" * 64, chunk_size=1024 * 1024)
+    assert not dest.exists()
+    assert not os.path.exists(f"{dest}.part")
+
+
+def test_corrupted_copies_are_downloaded_again(server, tmp_path, monkeypatch):
+    from trill.utils import cache
+
+    user_cache, shared = tmp_path / "user", tmp_path / "shared"
+    dest = user_cache / "weights.pt"
+    download(url_of(server), str(dest), chunk_size=1024 * 1024)
+    shared.mkdir()
+    for name in ("weights.pt", "weights.pt.sha256"):
+        (shared / name).write_bytes((user_cache / name).read_bytes())
+    # A truncated shared copy and local copy are both caught by the recorded digest
+    with open(shared / "weights.pt", "r+b") as f:
+        f.truncate(1024)
+    dest.write_bytes(PAYLOAD[:-1] + b"x")
+    monkeypatch.setattr(cache, "CACHE_DIR", str(user_cache))
+    monkeypatch.setenv(cache.SHARED_CACHE_ENV, str(shared))
+    assert download(url_of(server), str(dest), chunk_size=1024 * 1024) == str(dest)
+    assert dest.read_bytes() == PAYLOAD
+
+
+def test_download_resumes_finished_chunks(tmp_path):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.ranges, httpd.requests = True, []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        chunk_size = 1024 * 1024
+        dest = tmp_path / "weights.pt"
+        # Simulate an interrupted run that already wrote the first two chunks
+        with open(f"{dest}.part", "wb") as f:
+            f.write(PAYLOAD[:2 * chunk_size])
+            f.truncate(len(PAYLOAD))
+        with open(f"{dest}.part.json", "w") as f:
+            f.write(f'{{"url": "{url_of(httpd)}", "size": {len(PAYLOAD)}, "etag": null, "done": [0, 1]}}')
+
+        download(url_of(httpd), str(dest), sha256=hashlib.sha256(PAYLOAD).hexdigest(), chunk_size=chunk_size)
+        assert dest.read_bytes() == PAYLOAD
+        fetched = [r for r in httpd.requests if r != "bytes=0-0"]
+        assert f"bytes=0-{chunk_size - 1}" not in fetched
+        assert len(fetched) == -(-len(PAYLOAD) // chunk_size) - 2
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_download_skips_existing_file(server, tmp_path):
+    dest = tmp_path / "weights.pt"
+    dest.write_bytes(b"cached")
+    download(url_of(server), str(dest))
+    assert dest.read_bytes() == b"cached"
+    assert server.requests == []
+
+
+def test_callers_read_the_shared_cache_copy(tmp_path, monkeypatch):
+    from Bio.Align import substitution_matrices
+
+    from trill.utils import cache
+    from trill.utils.tdi_search import load_substitution_matrices
+
+    user_cache, shared = tmp_path / "user", tmp_path / "shared"
+    shared.mkdir()
+    (shared / "mat3di.out").write_text(str(substitution_matrices.load("BLOSUM62")))
+    monkeypatch.setattr(cache, "CACHE_DIR", str(user_cache))
+    monkeypatch.setenv(cache.SHARED_CACHE_ENV, str(shared))
+    assert download("http://127.0.0.1:9/mat3di.out", str(user_cache / "mat3di.out")) == str(shared / "mat3di.out")
+    mat3di, blosum = load_substitution_matrices(str(user_cache))
+    assert mat3di.shape == blosum.shape and mat3di[0, 0] == blosum[0, 0]
+    assert not user_cache.exists()
@@ -0,0 +1,66 @@
+import os
+
+from trill.utils import foldseek_utils
+from trill.utils.foldseek_utils import get_cached_foldseek_db, read_db_records
+
+
+def fake_models():
+    return None, None, None, "cpu"
+
+
+def setup_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv("TRILL_SHARED_CACHE", raising=False)
+    monkeypatch.setattr(foldseek_utils, "FOLDSEEK_DB_CACHE", str(tmp_path / "cache"))
+    predicted = []
+
+    def fake_predict_3di(model, vocab, predictor, seq_dict, device, **kwargs):
+        predicted.extend(seq_dict.values())
+        return {i: ([0] * len(aa), 50) for i, aa in seq_dict.items()}
+
+    monkeypatch.setattr(foldseek_utils, "predict_3di", fake_predict_3di)
+    return predicted
+
+
+def test_foldseek_db_is_added_to_a_native_entry_under_its_lock(tmp_path, monkeypatch):
+    setup_cache(tmp_path, monkeypatch)
+    fasta = tmp_path / "db.fasta"
+    fasta.write_text(">a\nMKT\n>b\nACDE\n")
+    entry_dir = get_cached_foldseek_db(str(fasta), fake_models, foldseek=False)
+    assert not os.path.exists(os.path.join(entry_dir, "db.dbtype"))
+    built = []
+
+    def fake_tsv2db(records, out_dir, db_name="db"):
+        # Another run on the same database must not be able to write here at the same time
+        assert os.path.exists(f"{out_dir}.lock")
+        built.append(out_dir)
+        for type in ('aa', 'tdi', 'header'):
+            open(os.path.join(out_dir, f"{type}.tsv"), "w").close()
+        open(os.path.join(out_dir, f"{db_name}.dbtype"), "w").close()
+
+    monkeypatch.setattr(foldseek_utils, "foldseek_tsv2db", fake_tsv2db)
+    assert get_cached_foldseek_db(str(fasta), fake_models) == entry_dir
+    assert get_cached_foldseek_db(str(fasta), fake_models) == entry_dir
+    assert built == [entry_dir] and os.path.exists(os.path.join(entry_dir, "db.dbtype"))
+    assert not os.path.exists(f"{entry_dir}.lock")
+
+
+def test_new_version_reuses_3di_and_removes_the_old_entry_under_its_lock(tmp_path, monkeypatch):
+    predicted = setup_cache(tmp_path, monkeypatch)
+    fasta = tmp_path / "db.fasta"
+    fasta.write_text(">a\nMKT\n>b\nACDE\n")
+    old_entry = get_cached_foldseek_db(str(fasta), fake_models, foldseek=False)
+    fasta.write_text(">a\nMKT\n>b\nACDE\n>c\nWWYV\n")
+    removed = []
+    remove = foldseek_utils._remove
+
+    def checked_remove(path):
+        if path == old_entry:
+            assert os.path.exists(f"{old_entry}.lock")
+            removed.append(path)
+        remove(path)
+
+    monkeypatch.setattr(foldseek_utils, "_remove", checked_remove)
+    new_entry = get_cached_foldseek_db(str(fasta), fake_models, foldseek=False)
+    assert predicted == ["MKT", "ACDE", "WWYV"] and removed == [old_entry]
+    assert [record[0] for record in read_db_records(new_entry)] == ["a", "b", "c"]
+    assert os.listdir(foldseek_utils.FOLDSEEK_DB_CACHE) == [os.path.basename(new_entry)]
@@ -0,0 +1,84 @@
+import math
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from trill.utils.generation_utils import PromptCache, perplexity, processed_logits, speculative_samples, \
+    stream_samples
+
+PROMPT = torch.tensor([3, 5, 7])
+
+
+def tiny_gpt2(seed=0, n_layer=2, vocab_size=30):
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=vocab_size, n_positions=256, n_embd=32, n_layer=n_layer, n_head=2, initializer_range=0.5)
+    return GPT2LMHeadModel(config).eval()
+
+
+def test_greedy_samples_match_generate():
+    model = tiny_gpt2()
+    reference = model.generate(PROMPT[None], max_length=60, do_sample=False, repetition_penalty=1.2,
+                               pad_token_id=0)[0, len(PROMPT):].tolist()
+    eos = reference[5]
+    samples = list(stream_samples(model, PROMPT, 9, 4, 60, eos, pad_token_id=0, do_sample=False,
+                                  repetition_penalty=1.2))
+    assert sorted(i for i, _, _ in samples) == list(range(9))
+    assert all(tokens == reference[:reference.index(eos) + 1] for _, tokens, _ in samples)
+
+
+def test_refilled_slots_score_like_a_full_forward_pass():
+    model = tiny_gpt2()
+    samples = list(stream_samples(model, PROMPT, 25, 3, 25, eos_token_id=4, top_k=10))
+    assert sorted(i for i, _, _ in samples) == list(range(25))
+    for _, tokens, logprobs in samples:
+        with torch.no_grad():
+            logits = model(torch.cat([PROMPT, torch.tensor(tokens)])[None]).logits[0, len(PROMPT) - 1:-1]
+        expected = torch.log_softmax(logits, -1).gather(-1, torch.tensor(tokens)[:, None]).squeeze(-1)
+        assert torch.allclose(expected, torch.tensor(logprobs), atol=1e-4)
+
+
+def test_speculative_greedy_samples_match_regular_ones():
+    model, draft = tiny_gpt2(), tiny_gpt2(seed=1, n_layer=1)
+    for prompt in (PROMPT, PROMPT[:1]):
+        reference = next(stream_samples(model, prompt, 1, 1, 50, 999, pad_token_id=0, do_sample=False,
+                                        repetition_penalty=1.2))[1]
+        samples = speculative_samples(model, draft, prompt, 2, 50, 999, n_draft=3, do_sample=False,
+                                      repetition_penalty=1.2)
+        assert all(tokens == reference for _, tokens, _ in samples)
+
+
+@pytest.mark.parametrize("top_k, repetition_penalty", [(0, 1.0), (3, 1.5)])
+def test_speculative_samples_follow_the_model_distribution(top_k, repetition_penalty):
+    model, draft = tiny_gpt2(vocab_size=8), tiny_gpt2(seed=1, n_layer=1, vocab_size=8)
+    process = dict(top_k=top_k, repetition_penalty=repetition_penalty)
+    # Exact distribution of the first two tokens under the model alone
+    exact = torch.zeros(8, 8)
+    with torch.no_grad():
+        for first in range(8):
+            ids = torch.cat([PROMPT, torch.tensor([first])])
+            logits = model(ids[None]).logits[0, -2:]
+            seen = torch.zeros(2, 8, dtype=torch.bool)
+            seen[:, PROMPT] = True
+            seen[1, first] = True
+            probs = torch.softmax(processed_logits(logits, seen, **process), -1)
+            exact[first] = probs[0, first] * probs[1]
+
+    # One draft token and the model's bonus token per sample, so both the accept and the resample paths are taken
+    torch.manual_seed(0)
+    n_samples = 4000
+    counts = torch.zeros(8, 8)
+    for _, tokens, _ in speculative_samples(model, draft, PROMPT, n_samples, len(PROMPT) + 2, 999, **process):
+        counts[tokens[0], tokens[1]] += 1
+    assert (counts[exact == 0] == 0).all()
+    assert 0.5 * (counts / n_samples - exact).abs().sum() < 0.05
+
+
+def test_perplexity_from_sampling_matches_a_scoring_pass():
+    model = tiny_gpt2()
+    prompt = PromptCache(model, PROMPT)
+    for _, tokens, logprobs in stream_samples(model, prompt, 4, 2, 20, eos_token_id=4):
+        with torch.no_grad():
+            ids = torch.cat([PROMPT, torch.tensor(tokens)])
+            loss = model(ids, labels=ids).loss
+        assert math.isclose(perplexity(prompt, logprobs), math.exp(loss), rel_tol=1e-4)
@@ -0,0 +1,41 @@
+import argparse
+import random
+
+import esm
+import pytest
+import torch
+
+from trill.utils.lightning_models import ESM_Gibbs
+
+SEEDS = ["MKTAYIAKQR", "MK"]
+
+
+def tiny_gibbs():
+    torch.manual_seed(0)
+    alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+    model = esm.model.esm2.ESM2(num_layers=2, embed_dim=32, attention_heads=4, alphabet=alphabet).eval()
+    return ESM_Gibbs((model, alphabet), argparse.Namespace(GPUs=0))
+
+
+@pytest.mark.parametrize("schedule", ["blocked", "entropy"])
+def test_seeds_of_different_lengths_are_kept(schedule):
+    random.seed(1)
+    sampler = tiny_gibbs()
+    out = sampler.generate(SEEDS, n_samples=8, batch_size=8, max_len=14, schedule=schedule, num_steps=3,
+                           show_progress_bar=False)
+    assert len(out) == 8 and all(len(seq) == 14 and "<mask>" not in seq for seq in out)
+    assert all(seq.startswith(SEEDS[0]) or seq.startswith(SEEDS[1]) for seq in out)
+    assert any(seq.startswith(SEEDS[0]) for seq in out) and any(not seq.startswith(SEEDS[0]) for seq in out)
+
+
+@pytest.mark.parametrize("schedule, kwargs", [("dilated", {"dilation": 0}), ("blocked", {"num_steps": 0})])
+def test_schedule_lengths_are_validated(schedule, kwargs):
+    with pytest.raises(ValueError):
+        tiny_gibbs().generate("MK", max_len=10, schedule=schedule, show_progress_bar=False, **kwargs)
+
+
+def test_stats_count_the_sampled_sequences():
+    stats = {}
+    tiny_gibbs().generate("MK", n_samples=4, batch_size=4, max_len=11, schedule="dilated", dilation=3,
+                          show_progress_bar=False, stats=stats)
+    assert stats == {"forward_passes": 3, "forward_rows": 12}
@@ -0,0 +1,48 @@
+import esm
+import torch
+
+from trill.utils.esm_utils import pseudo_log_likelihoods
+
+SEQS = ["MKTAYIAKQR", "MKV", "ACDEFGHIKLMNPQRSTVWY"]
+
+
+def tiny_esm2():
+    torch.manual_seed(0)
+    alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+    return esm.model.esm2.ESM2(num_layers=2, embed_dim=32, attention_heads=4, alphabet=alphabet).eval(), alphabet
+
+
+def test_batched_copies_match_masking_one_sequence_at_a_time():
+    model, alphabet = tiny_esm2()
+    _, _, tokens = alphabet.get_batch_converter()([(str(i), seq) for i, seq in enumerate(SEQS)])
+    logprobs, scored = pseudo_log_likelihoods(model, alphabet, tokens, toks_per_batch=50)
+    assert scored.sum(1).tolist() == [len(seq) for seq in SEQS]
+    for i, seq in enumerate(SEQS):
+        for pos in range(1, len(seq) + 1):
+            masked = tokens[i:i + 1, :len(seq) + 2].clone()
+            masked[0, pos] = alphabet.mask_idx
+            with torch.no_grad():
+                expected = torch.log_softmax(model(masked)["logits"][0, pos], -1)[tokens[i, pos]]
+            assert torch.isclose(logprobs[i, pos], expected, atol=1e-4)
+
+
+def test_mask_distance_masks_every_kth_residue_together():
+    model, alphabet = tiny_esm2()
+    _, _, tokens = alphabet.get_batch_converter()([("0", SEQS[0])])
+    logprobs, _ = pseudo_log_likelihoods(model, alphabet, tokens, mask_distance=3)
+    masked = tokens.clone()
+    masked[0, [2, 5, 8]] = alphabet.mask_idx
+    with torch.no_grad():
+        expected = torch.log_softmax(model(masked)["logits"][0], -1).gather(-1, tokens[0, :, None]).squeeze(-1)
+    assert torch.allclose(logprobs[0, [2, 5, 8]], expected[[2, 5, 8]], atol=1e-4)
+
+
+def test_stats_count_every_masked_copy():
+    model, alphabet = tiny_esm2()
+    _, _, tokens = alphabet.get_batch_converter()([(str(i), seq) for i, seq in enumerate(SEQS)])
+    stats = {}
+    pseudo_log_likelihoods(model, alphabet, tokens, toks_per_batch=50, stats=stats)
+    assert stats["forward_rows"] == sum(len(seq) for seq in SEQS) and stats["forward_passes"] > 1
+    stats = {}
+    pseudo_log_likelihoods(model, alphabet, tokens, mask_distance=3, stats=stats)
+    assert stats == {"forward_passes": 1, "forward_rows": 3 * len(SEQS)}
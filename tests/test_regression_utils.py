@@ -0,0 +1,48 @@
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import r2_score
+
+from trill.utils.regression_utils import StreamingLinearRegression, train_streaming_linear
+
+
+def write_dataset(tmp_path, y):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(len(y), 5)).astype(np.float32)
+    emb = pd.DataFrame(X, columns=[str(i) for i in range(X.shape[1])])
+    emb['Label'] = [f"p{i}" for i in range(len(y))]
+    emb.to_csv(tmp_path / "emb.csv", index=False)
+    pd.DataFrame({'Label': emb['Label'], 'Score': y}).to_csv(tmp_path / "key.csv", index=False)
+    args = SimpleNamespace(key=str(tmp_path / "key.csv"), RNG_seed=1, train_split=0.7, chunk_rows=16,
+                           ridge_alpha=0.0)
+    return X, emb, args
+
+
+def test_streaming_fit_matches_scikit_learn_and_predicts_on_named_columns():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(100, 5)).astype(np.float32)
+    y = X @ np.arange(1, 6) + 3 + 0.1 * rng.normal(size=100)
+    reg = StreamingLinearRegression(5, 1)
+    for start in range(0, 100, 30):
+        reg.partial_fit(X[start:start + 30], y[start:start + 30])
+    model = reg.solve()
+    expected = LinearRegression().fit(X, y)
+    assert np.allclose(model.coef_, expected.coef_, atol=1e-4) and model.intercept_ == pytest.approx(expected.intercept_)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        model.predict(pd.DataFrame(X, columns=[str(i) for i in range(5)]))
+
+
+@pytest.mark.parametrize("constant", [False, True])
+def test_test_r2_matches_r2_score(tmp_path, constant):
+    rng = np.random.default_rng(2)
+    y = np.full(60, 4.0) if constant else rng.normal(size=60)
+    X, emb, args = write_dataset(tmp_path, y)
+    model, r2, _ = train_streaming_linear(str(tmp_path / "emb.csv"), args)
+    is_train = np.random.default_rng(int(args.RNG_seed)).random(len(y)) < float(args.train_split)
+    expected = r2_score(y[~is_train], model.predict(emb.iloc[:, :-1][~is_train]))
+    assert np.isfinite(r2) and r2 == pytest.approx(expected)
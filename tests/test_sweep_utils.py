@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from trill.utils import sweep_utils
+from trill.utils.sweep_utils import SEARCH_SPACES, BoostingSweep, SweepResult, rung_rounds, run_sweep, sample_params
+
+
+def toy_data(task, n_classes=2, n=90, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 4))
+    if task == 'regression':
+        return X, 2 * X[:, 0] - X[:, 1] + 0.1 * rng.normal(size=n)
+    return X, np.digitize(X[:, 0], np.quantile(X[:, 0], np.linspace(0, 1, n_classes + 1)[1:-1]))
+
+
+def test_rung_rounds():
+    assert rung_rounds() == [28, 83, 250]
+    assert rung_rounds(27, 3, 4) == [1, 3, 9, 27]
+    assert rung_rounds(2, 3, 3) == [1, 1, 2]
+
+
+def test_sample_params_only_depend_on_seed_and_trial():
+    for model, space in SEARCH_SPACES.items():
+        params = sample_params(space, 7, 3)
+        assert params == sample_params(space, 7, 3) != sample_params(space, 7, 4) != sample_params(space, 8, 3)
+        for name, (kind, low, high) in space.items():
+            assert low <= params[name] <= high and isinstance(params[name], float if kind == 'real' else int)
+
+
+@pytest.mark.parametrize("model,task,n_classes", [('XGBoost', 'classification', 3), ('LightGBM', 'classification', 2),
+                                                  ('XGBoost', 'regression', None), ('LightGBM', 'regression', None)])
+def test_sweep_refits_the_best_trial(tmp_path, monkeypatch, model, task, n_classes):
+    monkeypatch.setattr(sweep_utils, "rung_rounds", lambda: [3, 9, 27])
+    X, y = toy_data(task, n_classes or 2)
+    args = SimpleNamespace(outdir=str(tmp_path), name="toy", sweep_cv=2, sweep_trials=4, n_workers=2, RNG_seed=1,
+                           sweep_resume=False)
+    result = run_sweep(model, task, X, y, args, n_classes=n_classes)
+    table = pd.read_csv(tmp_path / f"toy_{model}_sweep_trials.csv")
+    assert isinstance(result, SweepResult) and len(table) == 4 + 1
+    assert (table['model'] == model).all() and (table['seed'] == 1).all() and (table['cv'] == 2).all()
+    best = table[table['rung'] == table['rung'].max()].sort_values('score').iloc[-1]
+    assert result.best_params_ == {**sample_params(SEARCH_SPACES[model], 1, int(best['trial'])),
+                                   'n_estimators': int(best['rounds'])}
+    assert result.best_score_ == pytest.approx(best['score']) and result.best_score_ > 0
+    assert result.predict(X).shape == (len(X),)
+
+
+def test_resume_skips_finished_trials_and_refuses_another_sweep(tmp_path, monkeypatch):
+    monkeypatch.setattr(sweep_utils, "rung_rounds", lambda: [3, 9, 27])
+    X, y = toy_data('classification')
+    table_path = str(tmp_path / "trials.csv")
+    full = BoostingSweep('LightGBM', 'classification', X, y, 2, 1, n_classes=2).run(6, 1, table_path)
+    complete = pd.read_csv(table_path)
+
+    # Interrupted after the first three rung 0 trials
+    complete[(complete['rung'] == 0) & (complete['trial'] < 3)].to_csv(table_path, index=False)
+    sweep = BoostingSweep('LightGBM', 'classification', X, y, 2, 1, n_classes=2)
+    advanced = []
+    advance = sweep.advance
+    monkeypatch.setattr(sweep, "advance", lambda trial, rounds: advanced.append(rounds) or advance(trial, rounds))
+    assert sweep.run(6, 1, table_path, resume=True) == full
+    assert advanced.count(3) == 3
+    assert len(pd.read_csv(table_path)) == len(complete)
+
+    for other in [BoostingSweep('LightGBM', 'classification', X, y, 2, 2, n_classes=2),
+                  BoostingSweep('LightGBM', 'classification', X, y, 3, 1, n_classes=2),
+                  BoostingSweep('XGBoost', 'classification', X, y, 2, 1, n_classes=2)]:
+        with pytest.raises(ValueError, match="can't be resumed"):
+            other.run(6, 1, table_path, resume=True)
@@ -0,0 +1,83 @@
+import numpy as np
+
+from trill.utils.tdi_search import ALPHABET, PAD, KmerIndex, NativeSearchDB, _profile, encode, smith_waterman, \
+    traceback
+
+N_CODES = len(ALPHABET) + 1
+
+
+def random_matrix(rng):
+    m = rng.integers(-4, 3, size=(N_CODES, N_CODES))
+    m = (m + m.T) // 2
+    np.fill_diagonal(m, rng.integers(4, 9, size=N_CODES))
+    return m.astype(np.int32)
+
+
+def identity_matrix(match=5, mismatch=-3):
+    return np.where(np.eye(N_CODES, dtype=bool), match, mismatch).astype(np.int32)
+
+
+def gotoh(q3, qa, t3, ta, mat3di, blosum, gap_open, gap_extend):
+    '''Textbook affine-gap Smith-Waterman, one cell at a time'''
+    lq, lt = len(q3), len(t3)
+    neg = -10 ** 9
+    H = np.zeros((lt + 1, lq + 1), dtype=np.int64)
+    E = np.full((lt + 1, lq + 1), neg, dtype=np.int64)
+    F = np.full((lt + 1, lq + 1), neg, dtype=np.int64)
+    for i in range(1, lt + 1):
+        for j in range(1, lq + 1):
+            E[i, j] = max(H[i, j - 1] - gap_open, E[i, j - 1] - gap_extend)
+            F[i, j] = max(H[i - 1, j] - gap_open, F[i - 1, j] - gap_extend)
+            s = mat3di[t3[i - 1], q3[j - 1]] + blosum[ta[i - 1], qa[j - 1]]
+            H[i, j] = max(0, H[i - 1, j - 1] + s, E[i, j], F[i, j])
+    return int(H.max())
+
+
+def random_codes(rng, n):
+    return rng.integers(0, len(ALPHABET), size=n).astype(np.uint8)
+
+
+def test_scores_match_a_cell_by_cell_gotoh():
+    rng = np.random.default_rng(0)
+    mat3di, blosum = random_matrix(rng), random_matrix(rng)
+    for gap_open, gap_extend in [(10, 1), (4, 2), (3, 3)]:
+        q3, qa = random_codes(rng, 17), random_codes(rng, 17)
+        targets = [(random_codes(rng, n), random_codes(rng, n)) for n in rng.integers(1, 30, size=8)]
+        lt = max(len(t) for t, _ in targets)
+        t3 = np.full((len(targets), lt), PAD, dtype=np.uint8)
+        ta = np.full((len(targets), lt), PAD, dtype=np.uint8)
+        for row, (t, a) in enumerate(targets):
+            t3[row, :len(t)], ta[row, :len(a)] = t, a
+        prof3, profa = _profile(mat3di, blosum, q3, qa)
+        scores = smith_waterman(prof3, profa, t3, ta, gap_open, gap_extend)
+        expected = [gotoh(q3, qa, t, a, mat3di, blosum, gap_open, gap_extend) for t, a in targets]
+        assert scores.tolist() == expected
+
+
+def test_traceback_of_an_insertion():
+    mat, zero = identity_matrix(), np.zeros((N_CODES, N_CODES), dtype=np.int32)
+    query = "MKTAYIAKQRQISFVKSHFSRQ"
+    target = query[:11] + "WWW" + query[11:]
+    q, t = encode(query), encode(target)
+    prof3, profa = _profile(mat, zero, q, q)
+    score, stats = traceback(prof3, profa, t, t, q, gap_open=6, gap_extend=1)
+    assert score == 5 * len(query) - 6 - 2
+    assert stats == {"fident": len(query) / (len(query) + 3), "alnlen": len(query) + 3, "mismatch": 0,
+                     "gapopen": 1, "qstart": 1, "qend": len(query), "tstart": 1, "tend": len(target)}
+    _, stats = traceback(prof3, profa, q, q, q, gap_open=6, gap_extend=1)
+    assert stats["fident"] == 1 and stats["alnlen"] == len(query) and stats["gapopen"] == 0
+
+
+def test_prefilter_keeps_the_exact_self_hit():
+    rng = np.random.default_rng(1)
+    letters = np.array(list(ALPHABET))
+    query = "".join(letters[random_codes(rng, 60)])
+    # Decoys share many k-mers with the query but are never the query itself
+    decoys = [query[:20 + i] + "".join(letters[random_codes(rng, 25)]) for i in range(30)]
+    seqs = decoys[:17] + [query] + decoys[17:]
+    index = KmerIndex([encode(seq) for seq in seqs])
+    assert index.candidates(encode(query), max_seqs=1).tolist() == [17]
+
+    db = NativeSearchDB([f"t{i}" for i in range(len(seqs))], seqs, seqs, identity_matrix(), identity_matrix())
+    rows, _ = db.search("q", query, query, max_seqs=5)
+    assert rows[0][1] == "t17" and float(rows[0][2]) == 1.0
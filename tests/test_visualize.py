@@ -0,0 +1,114 @@
+import os
+from types import SimpleNamespace
+
+import bokeh.io
+import numpy as np
+import pandas as pd
+import pytest
+from loguru import logger
+
+from trill.utils import visualize
+from trill.utils.visualize import fit_pca, fit_reducer, knn_interpolate, landmark_sample, project_onto, reduce_dims, \
+    reducer_cache_path, viz
+
+
+def write_embeddings(path, n, seed, prefix):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.normal(size=(n, 8)) * np.arange(1, 9))
+    df['Label'] = [f"{prefix}{i}" for i in range(n)]
+    df.to_csv(path, index=False)
+    return df
+
+
+def test_incremental_pca_matches_full_pca():
+    X = np.random.default_rng(0).normal(size=(500, 8)) * np.array([1, 1, 1, 1, 1, 1, 5, 10])
+    full, incremental = fit_pca(X, 2, solver='full'), fit_pca(X, 2, solver='incremental', chunk_rows=64)
+    assert np.allclose(np.abs((full.components_ * incremental.components_).sum(1)), 1, atol=1e-3)
+
+
+def test_landmarks_are_stratified_by_key(tmp_path):
+    labels = [f"p{i}" for i in range(100)]
+    key = tmp_path / "key.csv"
+    pd.DataFrame({'Label': labels, 'Group': ['a'] * 80 + ['b'] * 20}).to_csv(key, index=False)
+    picked = landmark_sample(labels, 10, str(key))
+    assert len(picked) == 10 and (picked >= 80).sum() == 2
+
+
+def test_knn_interpolation_keeps_landmarks_in_place():
+    landmarks = np.random.default_rng(0).normal(size=(20, 4))
+    coords = np.random.default_rng(1).normal(size=(20, 2))
+    assert np.allclose(knn_interpolate(landmarks, coords, landmarks, k=3, chunk_rows=7), coords, atol=1e-5)
+
+
+def test_landmark_projection_reads_the_store_in_chunks():
+    X = np.random.default_rng(0).normal(size=(60, 8))
+    reduced, fitted = fit_reducer(X, [str(i) for i in range(60)], 'tSNE', landmarks=40, chunk_rows=7)
+    assert reduced.shape == (60, 2) and np.isfinite(reduced).all()
+    assert len(fitted['reducer']['landmarks']) == 40
+
+
+def test_projected_embeddings_stay_out_of_the_cached_map(tmp_path, monkeypatch):
+    monkeypatch.setattr(visualize, "REDUCER_CACHE", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    original, new = str(tmp_path / "original.csv"), str(tmp_path / "new.csv")
+    write_embeddings(original, 50, 0, "old")
+    write_embeddings(new, 5, 1, "new")
+    first, _ = reduce_dims("t", original, 'PCA')
+    saved = reducer_cache_path(original, 'PCA', {'pca_solver': 'auto', 'pca_dims': 0, 'landmarks': 0,
+                                                 'chunk_rows': None, 'key': None})
+
+    outdir = tmp_path / "projection"
+    outdir.mkdir()
+    projected, incsv, method = project_onto(saved, new, str(outdir), "p")
+    assert len(projected) == 55
+    assert len(project_onto(saved, new, str(outdir), "p")[0]) == 55
+    # The merged map goes next to this run's HTML, the first run's table is left alone
+    assert len(pd.read_csv(outdir / f"p_{method}_{incsv}.csv")) == 55
+    assert len(pd.read_csv(tmp_path / "t_PCA_original.csv")) == 50
+
+    rerun, _ = reduce_dims("t", original, 'PCA')
+    assert len(rerun) == 50 and not rerun['Label'].str.startswith("new").any()
+    assert np.allclose(rerun.iloc[:, :2], first.iloc[:, :2])
+
+
+def test_chunk_rows_only_keys_incremental_fits(tmp_path, monkeypatch):
+    monkeypatch.setattr(visualize, "REDUCER_CACHE", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    original = str(tmp_path / "original.csv")
+    write_embeddings(original, 50, 0, "old")
+    messages = []
+    sink = logger.add(lambda message: messages.append(message.record["message"]))
+    try:
+        reduce_dims("t", original, 'PCA', chunk_rows=20)
+        reduce_dims("t", original, 'PCA', chunk_rows=30)
+        assert len(os.listdir(tmp_path / "cache")) == 1
+        assert sum(message.startswith("Saved the fitted reducer") for message in messages) == 1
+        assert sum(message.startswith("Using the PCA reducer") for message in messages) == 1
+        reduce_dims("t", original, 'PCA', pca_solver='incremental', chunk_rows=20)
+        reduce_dims("t", original, 'PCA', pca_solver='incremental', chunk_rows=30)
+        assert len(os.listdir(tmp_path / "cache")) == 3
+    finally:
+        logger.remove(sink)
+
+
+@pytest.mark.filterwarnings("error::bokeh.util.warnings.BokehDeprecationWarning")
+@pytest.mark.parametrize("max_points,keyed", [(1000, False), (1000, True), (50, True)])
+def test_viz_saves_html(tmp_path, max_points, keyed):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(200, 2)), columns=["PCA_1", "PCA_2"])
+    df["Label"] = [f"p{i}" for i in range(len(df))]
+    key = None
+    if keyed:
+        key = str(tmp_path / "key.csv")
+        pd.DataFrame({"Label": df["Label"], "Class": [f"c{i % 3}" for i in range(len(df))]}).to_csv(key, index=False)
+    args = SimpleNamespace(name="toy", key=key, max_points=max_points)
+    tile_dir = str(tmp_path / "toy_tiles")
+    html = str(tmp_path / "toy.html")
+    bokeh.io.save(viz(df, args, tile_dir=tile_dir), filename=html, title="toy", resources="cdn")
+    with open(html) as f:
+        page = f.read()
+    if max_points < len(df):
+        assert any(name.startswith("tile_") for name in os.listdir(tile_dir)) and "trillTiles" in page
+    else:
+        assert not os.path.exists(tile_dir) and "CustomJSFilter" in page
+        assert ("IntersectionFilter" in page) == keyed
@@ -51,18 +51,40 @@ def setup(subparsers):
 
     classify.add_argument(
         "--preComputed_Embs",
-        help="Enter the path to your pre-computed embeddings. Make sure they match the --emb_model you select.",
+        help="Enter the path to your pre-computed embeddings. Make sure they match the --emb_model you select. "
+             "TemStaPro also accepts an embedding store (.npy matrix with a matching _labels.txt).",
         action="store",
         default=False
     )
 
     classify.add_argument(
         "--batch_size",
-        help="EpHod: Sets batch_size for embedding with ESM1v.",
+        help="TemStaPro: Sets batch_size for embedding with ProtT5. EpHod batches are set by --toks_per_batch "
+             "instead. ESM2+MLP: Maximum number of sequences in a training batch, which is also capped at "
+             "--toks_per_batch tokens.",
         action="store",
         default=1
     )
 
+    classify.add_argument(
+        "--toks_per_batch",
+        help="EpHod/ESM2+MLP: Sequences are grouped by length and packed into batches of at most this many "
+             "ESM1v/ESM2 tokens (padded length x sequences). ESM2+MLP training batches also hold at most "
+             "--batch_size sequences, and with --freeze_backbone --batch_size sets the batch size for training the "
+             "head. Default is 4096.",
+        action="store",
+        default=4096
+    )
+
+    classify.add_argument(
+        "--chunk_rows",
+        help="XGBoost/LightGBM/iForest: Number of embeddings scored at a time with --preTrained. Up to 2 x "
+             "--n_workers chunks are predicted in parallel and results are appended to the output as they finish. "
+             "Default is 65536",
+        action="store",
+        default=65536
+    )
+
     classify.add_argument(
         "--xg_gamma",
         help="XGBoost: sets gamma for XGBoost, which is a hyperparameter that sets 'Minimum loss reduction required "
@@ -141,7 +163,9 @@ def setup(subparsers):
     )
     classify.add_argument(
         "--sweep",
-        help="XGBoost/LightGBM: Use this flag to perform cross-validated bayesian optimization over the hyperparameter space.",
+        help="XGBoost/LightGBM: Use this flag to perform a cross-validated hyperparameter sweep. Candidates are "
+             "trained --n_workers at a time and only the most promising ones keep boosting (successive halving). "
+             "Every trial is logged to {name}_{classifier}_sweep_trials.csv.",
         action="store_true",
         default=False
     )
@@ -151,6 +175,19 @@ def setup(subparsers):
         action="store",
         default=3
     )
+    classify.add_argument(
+        "--sweep_trials",
+        help="XGBoost/LightGBM: Number of hyperparameter candidates to try when sweeping. Default is 30",
+        action="store",
+        default=30
+    )
+    classify.add_argument(
+        "--sweep_resume",
+        help="XGBoost/LightGBM: Resume an interrupted sweep from its {name}_{classifier}_sweep_trials.csv, "
+             "which must have been written with the same --RNG_seed and --sweep_cv.",
+        action="store_true",
+        default=False
+    )
     classify.add_argument(
         "--f1_avg_method",
         help="XGBoost/LightGBM: Change the scoring method used for calculated F1. Default is with no averaging.",
@@ -166,12 +203,34 @@ def setup(subparsers):
         default=3
     )
 
+    classify.add_argument(
+        "--freeze_backbone",
+        help="ESM2+MLP: Keep the ESM2 weights frozen and train only the classification head. The train and test "
+             "sequences are embedded once (cached in ~/.trill_cache/ESM2_MLP_features) and the head is trained on "
+             "those features in batches of --batch_size. Apart from that single forward pass over the sequences, "
+             "each epoch takes seconds, even without a GPU. The saved model works with --preTrained like an "
+             "end-to-end trained one.",
+        action="store_true",
+        default=False
+    )
+
     classify.add_argument(
         "--db",
-        help="3Di-Search: Specify the path of the fasta file for your database that you want to query against.",
+        help="3Di-Search: Specify the path of the fasta file for your database that you want to query against. "
+             "The Foldseek database built from it is cached in ~/.trill_cache/3Di_Search_DBs and reused while the "
+             "file is unchanged; when sequences are added, only the new ones are run through ProstT5.",
         action="store",
     )
 
+    classify.add_argument(
+        "--search_backend",
+        help="3Di-Search: Use the foldseek executable or TRILL's built-in 3Di+AA search (k-mer prefilter and "
+             "Smith-Waterman in NumPy, parallelized over --n_workers). Default is foldseek.",
+        action="store",
+        default="foldseek",
+        choices=("foldseek", "native")
+    )
+
 def run(args):
     import builtins
     import logging
@@ -179,6 +238,7 @@ def run(args):
     import shutil
     import subprocess
     import sys
+    import time
 
     import esm
     import numpy as np
@@ -197,23 +257,20 @@ def run(args):
     from sklearn.metrics import precision_recall_fscore_support
     import trill.utils.ephod_utils as eu
     from trill.commands.fold import process_sublist
-    from trill.utils.MLP import MLP_C2H2, inference_epoch
-    from trill.utils.classify_utils import prep_data, setup_esm2_hf, prep_foldseek_dbs, get_3di_embeddings, log_results, sweep, prep_hf_data, custom_esm2mlp_test, train_model, load_model, custom_model_test, predict_and_evaluate
+    from trill.utils.MLP import MLP_C2H2, MLP_C2H2_Ensemble, ensemble_inference
+    from trill.utils.batch_inference import predict_in_chunks
+    from trill.utils.cache import populate
+    from trill.utils.download import download
+    from trill.utils.embedding_store import open_embedding_store, load_embeddings, remove_embedding_store
+    from trill.utils.classify_utils import prep_data, setup_esm2_hf, prep_foldseek_dbs, get_3di_embeddings, load_3di_models, log_results, sweep, prep_hf_data, custom_esm2mlp_test, train_frozen_esm2_mlp, train_model, load_model, custom_model_test, predict_and_evaluate
     from trill.utils.esm_utils import parse_and_save_all_predictions, convert_outputs_to_pdb
+    from trill.utils.foldseek_utils import get_cached_foldseek_db, write_db_3di_outputs, read_db_records
+    from trill.utils.tdi_search import NativeSearchDB, load_substitution_matrices, native_3di_search
     from trill.utils.lightning_models import ProtT5, CustomWriter, ProstT5
     from .commands_common import cache_dir, get_logger
 
     ml_logger = get_logger(args)
 
-    class CustomDataset(torch.utils.data.Dataset):
-        def __init__(self, data):
-            self.data = data
-
-        def __len__(self):
-            return len(self.data)
-
-        def __getitem__(self, idx):
-            return self.data[idx]
     if args.sweep and not args.train_split:
         logger.error("You need to provide a train-test fraction with --train_split!")
         raise Exception("You need to provide a train-test fraction with --train_split!")
@@ -221,77 +278,67 @@ def run(args):
         if not args.preComputed_Embs:
             data = esm.data.FastaBatchedDataset.from_file(args.query)
             model = ProtT5(args)
-            dataloader = torch.utils.data.DataLoader(data, shuffle=False, batch_size=1, num_workers=0)
+            dataloader = torch.utils.data.DataLoader(data, shuffle=False, batch_size=int(args.batch_size), num_workers=0)
+            pred_writer = CustomWriter(output_dir=args.outdir, write_interval="epoch")
             if int(args.GPUs) > 0:
                 trainer = pl.Trainer(enable_checkpointing=False, devices=int(args.GPUs), accelerator="gpu",
-                                     logger=ml_logger, num_nodes=int(args.nodes))
+                                     callbacks=[pred_writer], logger=ml_logger, num_nodes=int(args.nodes))
             else:
-                trainer = pl.Trainer(enable_checkpointing=False, logger=ml_logger, num_nodes=int(args.nodes))
+                trainer = pl.Trainer(enable_checkpointing=False, callbacks=[pred_writer], logger=ml_logger,
+                                     num_nodes=int(args.nodes))
             reps = trainer.predict(model, dataloader)
-            parse_and_save_all_predictions(args)
-        if not os.path.exists(os.path.join(cache_dir, "TemStaPro_models")):
-            temstapro_models = Repo.clone_from("https://github.com/martinez-zacharya/TemStaPro_models",
-                                               os.path.join(cache_dir, "TemStaPro_models"))
-            temstapro_models_root = temstapro_models.git.rev_parse("--show-toplevel")
-        else:
-            temstapro_models = Repo(os.path.join(cache_dir, "TemStaPro_models"))
-            temstapro_models_root = temstapro_models.git.rev_parse("--show-toplevel")
+            parse_and_save_all_predictions(args, as_store=True)
+            for file in os.listdir(args.outdir):
+                if "predictions_" in file:
+                    os.remove(os.path.join(args.outdir, file))
+        temstapro_models_root = populate(
+            os.path.join(cache_dir, "TemStaPro_models"),
+            lambda tmp: Repo.clone_from("https://github.com/martinez-zacharya/TemStaPro_models", tmp))
         THRESHOLDS = ("40", "45", "50", "55", "60", "65")
         SEEDS = ("41", "42", "43", "44", "45")
         if not args.preComputed_Embs:
-            emb_df = pd.read_csv(os.path.join(args.outdir, f"{args.name}_ProtT5_AVG.csv"))
+            embs, labels = open_embedding_store(os.path.join(args.outdir, f"{args.name}_ProtT5_AVG.npy"))
         else:
-            emb_df = pd.read_csv(args.preComputed_Embs)
-        embs = emb_df[emb_df.columns[:-1]].applymap(lambda x: torch.tensor(x)).values.tolist()
-        labels = emb_df.iloc[:, -1]
-        list_of_tensors = [torch.tensor(l) for l in embs]
-        input_data = list(zip(list_of_tensors, labels))
-        custom_dataset = CustomDataset(input_data)
-        emb_loader = torch.utils.data.DataLoader(custom_dataset, shuffle=False, batch_size=1, num_workers=0)
-        inferences = {}
+            embs, labels = load_embeddings(args.preComputed_Embs)
+
+        # All 30 MLPs (thresholds x seeds) are stacked into one module and score every embedding at once
+        clfs = []
         for thresh in THRESHOLDS:
-            threshold_inferences = {}
             for seed in SEEDS:
                 clf = MLP_C2H2(1024, 512, 256)
                 clf.load_state_dict(torch.load(os.path.join(
-                    temstapro_models_root, f"mean_major_imbal-{thresh}_s{seed}.pt")))
-                clf.eval()
-                if int(args.GPUs) > 0:
-                    clf.to("cuda")
-                    threshold_inferences[seed] = inference_epoch(clf, emb_loader, device="cuda")
-                else:
-                    threshold_inferences[seed] = inference_epoch(clf, emb_loader, device="cpu")
-            for seq in threshold_inferences["41"].keys():
-                mean_prediction = 0
-                for seed in SEEDS:
-                    mean_prediction += threshold_inferences[seed][seq]
-                mean_prediction /= len(SEEDS)
-                binary_pred = builtins.round(mean_prediction)
-                inferences[f"{seq}$%#{thresh}"] = (mean_prediction, binary_pred)
-        inference_df = pd.DataFrame.from_dict(inferences, orient="index", columns=("Mean_Pred", "Binary_Pred"))
-        inference_df = inference_df.reset_index(names="RawLab")
-        inference_df["Protein"] = inference_df["RawLab"].apply(lambda x: x.split("$%#")[0])
-        inference_df["Threshold"] = inference_df["RawLab"].apply(lambda x: x.split("$%#")[-1])
-        inference_df = inference_df.drop(columns="RawLab")
-        inference_df = inference_df[("Protein", "Threshold", "Mean_Pred", "Binary_Pred")]
+                    temstapro_models_root, f"mean_major_imbal-{thresh}_s{seed}.pt"), map_location="cpu"))
+                clfs.append(clf)
+        device = "cuda" if int(args.GPUs) > 0 else "cpu"
+        ensemble = MLP_C2H2_Ensemble(clfs).eval().to(device)
+        preds = ensemble_inference(ensemble, embs, device=device)
+        mean_preds = preds.reshape(len(THRESHOLDS), len(SEEDS), -1).mean(axis=1)
+
+        inference_df = pd.DataFrame({
+            "Protein": np.tile(np.asarray(labels, dtype=object), len(THRESHOLDS)),
+            "Threshold": np.repeat(THRESHOLDS, len(labels)),
+            "Mean_Pred": mean_preds.reshape(-1),
+            "Binary_Pred": np.round(mean_preds.reshape(-1)),
+        })
         inference_df.to_csv(os.path.join(args.outdir, f"{args.name}_TemStaPro_preds.csv"), index=False)
-        if not args.save_emb:
-            os.remove(os.path.join(args.outdir, f"{args.name}_ProtT5_AVG.csv"))
+        if not args.save_emb and not args.preComputed_Embs:
+            remove_embedding_store(os.path.join(args.outdir, f"{args.name}_ProtT5_AVG.npy"))
 
     elif args.classifier == "EpHod":
         logging.getLogger("pytorch_lightning.utilities.rank_zero").addHandler(logging.NullHandler())
         logging.getLogger("pytorch_lightning.accelerators.cuda").addHandler(logging.NullHandler())
-        if not os.path.exists(os.path.join(cache_dir, "EpHod_Models")):
+        def fetch_ephod_models(tmp):
             logger.info("Downloading EpHod models...")
-            cmd = ("curl", "-o", "saved_models.tar.gz", "--progress-bar",
-                   "https://zenodo.org/records/8011249/files/saved_models.tar.gz?download=1")
-            result = subprocess.run(cmd)
+            tarfile = download("https://zenodo.org/records/8011249/files/saved_models.tar.gz?download=1",
+                               os.path.join(cache_dir, "saved_models.tar.gz"))
+            shutil.unpack_archive(tarfile, f"{tmp}_unpack")
+            shutil.move(os.path.join(f"{tmp}_unpack", "saved_models"), tmp)
+            shutil.rmtree(f"{tmp}_unpack")
+            # The tarball may come from the read-only shared cache
+            if tarfile == os.path.join(cache_dir, "saved_models.tar.gz"):
+                os.remove(tarfile)
 
-            shutil.move("saved_models.tar.gz", cache_dir)
-            tarfile = os.path.join(cache_dir, "saved_models.tar.gz")
-            shutil.unpack_archive(tarfile, cache_dir)
-            os.remove(tarfile)
-            shutil.move(os.path.join(cache_dir, "saved_models"), os.path.join(cache_dir, "EpHod_Models"))
+        populate(os.path.join(cache_dir, "EpHod_Models"), fetch_ephod_models)
 
         headers, sequences = eu.read_fasta(args.query)
         accessions = [head.split()[0] for head in headers]
@@ -318,23 +365,14 @@ def run(args):
         phout_file = os.path.join(args.outdir, f"{args.name}_EpHod.csv")
         embed_file = os.path.join(args.outdir, f"{args.name}_ESM1v_embeddings.csv")
         ephod_model = eu.EpHodModel(args)
-        num_batches = int(np.ceil(numseqs / args.batch_size))
-        all_ypred, all_emb_ephod = [], []
-        batches = range(1, num_batches + 1)
-        batches = tqdm(batches, desc="Predicting pHopt")
-        for batch_step in batches:
-            start_idx = (batch_step - 1) * args.batch_size
-            stop_idx = batch_step * args.batch_size
-            accs = accessions[start_idx: stop_idx]
-            seqs = sequences[start_idx: stop_idx]
-
-            # Predict with EpHod model
-            ypred, emb_ephod, attention_weights = ephod_model.batch_predict(accs, seqs, args)
-            all_ypred.extend(ypred.to("cpu").detach().numpy())
-            all_emb_ephod.extend(emb_ephod.to("cpu").detach().numpy())
+        start = time.time()
+        all_ypred, all_emb_ephod = ephod_model.predict(accessions, sequences, int(args.toks_per_batch))
+        elapsed = time.time() - start
+        logger.info(f"Predicted pHopt for {numseqs} sequences in {elapsed:.1f}s "
+                    f"({numseqs / max(elapsed, 1e-9):.1f} seqs/s)")
 
         if args.save_emb:
-            all_emb_ephod = pd.DataFrame(np.array(all_emb_ephod), index=accessions)
+            all_emb_ephod = pd.DataFrame(all_emb_ephod, index=accessions)
             all_emb_ephod.to_csv(embed_file)
 
         all_ypred = pd.DataFrame(all_ypred, index=accessions, columns=["pHopt"])
@@ -350,11 +388,18 @@ def run(args):
             logger.info("Prepping data for training ESM2+MLP...")
             train_df, test_df, n_classes, le = prep_hf_data(args)
             logger.info("Setting up ESM2+MLP...")
-            trainer, test_dataset = setup_esm2_hf(train_df, test_df, args, n_classes)
-            train_res = trainer.train()
-            test_res = trainer.predict(test_dataset = test_dataset)
-            trainer.model.save_pretrained(os.path.join(args.outdir, f'{args.name}_{args.emb_model}-MLP_{n_classes}-classifier.pt'), safe_serialization=False) 
-            preds = np.argmax(test_res[0], axis=1)
+            if args.freeze_backbone:
+                model, test_logits = train_frozen_esm2_mlp(train_df, test_df, args, n_classes)
+            else:
+                trainer, test_dataset = setup_esm2_hf(train_df, test_df, args, n_classes)
+                train_res = trainer.train()
+                logger.info(f"Trained at {train_res.metrics['train_samples_per_second']:.2f} seqs/s")
+                test_res = trainer.predict(test_dataset = test_dataset)
+                logger.info(f"Predicted at {test_res.metrics['test_samples_per_second']:.2f} seqs/s")
+                test_logits = test_res[0]
+                model = trainer.model
+            model.save_pretrained(os.path.join(args.outdir, f'{args.name}_{args.emb_model}-MLP_{n_classes}-classifier.pt'), safe_serialization=False) 
+            preds = np.argmax(test_logits, axis=1)
             transformed_preds = le.inverse_transform(preds)
             unique_c = np.unique(transformed_preds)
             precision, recall, fscore, support = precision_recall_fscore_support(test_df['NewLab'].values, preds, average=args.f1_avg_method, labels=np.unique(test_df['NewLab']))
@@ -362,6 +407,7 @@ def run(args):
         else:
             trainer, dataset, label_list = custom_esm2mlp_test(args)
             test_res = trainer.predict(test_dataset=dataset)
+            logger.info(f"Predicted at {test_res.metrics['test_samples_per_second']:.2f} seqs/s")
             # Convert probabilities to a DataFrame
             proba_df = pd.DataFrame(test_res[0])
             
@@ -385,6 +431,8 @@ def run(args):
 
     elif args.classifier != "iForest" and args.classifier != '3Di-Search':
         outfile = os.path.join(args.outdir, f"{args.name}_{args.classifier}.out")
+        # Inference streams the embeddings in chunks, so they are written as a memory-mappable store
+        as_store = args.train_split is None
         if not args.preComputed_Embs:
             embed_command = (
                 "trill",
@@ -396,12 +444,15 @@ def run(args):
                 args.query,
                 "--avg"
             )
+            if as_store:
+                embed_command += ("--emb_store",)
             subprocess.run(embed_command, check=True)
-            df = pd.read_csv(os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.csv"))
+            emb_path = os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.{'npy' if as_store else 'csv'}")
         else:
-            df = pd.read_csv(args.preComputed_Embs)
+            emb_path = args.preComputed_Embs
 
         if args.train_split is not None:
+            df = pd.read_csv(emb_path)
             le = LabelEncoder()
             train_df, test_df, n_classes = prep_data(df, args)
             unique_c = np.unique(test_df["NewLab"])
@@ -430,13 +481,14 @@ def run(args):
                 raise Exception("You need to provide a model with --preTrained to perform inference!")
             else:
                 clf = load_model(args)
-                custom_model_test(clf, df, args)
+                custom_model_test(clf, emb_path, args)
 
                 if not args.save_emb and not args.preComputed_Embs:
-                    os.remove(os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.csv"))
+                    remove_embedding_store(emb_path)
 
     elif args.classifier == "iForest":
-        # Load embeddings
+        # Load embeddings. Inference streams them in chunks, so they are written as a memory-mappable store
+        as_store = bool(args.preTrained)
         if not args.preComputed_Embs:
             embed_command = (
                 "trill",
@@ -448,10 +500,14 @@ def run(args):
                 args.query,
                 "--avg"
             )
+            if as_store:
+                embed_command += ("--emb_store",)
             subprocess.run(embed_command, check=True)
-            df = pd.read_csv(os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.csv"))
+            emb_path = os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.{'npy' if as_store else 'csv'}")
         else:
-            df = pd.read_csv(args.preComputed_Embs)
+            emb_path = args.preComputed_Embs
+        if not args.preTrained:
+            df = pd.read_csv(emb_path)
 
         # Filter fasta file
         if args.preComputed_Embs and not args.preTrained:
@@ -473,30 +529,48 @@ def run(args):
         else:
             model = sio.load(args.preTrained, trusted=True)
 
-            # Predict and output results
-            preds = model.predict(df.iloc[:, :-1])
-            # unique_values, counts = np.unique(preds, return_counts=True)
-            # for value, count in zip(unique_values, counts):
-            #     print(f"{value}: {count}")
-
-            df["Predicted_Class"] = preds
-            out_df = df[("Label", "Predicted_Class")]
-            out_df.to_csv(os.path.join(args.outdir, f"{args.name}_iForest_predictions.csv"), index=False)
+            # Predict and output results, a chunk of embeddings at a time
+            predict_in_chunks(emb_path, lambda features, labels: [pd.DataFrame({"Label": labels, "Predicted_Class": model.predict(features)})],
+                              [os.path.join(args.outdir, f"{args.name}_iForest_predictions.csv")],
+                              n_workers=args.n_workers, chunk_rows=args.chunk_rows)
         if not args.save_emb and not args.preComputed_Embs:
-            os.remove(os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.csv"))
+            if as_store:
+                remove_embedding_store(emb_path)
+            else:
+                os.remove(emb_path)
 
 
     elif args.classifier == '3Di-Search':
         logger.info(f'Prepping Foldseek databases from {args.query} and {args.db}')
-        query_preds_out_path, db_preds_out_path = get_3di_embeddings(args, cache_dir)
-        prep_foldseek_dbs(args.query, query_preds_out_path, f'{args.name}_query')
-        prep_foldseek_dbs(args.db, db_preds_out_path, f'{args.name}_db')
-        logger.info(f'Finished creating Foldseek databases!')
-        foldseek_search_cmd = f'foldseek search tmp_{args.name}_query_db tmp_{args.name}_db_db {args.name}_3di-search_results tmp -v 0'
-        logger.info(f'Starting foldseek search with: \n{foldseek_search_cmd}')
-        subprocess.run(foldseek_search_cmd.split())
+        models = []
+        def get_3di_models():
+            if not models:
+                models.extend(load_3di_models(args, cache_dir))
+            return models
+        native = args.search_backend == 'native'
+        db_entry = get_cached_foldseek_db(args.db, get_3di_models, foldseek=not native)
+        write_db_3di_outputs(db_entry, args)
+        query_preds_out_path, = get_3di_embeddings(args, cache_dir, inputs=('query',), models=get_3di_models())
         output_path = os.path.join(args.outdir, f'{args.name}_3di-search_results.tsv')
-        foldseek_convertalis_cmd = f'foldseek convertalis tmp_{args.name}_query_db tmp_{args.name}_db_db {args.name}_3di-search_results {output_path} -v 0'.split()
-        subprocess.run(foldseek_convertalis_cmd)
-        logger.info(f'Foldseek output can be found at {output_path}!')
+        if native:
+            mat3di, blosum = load_substitution_matrices(cache_dir)
+            db_ids, db_aa, db_3di, _ = zip(*read_db_records(db_entry))
+            native_db = NativeSearchDB(db_ids, db_aa, db_3di, mat3di, blosum)
+            query_3di = {record.id: str(record.seq) for record in SeqIO.parse(query_preds_out_path, 'fasta')}
+            queries = [(record.id, str(record.seq).replace('-', ''), query_3di[record.id])
+                       for record in SeqIO.parse(args.query, 'fasta') if record.id in query_3di]
+            native_3di_search(queries, native_db, output_path, n_workers=int(args.n_workers))
+            logger.info(f'3Di search output can be found at {output_path}!')
+        else:
+            prep_foldseek_dbs(args.query, query_preds_out_path, f'{args.name}_query')
+            logger.info(f'Finished creating Foldseek databases!')
+            db_path = os.path.join(db_entry, 'db')
+            foldseek_search_cmd = f'foldseek search tmp_{args.name}_query_db {db_path} {args.name}_3di-search_results tmp -v 0'
+            logger.info(f'Starting foldseek search with: \n{foldseek_search_cmd}')
+            start = time.time()
+            subprocess.run(foldseek_search_cmd.split())
+            foldseek_convertalis_cmd = f'foldseek convertalis tmp_{args.name}_query_db {db_path} {args.name}_3di-search_results {output_path} -v 0'.split()
+            subprocess.run(foldseek_convertalis_cmd)
+            logger.info(f'Foldseek search took {time.time() - start:.1f}s')
+            logger.info(f'Foldseek output can be found at {output_path}!')
 
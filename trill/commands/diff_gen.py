@@ -88,48 +88,42 @@ def run(args):
     import subprocess
     import sys
 
-    import requests
     from git import Repo
     from run_inference import run_rfdiff
     from loguru import logger
+    from trill.utils.cache import pip_installed, populate
+    from trill.utils.download import download
     from .commands_common import cache_dir
 
     # command = "conda install -c dglteam dgl-cuda11.7 -y -S -q".split(" ")
     # subprocess.run(command, check=True)
     logger.info("Finding RFDiffusion weights... \n")
-    if not os.path.exists((os.path.join(cache_dir, "RFDiffusion_weights"))):
-        os.makedirs(os.path.join(cache_dir, "RFDiffusion_weights"))
-
-        urls = (
-            "http://files.ipd.uw.edu/pub/RFdiffusion/6f5902ac237024bdd0c176cb93063dc4/Base_ckpt.pt",
-            "http://files.ipd.uw.edu/pub/RFdiffusion/e29311f6f1bf1af907f9ef9f44b8328b/Complex_base_ckpt.pt",
-            "http://files.ipd.uw.edu/pub/RFdiffusion/60f09a193fb5e5ccdc4980417708dbab/Complex_Fold_base_ckpt.pt",
-            "http://files.ipd.uw.edu/pub/RFdiffusion/74f51cfb8b440f50d70878e05361d8f0/InpaintSeq_ckpt.pt",
-            "http://files.ipd.uw.edu/pub/RFdiffusion/76d00716416567174cdb7ca96e208296/InpaintSeq_Fold_ckpt.pt",
-            "http://files.ipd.uw.edu/pub/RFdiffusion/5532d2e1f3a4738decd58b19d633b3c3/ActiveSite_ckpt.pt",
-            "http://files.ipd.uw.edu/pub/RFdiffusion/12fc204edeae5b57713c5ad7dcb97d39/Base_epoch8_ckpt.pt"
-        )
-        for url in urls:
-            if not os.path.isfile(os.path.join(cache_dir, "RFDiffusion_weights", url.split('/')[-1])):
-                logger.info(f"Fetching {url}...")
-                response = requests.get(url)
-                with open(os.path.join(cache_dir, "RFDiffusion_weights", url.split('/')[-1]), "wb") as fp:
-                    fp.write(response.content)
-
-    if not os.path.exists(os.path.join(cache_dir, "RFDiffusion")):
-        logger.info("Cloning forked RFDiffusion")
-        os.makedirs(os.path.join(cache_dir, "RFDiffusion"))
-        rfdiff = Repo.clone_from("https://github.com/martinez-zacharya/RFDiffusion",
-                                 os.path.join(cache_dir, "RFDiffusion", ""))
-        rfdiff_git_root = rfdiff.git.rev_parse("--show-toplevel")
-        subprocess.run(("pip", "install", "-e", rfdiff_git_root))
-        subprocess.run(("pip", "install", os.path.join(rfdiff_git_root, "env", "SE3Transformer")))
-        sys.path.insert(0, os.path.join(cache_dir, "RFDiffusion"))
-
-    else:
-        sys.path.insert(0, os.path.join(cache_dir, "RFDiffusion"))
-        git_repo = Repo(os.path.join(cache_dir, "RFDiffusion"), search_parent_directories=True)
-        rfdiff_git_root = git_repo.git.rev_parse("--show-toplevel")
+    urls = (
+        "http://files.ipd.uw.edu/pub/RFdiffusion/6f5902ac237024bdd0c176cb93063dc4/Base_ckpt.pt",
+        "http://files.ipd.uw.edu/pub/RFdiffusion/e29311f6f1bf1af907f9ef9f44b8328b/Complex_base_ckpt.pt",
+        "http://files.ipd.uw.edu/pub/RFdiffusion/60f09a193fb5e5ccdc4980417708dbab/Complex_Fold_base_ckpt.pt",
+        "http://files.ipd.uw.edu/pub/RFdiffusion/74f51cfb8b440f50d70878e05361d8f0/InpaintSeq_ckpt.pt",
+        "http://files.ipd.uw.edu/pub/RFdiffusion/76d00716416567174cdb7ca96e208296/InpaintSeq_Fold_ckpt.pt",
+        "http://files.ipd.uw.edu/pub/RFdiffusion/5532d2e1f3a4738decd58b19d633b3c3/ActiveSite_ckpt.pt",
+        "http://files.ipd.uw.edu/pub/RFdiffusion/12fc204edeae5b57713c5ad7dcb97d39/Base_epoch8_ckpt.pt"
+    )
+    for url in urls:
+        weights_path = os.path.join(cache_dir, "RFDiffusion_weights", url.split('/')[-1])
+        found = download(url, weights_path)
+        # RFDiffusion reads its weights from the per-user cache, so link in the shared cache copies
+        if found != weights_path and not os.path.lexists(weights_path):
+            os.makedirs(os.path.dirname(weights_path), exist_ok=True)
+            os.symlink(found, weights_path)
+
+    def install_rfdiff(path):
+        subprocess.run(("pip", "install", "-e", path))
+        subprocess.run(("pip", "install", os.path.join(path, "env", "SE3Transformer")))
+
+    rfdiff_git_root = populate(os.path.join(cache_dir, "RFDiffusion"),
+                               lambda tmp: Repo.clone_from("https://github.com/martinez-zacharya/RFDiffusion", tmp),
+                               after=install_rfdiff,
+                               installed=lambda path: pip_installed(path, os.path.join(path, "env", "SE3Transformer")))
+    sys.path.insert(0, rfdiff_git_root)
 
     # if args.sym:
     #     run_rfdiff(os.path.join(rfdiff_git_root, "config", "inference", "symmetry.yaml"), args)
@@ -143,6 +143,8 @@ def setup(subparsers):
 
 
 def run(args):
+    import importlib
+    import importlib.util
     import os
     import subprocess
     import sys
@@ -150,12 +152,13 @@ def run(args):
     import esm
     import pkg_resources
     import pytorch_lightning as pl
-    import requests
     import torch
     from esm.inverse_folding.util import load_coords
     from git import Repo
     from loguru import logger
+    from trill.utils.cache import FileLock, pip_installed, populate
     from trill.utils.dock_utils import perform_docking, write_docking_results_to_file
+    from trill.utils.download import download
     from trill.utils.esm_utils import parse_and_save_all_predictions
     from trill.utils.lightning_models import ESM, CustomWriter
     from .commands_common import cache_dir, get_logger
@@ -192,15 +195,15 @@ def run(args):
         try:
             pkg_resources.get_distribution("geodock")
         except pkg_resources.DistributionNotFound:
-            install_cmd = "pip install git+https://github.com/martinez-zacharya/GeoDock.git".split(" ")
-            subprocess.run(install_cmd)
+            # Jobs sharing an environment install GeoDock once instead of all running pip at the same time
+            with FileLock(os.path.join(cache_dir, "GeoDock_install.lock")):
+                importlib.invalidate_caches()
+                if importlib.util.find_spec("geodock") is None:
+                    install_cmd = "pip install git+https://github.com/martinez-zacharya/GeoDock.git".split(" ")
+                    subprocess.run(install_cmd)
         from geodock.GeoDockRunner import EnMasseGeoDockRunner
         base_url = "https://raw.githubusercontent.com/martinez-zacharya/GeoDock/main/geodock/weights/dips_0.3.ckpt"
-        weights_path = f"{cache_dir}/dips_0.3.ckpt"
-        if not os.path.exists(weights_path):
-            r = requests.get(base_url)
-            with open(weights_path, "wb") as file:
-                file.write(r.content)
+        weights_path = download(base_url, f"{cache_dir}/dips_0.3.ckpt")
 
         rec_coord, rec_seq = load_coords(args.protein, chain=None)
         rec_name = os.path.basename(args.protein).split(".")[0]
@@ -255,18 +258,11 @@ def run(args):
         os.remove(f"{args.outdir}/predictions_0.pt")
 
     elif args.algorithm == "DiffDock":
-        if not os.path.exists(os.path.join(cache_dir, "DiffDock")):
-            logger.info("Cloning forked DiffDock")
-            os.makedirs(os.path.join(cache_dir, "DiffDock"))
-            diffdock = Repo.clone_from("https://github.com/martinez-zacharya/DiffDock",
-                                       os.path.join(cache_dir, "DiffDock"))
-            diffdock_root = diffdock.git.rev_parse("--show-toplevel")
-            subprocess.run(["pip", "install", "-e", diffdock_root])
-            sys.path.insert(0, os.path.join(cache_dir, "DiffDock"))
-        else:
-            sys.path.insert(0, os.path.join(cache_dir, "DiffDock"))
-            diffdock = Repo(os.path.join(cache_dir, "DiffDock"))
-            diffdock_root = diffdock.git.rev_parse("--show-toplevel")
+        diffdock_root = populate(os.path.join(cache_dir, "DiffDock"),
+                                 lambda tmp: Repo.clone_from("https://github.com/martinez-zacharya/DiffDock", tmp),
+                                 after=lambda path: subprocess.run(["pip", "install", "-e", path]),
+                                 installed=pip_installed)
+        sys.path.insert(0, diffdock_root)
         from inference import run_diffdock
         run_diffdock(args, diffdock_root)
 
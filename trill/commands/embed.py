@@ -43,6 +43,20 @@ def setup(subparsers):
         action="store_true",
         default=False,
     )
+    embed.add_argument(
+        "--emb_store",
+        help="Write the average embeddings as a memory-mappable embedding store ({name}_{model}_AVG.npy plus "
+             "{name}_{model}_AVG_labels.txt) instead of a CSV. Much faster to read back for large sets.",
+        action="store_true",
+        default=False,
+    )
+    embed.add_argument(
+        "--esmfold_states",
+        help="esm2_t36_3B: Also cache the per-residue hidden states of every layer in ~/.trill_cache so that "
+             "trill fold ESMFold --reuse_lm_states can skip running the ESM-2 3B language model again.",
+        action="store_true",
+        default=False,
+    )
 
 
 def run(args):
@@ -52,7 +66,7 @@ def run(args):
     import pytorch_lightning as pl
     import torch
 
-    from trill.utils.esm_utils import parse_and_save_all_predictions
+    from trill.utils.esm_utils import parse_and_save_all_predictions, ESMFOLD_STATES_DIR
     from trill.utils.lightning_models import ESM, CustomWriter, ProtT5, ProstT5, Ankh
     from trill.utils.update_weights import weights_update
     from loguru import logger
@@ -63,9 +77,12 @@ def run(args):
     if not args.query.endswith((".fasta", ".faa", ".fa")):
         raise Exception(f"Input query file - {args.query} is not a valid file format.\
         File needs to be a protein fasta (.fa, .fasta, .faa)")
-    if not args.avg and not args.per_AA:
+    if not args.avg and not args.per_AA and not args.esmfold_states:
         logger.error("You need to select whether you want the average sequence embeddings or the per AA embeddings, or both!")
         raise RuntimeError
+    if args.esmfold_states and args.model != "esm2_t36_3B":
+        logger.error("--esmfold_states is only available for esm2_t36_3B, the language model used by ESMFold!")
+        raise RuntimeError
     if args.model == "ProtT5-XL":
         model = ProtT5(args)
         data = esm.data.FastaBatchedDataset.from_file(args.query)
@@ -80,7 +97,7 @@ def run(args):
         reps = trainer.predict(model, dataloader)
         cwd_files = os.listdir(args.outdir)
         pt_files = [file for file in cwd_files if "predictions_" in file]
-        parse_and_save_all_predictions(args)
+        parse_and_save_all_predictions(args, as_store=args.emb_store)
 
         for file in pt_files:
             os.remove(os.path.join(args.outdir, file))
@@ -100,7 +117,7 @@ def run(args):
         reps = trainer.predict(model, dataloader)
         cwd_files = os.listdir(args.outdir)
         pt_files = [file for file in cwd_files if "predictions_" in file]
-        parse_and_save_all_predictions(args)
+        parse_and_save_all_predictions(args, as_store=args.emb_store)
         for file in pt_files:
             os.remove(os.path.join(args.outdir, file))
 
@@ -120,7 +137,7 @@ def run(args):
         reps = trainer.predict(model, dataloader)
         cwd_files = os.listdir(args.outdir)
         pt_files = [file for file in cwd_files if "predictions_" in file]
-        parse_and_save_all_predictions(args)
+        parse_and_save_all_predictions(args, as_store=args.emb_store)
         for file in pt_files:
             os.remove(os.path.join(args.outdir, file))
 
@@ -141,8 +158,10 @@ def run(args):
             model = weights_update(model=ESM(eval(model_import_name), 0.0001, args),
                                    checkpoint=torch.load(args.finetuned))
         trainer.predict(model, dataloader)
+        if args.esmfold_states:
+            logger.info(f"Cached ESM-2 3B states for trill fold ESMFold --reuse_lm_states in {ESMFOLD_STATES_DIR}")
 
-        parse_and_save_all_predictions(args)
+        parse_and_save_all_predictions(args, as_store=args.emb_store)
 
         cwd_files = os.listdir(args.outdir)
         pt_files = [file for file in cwd_files if "predictions_" in file]
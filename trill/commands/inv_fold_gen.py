@@ -365,6 +365,7 @@ def run(args):
     from git import Repo
     from loguru import logger
 
+    from trill.utils.cache import cache_root, pip_installed, populate
     from trill.utils.esm_utils import ESM_IF1_Wrangle, ESM_IF1
     from trill.utils.lightning_models import ProstT5, Custom3DiDataset
     from trill.utils.inverse_folding.util import download_ligmpnn_weights
@@ -439,23 +440,17 @@ def run(args):
 
     elif args.model == 'LigandMPNN':
         args.loguru = logger
-        if not os.path.exists((os.path.join(cache_dir, "LigandMPNN/"))):
-            logger.info("Cloning forked LigandMPNN")
-            os.makedirs(os.path.join(cache_dir, "LigandMPNN/"))
-            proteinmpnn = Repo.clone_from("https://github.com/martinez-zacharya/LigandMPNN",
-                                          (os.path.join(cache_dir, "LigandMPNN", "")))
-            mpnn_git_root = proteinmpnn.git.rev_parse("--show-toplevel")
-            subprocess.run(("pip", "install", "-e", mpnn_git_root))
-            sys.path.insert(0, (os.path.join(cache_dir, "LigandMPNN", "")))
-        else:
-            sys.path.insert(0, (os.path.join(cache_dir, "LigandMPNN", "")))
-        
+        # LigandMPNN finds its weights relative to the cache it is given, so use the shared cache only if it has both
+        mpnn_cache = cache_root(cache_dir, "LigandMPNN", "LigandMPNN_weights")
+        mpnn_dir = populate(os.path.join(mpnn_cache, "LigandMPNN"),
+                            lambda tmp: Repo.clone_from("https://github.com/martinez-zacharya/LigandMPNN", tmp),
+                            after=lambda path: subprocess.run(("pip", "install", "-e", path)), installed=pip_installed)
+        sys.path.insert(0, os.path.join(mpnn_dir, ""))
+
         logger.info("Looking for LigandMPNN model weights...")
-        if not os.path.exists((os.path.join(cache_dir, "LigandMPNN_weights"))):
-            logger.info("Downloading LigandMPNN model weights")
-            download_ligmpnn_weights(cache_dir)
-            logger.info(f"Finished downloading LigandMPNN model weights to {cache_dir}/LigandMPNN_weights")
+        populate(os.path.join(mpnn_cache, "LigandMPNN_weights"),
+                 lambda tmp: download_ligmpnn_weights(mpnn_cache, weights_dir=tmp))
         logger.info("Found LigandMPNN model weights!")
         from lig_mpnn_run import lig_mpnn
         logger.info("LigandMPNN generation starting...")
-        lig_mpnn(args, cache_dir)
\ No newline at end of file
+        lig_mpnn(args, mpnn_cache)
\ No newline at end of file
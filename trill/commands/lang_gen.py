@@ -28,12 +28,15 @@ def setup(subparsers):
     lang_gen.add_argument(
         "--ctrl_tag",
         help="ZymCTRL: Choose an Enzymatic Commision (EC) control tag for conditional protein generation based on the "
-             "tag. You can find all ECs here https://www.brenda-enzymes.org/index.php",
+             "tag. You can find all ECs here https://www.brenda-enzymes.org/index.php. Several tags can be given one "
+             "after another, --num_return_sequences proteins are generated for each. Required for ZymCTRL",
         action="store",
+        nargs="+",
     )
     lang_gen.add_argument(
         "--batch_size",
-        help="Change batch-size number to modulate how many proteins are generated at a time. Default is 1",
+        help="Change batch-size number to modulate how many proteins are generated at a time. For ProtGPT2 and "
+             "ZymCTRL, finished proteins are replaced by new ones, so the batch stays full. Default is 1",
         action="store",
         default=1,
         dest="batch_size",
@@ -75,6 +78,27 @@ def setup(subparsers):
         dest="num_return_sequences",
         type=int,
     )
+    lang_gen.add_argument(
+        "--draft_model",
+        help="ProtGPT2/ZymCTRL: Path or Hugging Face name of a smaller causal LM with the same tokenizer (e.g. a "
+             "distilled or truncated-layer model). Turns on speculative decoding: the draft model proposes tokens that "
+             "the main model verifies in a single forward pass, with the same output distribution",
+        action="store",
+        default=None,
+    )
+    lang_gen.add_argument(
+        "--num_draft_tokens",
+        help="ProtGPT2/ZymCTRL: Number of tokens the --draft_model proposes per verification step. Default is 4",
+        action="store",
+        default=4,
+    )
+    lang_gen.add_argument(
+        "--speculative_benchmark",
+        help="ProtGPT2/ZymCTRL: After speculative decoding, generate this many proteins without the --draft_model "
+             "and report the speedup. Default is 0 (off)",
+        action="store",
+        default=0,
+    )
     lang_gen.add_argument(
         "--random_fill",
         help="ESM2_Gibbs: Randomly select positions to fill each iteration for Gibbs sampling with ESM2. If not "
@@ -89,47 +113,86 @@ def setup(subparsers):
         action="store",
         default=0,
     )
+    lang_gen.add_argument(
+        "--gibbs_schedule",
+        help="ESM2_Gibbs: Order in which masked positions are filled, replacing --random_fill/--num_positions. "
+             "'dilated' fills every --dilation-th position at once, 'blocked' fills random blocks that shrink over "
+             "--gibbs_steps steps, 'entropy' fills the positions the model is most confident about first, in "
+             "--gibbs_steps steps",
+        action="store",
+        choices=["dilated", "blocked", "entropy"],
+        default=None,
+    )
+    lang_gen.add_argument(
+        "--dilation",
+        help="ESM2_Gibbs: Stride of the 'dilated' --gibbs_schedule, which fills the protein in this many steps. "
+             "Default is 3",
+        action="store",
+        default=3,
+    )
+    lang_gen.add_argument(
+        "--gibbs_steps",
+        help="ESM2_Gibbs: Number of steps of the 'blocked' and 'entropy' --gibbs_schedule. Default is 10",
+        action="store",
+        default=10,
+    )
+    lang_gen.add_argument(
+        "--report_pll",
+        help="ESM2_Gibbs: Score every generated protein by its pseudo-log-likelihood, added to the fasta headers, as "
+             "a quality proxy to compare schedules with. This masks every residue in turn, which costs about as many "
+             "model rows as one-position-at-a-time sampling, unless --mask_distance is set",
+        action="store_true",
+        default=False,
+    )
+    lang_gen.add_argument(
+        "--mask_distance",
+        help="ESM2_Gibbs: With --report_pll, mask every --mask_distance-th residue together, so each protein takes "
+             "--mask_distance masked copies instead of one per residue. Default is to mask one residue at a time",
+        action="store",
+        default=None,
+    )
 
 
 def run(args):
     import os
 
     import torch
-    from tqdm import tqdm
-    from transformers import AutoTokenizer
     from loguru import logger
     from trill.utils.lightning_models import ProtGPT2, ESM_Gibbs, ZymCTRL
+    from trill.utils.generation_utils import load_draft_model, log_speculative_speedup
     from trill.utils.update_weights import weights_update
 
+    sampling = dict(do_sample=args.do_sample, temperature=float(args.temp), top_k=int(args.top_k),
+                    repetition_penalty=float(args.repetition_penalty))
+    speculative_stats = {}
+
     if args.model == "ProtGPT2":
         model = ProtGPT2(args)
         if args.finetuned:
             model = model.load_from_checkpoint(args.finetuned, args=args, strict=False)
-        tokenizer = AutoTokenizer.from_pretrained("nferruz/ProtGPT2")
-        generated_output = []
-        total_sequences_needed = int(args.num_return_sequences)
-        batch_size = int(args.batch_size)
-        num_rounds = (total_sequences_needed + batch_size - 1) // batch_size
-
+        draft_model = load_draft_model(args.draft_model, model.model.device) if args.draft_model else None
         with open(os.path.join(args.outdir, f"{args.name}_ProtGPT2.fasta"), "w+") as fasta:
-            for round in tqdm(range(num_rounds)):
-                num_sequences_this_round = batch_size if (round * batch_size + batch_size) <= total_sequences_needed \
-                    else total_sequences_needed % batch_size
-
-                generated_outputs = model.generate(
-                    seed_seq=args.seed_seq,
-                    max_length=int(args.max_length),
-                    do_sample=args.do_sample,
-                    top_k=int(args.top_k),
-                    repetition_penalty=float(args.repetition_penalty),
-                    num_return_sequences=num_sequences_this_round,
-                    temperature=float(args.temp)
-                )
-
-                for i, generated_output in enumerate(generated_outputs):
-                    fasta.write(f">{args.name}_ProtGPT2_{round * batch_size + i} \n")
-                    fasta.write(f"{generated_output}\n")
-                    fasta.flush()
+            samples = model.stream_generate(
+                seed_seq=args.seed_seq,
+                n_samples=int(args.num_return_sequences),
+                batch_size=int(args.batch_size),
+                max_length=int(args.max_length),
+                do_sample=args.do_sample,
+                top_k=int(args.top_k),
+                repetition_penalty=float(args.repetition_penalty),
+                temperature=float(args.temp),
+                draft_model=draft_model,
+                n_draft=int(args.num_draft_tokens),
+                stats=speculative_stats
+            )
+            for i, generated_output in samples:
+                fasta.write(f">{args.name}_ProtGPT2_{i} \n")
+                fasta.write(f"{generated_output}\n")
+                fasta.flush()
+        if draft_model is not None and int(args.speculative_benchmark) > 0:
+            log_speculative_speedup(model.model, model.tokenizer(args.seed_seq, return_tensors='pt')['input_ids'][0],
+                                    int(args.speculative_benchmark), int(args.batch_size), int(args.max_length), 0,
+                                    speculative_stats, **sampling)
 
     elif args.model == "ESM2":
         if int(args.GPUs) >= 1:
@@ -137,6 +200,8 @@ def run(args):
                 "*** Gibbs sampling on GPUs is currently down. For some reason, TRILL doesn't use generate different "
                 "proteins regardless if a finetuned model is passed, but it works correctly on CPU... ***")
             raise RuntimeError
+        if int(args.dilation) < 1 or int(args.gibbs_steps) < 1:
+            raise ValueError("--dilation and --gibbs_steps must be at least 1")
         model_import_name = f"esm.pretrained.{args.esm2_arch}()"
         with open(os.path.join(args.outdir, f"{args.name}_{args.esm2_arch}_Gibbs.fasta"), "w+") as fasta:
             model = ESM_Gibbs(eval(model_import_name), args)
@@ -150,27 +215,48 @@ def run(args):
             else:
                 tuned_name = f"{args.esm2_arch}___"
 
-            for i in range(args.num_return_sequences):
-                out = model.generate(args.seed_seq, mask=True, n_samples=1, max_len=args.max_length,
-                                     in_order=args.random_fill, num_positions=int(args.num_positions),
-                                     temperature=float(args.temp))
-                out = "".join(out)
-                fasta.write(f">{args.name}_{tuned_name[0:-3]}_Gibbs_{i} \n")
-                fasta.write(f"{out}\n")
-                fasta.flush()
+            gibbs_stats = {}
+            out = model.generate(args.seed_seq, mask=True, n_samples=int(args.num_return_sequences),
+                                 batch_size=int(args.batch_size), max_len=int(args.max_length),
+                                 in_order=args.random_fill, num_positions=int(args.num_positions),
+                                 temperature=float(args.temp), schedule=args.gibbs_schedule,
+                                 dilation=int(args.dilation), num_steps=int(args.gibbs_steps), stats=gibbs_stats)
+            logger.info(f"Gibbs sampling ({args.gibbs_schedule or 'default'} schedule) took "
+                        f"{gibbs_stats.get('forward_passes', 0)} forward passes over "
+                        f"{gibbs_stats.get('forward_rows', 0)} sequences for {len(out)} proteins")
+            plls = [None] * len(out)
+            if args.report_pll:
+                # Pseudo-log-likelihood per residue, as a quality proxy to compare schedules with
+                pll_stats = {}
+                plls = [pll for pll, _ in model.log_likelihood_batch(
+                    out, mask_distance=int(args.mask_distance) if args.mask_distance else float("inf"), stats=pll_stats)]
+                logger.info(f"Pseudo-log-likelihood scoring took another {pll_stats.get('forward_passes', 0)} forward "
+                            f"passes over {pll_stats.get('forward_rows', 0)} masked copies, mean pseudo-log-likelihood "
+                            f"{sum(plls) / len(plls):.4f}")
+            for i, (seq, pll) in enumerate(zip(out, plls)):
+                pll_tag = f"_PLL={pll:.4f}" if pll is not None else ""
+                fasta.write(f">{args.name}_{tuned_name[0:-3]}_Gibbs_{i}{pll_tag} \n")
+                fasta.write(f"{seq}\n")
+            fasta.flush()
 
     elif args.model == "ZymCTRL":
+        if not args.ctrl_tag:
+            raise ValueError("ZymCTRL needs at least one EC number to generate proteins for, given with --ctrl_tag")
         model = ZymCTRL(args)
         if args.finetuned:
             model = model.load_from_checkpoint(args.finetuned, args=args, strict=False)
+        draft_model = load_draft_model(args.draft_model, model.model.device) if args.draft_model else None
         with open(os.path.join(args.outdir, f"{args.name}_ZymCTRL.fasta"), "w+") as fasta:
-            for i in tqdm(range(int(args.num_return_sequences))):
-                generated_output = model.generator(
-                    str(args.ctrl_tag), device=torch.device("cpu" if int(args.GPUs) == 0 else "cuda"),
-                    temperature=float(args.temp), max_length=int(args.max_length),
-                    repetition_penalty=float(args.repetition_penalty), do_sample=args.do_sample,
-                    top_k=int(args.top_k))
-
-                fasta.write(f">{args.name}_{args.ctrl_tag}_ZymCTRL_{i}_PPL={generated_output[0][1]} \n")
-                fasta.write(f"{generated_output[0][0]}\n")
-                fasta.flush()
+            for ctrl_tag in args.ctrl_tag:
+                samples = model.stream_generate(
+                    ctrl_tag, n_samples=int(args.num_return_sequences), batch_size=int(args.batch_size),
+                    max_length=int(args.max_length), draft_model=draft_model, n_draft=int(args.num_draft_tokens),
+                    stats=speculative_stats, **sampling)
+                for i, sequence, ppl in samples:
+                    fasta.write(f">{args.name}_{ctrl_tag}_ZymCTRL_{i}_PPL={ppl} \n")
+                    fasta.write(f"{sequence}\n")
+                    fasta.flush()
+        if draft_model is not None and int(args.speculative_benchmark) > 0:
+            log_speculative_speedup(model.model, model.tokenizer.encode(args.ctrl_tag[-1], return_tensors='pt')[0],
+                                    int(args.speculative_benchmark), int(args.batch_size), int(args.max_length), 1,
+                                    speculative_stats, pad_token_id=0, **sampling)
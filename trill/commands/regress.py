@@ -16,7 +16,7 @@ def setup(subparsers):
     classify.add_argument(
         "--key",
         help="Input a CSV, with your mappings for your embeddings where the first column is the label and the "
-             "second column is the value.",
+             "second column is the value. Linear also accepts several value columns and fits one model per column.",
         action="store"
     )
     classify.add_argument(
@@ -50,7 +50,8 @@ def setup(subparsers):
 
     classify.add_argument(
         "--preComputed_Embs",
-        help="Enter the path to your pre-computed embeddings. Make sure they match the --emb_model you select.",
+        help="Enter the path to your pre-computed embeddings. Make sure they match the --emb_model you select. "
+             "Linear also accepts an embedding store (.npy matrix with a matching _labels.txt).",
         action="store",
         default=False
     )
@@ -90,18 +91,50 @@ def setup(subparsers):
         action="store",
         default=115
     )
-    # classify.add_argument(
-    #     "--sweep",
-    #     help="XGBoost/LightGBM: Use this flag to perform cross-validated bayesian optimization over the hyperparameter space.",
-    #     action="store_true",
-    #     default=False
-    # )
-    # classify.add_argument(
-    #     "--sweep_cv",
-    #     help="XGBoost/LightGBM: Change the number of folds used for cross-validation.",
-    #     action="store",
-    #     default=3
-    # )
+    classify.add_argument(
+        "--ridge_alpha",
+        help="Linear: L2 penalty for ridge regression. Default is 0, ordinary least squares",
+        action="store",
+        default=0
+    )
+
+    classify.add_argument(
+        "--chunk_rows",
+        help="Number of embeddings read at a time. Linear training streams the embeddings from an embedding store "
+             "(.npy, which TRILL writes when it embeds for you) and only ever holds this many rows plus a dim x dim "
+             "matrix in memory. With --preTrained, up to 2 x --n_workers chunks are predicted in parallel and "
+             "appended to the output as they finish. Default is 65536",
+        action="store",
+        default=65536
+    )
+
+    classify.add_argument(
+        "--sweep",
+        help="LightGBM: Use this flag to perform a cross-validated hyperparameter sweep. Candidates are trained "
+             "--n_workers at a time and only the most promising ones keep boosting (successive halving). Every "
+             "trial is logged to {name}_LightGBM_sweep_trials.csv.",
+        action="store_true",
+        default=False
+    )
+    classify.add_argument(
+        "--sweep_cv",
+        help="LightGBM: Change the number of folds used for cross-validation.",
+        action="store",
+        default=3
+    )
+    classify.add_argument(
+        "--sweep_trials",
+        help="LightGBM: Number of hyperparameter candidates to try when sweeping. Default is 30",
+        action="store",
+        default=30
+    )
+    classify.add_argument(
+        "--sweep_resume",
+        help="LightGBM: Resume an interrupted sweep from its {name}_LightGBM_sweep_trials.csv, which "
+             "must have been written with the same --RNG_seed and --sweep_cv.",
+        action="store_true",
+        default=False
+    )
     # classify.add_argument(
     #     "--f1_avg_method",
     #     help="XGBoost/LightGBM: Change the scoring method used for calculated F1. Default is with no averaging.",
@@ -145,11 +178,19 @@ def run(args):
     from trill.commands.fold import process_sublist
     from trill.utils.MLP import MLP_C2H2, inference_epoch
     from trill.utils.classify_utils import prep_data, log_results, sweep, prep_hf_data, custom_esm2mlp_test, train_model, load_model, custom_model_test, predict_and_evaluate
-    from trill.utils.regression_utils import log_reg_results, train_reg_model, prep_reg_data, predict_and_evaluate_reg, load_reg_model, custom_model_reg_test
+    from trill.utils.regression_utils import log_reg_results, train_reg_model, train_streaming_linear, sweep_reg, prep_reg_data, predict_and_evaluate_reg, load_reg_model, custom_model_reg_test
+    from trill.utils.embedding_store import remove_embedding_store
     from trill.utils.esm_utils import parse_and_save_all_predictions, convert_outputs_to_pdb
     from .commands_common import cache_dir, get_logger
 
+    if args.sweep and not args.train_split:
+        logger.error("You need to provide a train-test fraction with --train_split!")
+        raise Exception("You need to provide a train-test fraction with --train_split!")
     outfile = os.path.join(args.outdir, f"{args.name}_{args.regressor}.out")
+    # Linear regression is fit out of core and inference runs in chunks, both streaming the embeddings from a
+    # memory-mapped embedding store
+    streaming = args.regressor == 'Linear' and args.train_split is not None
+    as_store = streaming or args.train_split is None
     if not args.preComputed_Embs:
         embed_command = (
             "trill",
@@ -162,27 +203,40 @@ def run(args):
             "--avg",
             "--batch_size", args.batch_size
         )
+        if as_store:
+            embed_command += ("--emb_store",)
         subprocess.run(embed_command, check=True)
-        df = pd.read_csv(os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.csv"))
+        emb_path = os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.{'npy' if as_store else 'csv'}")
     else:
-        df = pd.read_csv(args.preComputed_Embs)
+        emb_path = args.preComputed_Embs
     if args.train_split is not None:
-        train_df, test_df = prep_reg_data(df, args)
         command_line_args = sys.argv
         command_line_str = " ".join(command_line_args)
-        clf = train_reg_model(train_df, args)
+        best_params = None
+        if streaming:
+            if args.sweep:
+                logger.warning("Linear regression has no hyperparameters to sweep, ignoring --sweep")
+            clf, r2, rmse = train_streaming_linear(emb_path, args)
+        else:
+            train_df, test_df = prep_reg_data(pd.read_csv(emb_path), args)
+            if args.sweep:
+                sweeped_clf = sweep_reg(train_df, args)
+                clf, best_params = sweeped_clf.best_estimator_, sweeped_clf.best_params_
+            else:
+                clf = train_reg_model(train_df, args)
+            r2, rmse = predict_and_evaluate_reg(clf, test_df, args)
         if args.regressor == 'LightGBM':
             # clf.booster_.save_model(os.path.join(args.outdir, f"{args.name}_LightGBM-Regression.json"))
             sio.dump(clf, os.path.join(args.outdir, f"{args.name}_LightGBM-Regression.skops"))
         elif args.regressor == 'Linear':
             sio.dump(clf, os.path.join(args.outdir, f"{args.name}_Linear-Regression.skops"))
-        r2, rmse = predict_and_evaluate_reg(clf, test_df, args)
-        log_reg_results(outfile, command_line_str, args, r2=r2, rmse=rmse)
+        log_reg_results(outfile, command_line_str, args, r2=r2, rmse=rmse, best_params=best_params)
     else:
         model = load_reg_model(args)
-        custom_model_reg_test(model, df, args)
-        if not args.save_emb and not args.preComputed_Embs:
-            os.remove(os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.csv"))
+        custom_model_reg_test(model, emb_path, args)
 
     if not args.save_emb and not args.preComputed_Embs:
-        os.remove(os.path.join(args.outdir, f"{args.name}_{args.emb_model}_AVG.csv"))
\ No newline at end of file
+        if as_store:
+            remove_embedding_store(emb_path)
+        else:
+            os.remove(emb_path)
@@ -3,9 +3,63 @@ def setup(subparsers):
 
     score.add_argument(
         "query",
-        help="Path to protein PDB file to score",
+        help="Path to protein PDB file to score, or to a FASTA file of proteins to score with --plm",
         action="store",
     )
+    score.add_argument(
+        "--plm",
+        help="PLL: Score the masked pseudo-log-likelihood of every protein in query (a FASTA file) with this ESM2 "
+             "model instead of using LigandMPNN",
+        action="store",
+        choices=("esm2_t6_8M", "esm2_t12_35M", "esm2_t30_150M", "esm2_t33_650M", "esm2_t36_3B", "esm2_t48_15B"),
+        default=None,
+    )
+    score.add_argument(
+        "--mask_distance",
+        help="PLL: Mask every mask_distance-th residue of a protein at once, so it is scored in mask_distance forward "
+             "passes instead of one per residue. Default is to mask one residue at a time",
+        action="store",
+        default=None,
+    )
+    score.add_argument(
+        "--toks_per_batch",
+        help="PLL/DMS: Masked copies of the proteins are packed into batches of at most this many tokens. Default is "
+             "16384",
+        action="store",
+        default=16384,
+    )
+    score.add_argument(
+        "--plm_benchmark",
+        help="PLL: Also score the first this many proteins one at a time with the per-position loop and report the "
+             "speedup. Default is 0 (off)",
+        action="store",
+        default=0,
+    )
+    score.add_argument(
+        "--dms",
+        help="DMS: Score mutants of every protein in query (a FASTA file) with these ESM models instead of using "
+             "LigandMPNN. Several models are averaged as an ensemble, esm1v is the ensemble of the five ESM-1v models",
+        action="store",
+        nargs="+",
+        choices=("esm2_t6_8M", "esm2_t12_35M", "esm2_t30_150M", "esm2_t33_650M", "esm2_t36_3B", "esm2_t48_15B",
+                 "esm1v_1", "esm1v_2", "esm1v_3", "esm1v_4", "esm1v_5", "esm1v"),
+        default=None,
+    )
+    score.add_argument(
+        "--dms_scoring",
+        help="DMS: masked_marginal masks every residue in turn (L masked copies, batched together), wt_marginal "
+             "scores all mutants from one unmasked forward pass. Default is masked_marginal",
+        action="store",
+        choices=("masked_marginal", "wt_marginal"),
+        default="masked_marginal",
+    )
+    score.add_argument(
+        "--mutants",
+        help="DMS: Path to a file with one mutant per line, like A12G or A12G:K15R for multi-mutants (1-indexed). "
+             "query must then hold a single wild-type protein. Default is every single mutant of every protein",
+        action="store",
+        default=None,
+    )
     score.add_argument("--lig_mpnn_model", type=str, default="",
                               help="LigandMPNN: ProteinMPNN, Soluble, Global_Membrane, Local_Membrane, Side-Chain_Packing")
     score.add_argument("--lig_mpnn_noise", type=str, default="010",
@@ -83,30 +137,140 @@ import os
 import subprocess
 import sys
 from git import Repo
+from trill.utils.cache import cache_root, pip_installed, populate
 from trill.utils.inverse_folding.util import download_ligmpnn_weights
  
 
 def run(args):
+    if args.dms:
+        import esm
+        import numpy as np
+        import pandas as pd
+        from trill.utils.dms_utils import marginal_matrix, parse_mutant, score_mutants, single_mutants, DMS_AMINO_ACIDS
+
+        models = []
+        for name in args.dms:
+            models += [f"esm1v_{i}" for i in range(1, 6)] if name == "esm1v" else [name]
+        models = list(dict.fromkeys(models))
+        data = esm.data.FastaBatchedDataset.from_file(args.query)
+        proteins = []
+        for label, seq in zip(data.sequence_labels, data.sequence_strs):
+            if set(seq.upper()).issubset(DMS_AMINO_ACIDS):
+                proteins.append((label, seq.upper()))
+            else:
+                logger.warning(f"Not scoring {label}, it contains non-standard residues")
+        mutants = None
+        if args.mutants:
+            with open(args.mutants) as f:
+                mutants = [line.strip() for line in f if line.strip()]
+            if len(proteins) != 1:
+                raise ValueError(f"--mutants is scored against one wild-type protein, but {args.query} has "
+                                 f"{len(proteins)} proteins that can be scored")
+            # Checked before any model is loaded, so a bad mutant fails fast
+            for mutant in mutants:
+                parse_mutant(mutant, proteins[0][1])
+
+        # Models are loaded one at a time, only their L x 20 matrices are kept
+        matrices = [[] for _ in proteins]
+        for name in models:
+            if name.startswith("esm1v"):
+                model, alphabet = eval(f"esm.pretrained.esm1v_t33_650M_UR90S_{name[-1]}()")
+            else:
+                model, alphabet = eval(f"esm.pretrained.{name}_UR50D()")
+            model.eval()
+            if int(args.GPUs) > 0:
+                model = model.cuda()
+            logger.info(f"Computing {args.dms_scoring} matrices of {len(proteins)} proteins with {name}...")
+            for i, (_, seq) in enumerate(proteins):
+                matrices[i].append(marginal_matrix(model, alphabet, seq, args.dms_scoring,
+                                                       int(args.toks_per_batch)))
+            del model
+
+        tables = []
+        for (label, seq), protein_matrices in zip(proteins, matrices):
+            protein_mutants = mutants if mutants is not None else single_mutants(seq)
+            scores = score_mutants(np.stack(protein_matrices), seq, protein_mutants)
+            table = pd.DataFrame(scores, columns=models)
+            table.insert(0, "Mutant", protein_mutants)
+            table.insert(0, "Label", label)
+            table["Score"] = scores.mean(axis=1)
+            tables.append(table)
+        out_path = os.path.join(args.outdir, f"{args.name}_{'_'.join(args.dms)}_{args.dms_scoring}_DMS.csv")
+        pd.concat(tables).to_csv(out_path, index=False)
+        logger.info(f"Wrote scores of {sum(len(table) for table in tables)} mutants to {out_path}")
+        return
+
+    if args.plm:
+        import time
+
+        import esm
+        import pandas as pd
+        from trill.utils.lightning_models import ESM_Gibbs, ESM_ALLOWED_AMINO_ACIDS
+
+        model = ESM_Gibbs(eval(f"esm.pretrained.{args.plm}_UR50D()"), args)
+        model.model.eval()
+        if int(args.GPUs) > 0:
+            model.model = model.model.cuda()
+        data = esm.data.FastaBatchedDataset.from_file(args.query)
+        labels, seqs = [], []
+        for label, seq in zip(data.sequence_labels, data.sequence_strs):
+            if set(seq.upper()).issubset(ESM_ALLOWED_AMINO_ACIDS):
+                labels.append(label)
+                seqs.append(seq.upper())
+            else:
+                logger.warning(f"Not scoring {label}, it contains non-standard residues")
+        mask_distance = float("inf") if args.mask_distance is None else int(args.mask_distance)
+        toks_per_batch = int(args.toks_per_batch)
+
+        summary_path = os.path.join(args.outdir, f"{args.name}_{args.plm}_PLL.csv")
+        residue_path = os.path.join(args.outdir, f"{args.name}_{args.plm}_per_residue_PLL.csv")
+        logger.info(f"Scoring the pseudo-log-likelihood of {len(seqs)} proteins with {args.plm}...")
+        start = time.time()
+        # Proteins are scored and written out a chunk at a time, so the padded tokens stay small
+        for chunk_start in range(0, len(seqs), 1024):
+            chunk_labels, chunk_seqs = labels[chunk_start:chunk_start + 1024], seqs[chunk_start:chunk_start + 1024]
+            scores = list(model.log_likelihood_batch(chunk_seqs, mask_distance=mask_distance,
+                                                     toks_per_batch=toks_per_batch))
+            summary = pd.DataFrame({"Label": chunk_labels, "Length": [len(seq) for seq in chunk_seqs],
+                                    "PLL": [sum(per_residue) for _, per_residue in scores],
+                                    "Mean_PLL": [mean for mean, _ in scores]})
+            residues = pd.DataFrame({
+                "Label": [label for label, seq in zip(chunk_labels, chunk_seqs) for _ in seq],
+                "Position": [i + 1 for seq in chunk_seqs for i in range(len(seq))],
+                "Residue": [aa for seq in chunk_seqs for aa in seq],
+                "Log_Probability": [logprob for _, per_residue in scores for logprob in per_residue]})
+            summary.to_csv(summary_path, mode="w" if chunk_start == 0 else "a", header=chunk_start == 0, index=False)
+            residues.to_csv(residue_path, mode="w" if chunk_start == 0 else "a", header=chunk_start == 0, index=False)
+        elapsed = time.time() - start
+        logger.info(f"Scored {len(seqs)} proteins in {elapsed:.2f}s. Wrote {summary_path} and {residue_path}")
+
+        n_benchmark = min(int(args.plm_benchmark), len(seqs))
+        if n_benchmark > 0:
+            start = time.time()
+            list(model.log_likelihood_batch(seqs[:n_benchmark], mask_distance=mask_distance,
+                                            toks_per_batch=toks_per_batch))
+            batched = time.time() - start
+            start = time.time()
+            for seq in seqs[:n_benchmark]:
+                list(model.log_likelihood_batch([seq], mask_distance=mask_distance, batched=False))
+            looped = time.time() - start
+            logger.info(f"Benchmark on {n_benchmark} proteins: {batched:.2f}s batched, {looped:.2f}s one protein at "
+                        f"a time ({looped / batched:.1f}x speedup)")
+        return
 
     args.loguru = logger
-    if not os.path.exists((os.path.join(cache_dir, "LigandMPNN/"))):
-        logger.info("Cloning forked LigandMPNN")
-        os.makedirs(os.path.join(cache_dir, "LigandMPNN/"))
-        proteinmpnn = Repo.clone_from("https://github.com/martinez-zacharya/LigandMPNN",
-                                        (os.path.join(cache_dir, "LigandMPNN", "")))
-        mpnn_git_root = proteinmpnn.git.rev_parse("--show-toplevel")
-        subprocess.run(("pip", "install", "-e", mpnn_git_root))
-        sys.path.insert(0, (os.path.join(cache_dir, "LigandMPNN", "")))
-    else:
-        sys.path.insert(0, (os.path.join(cache_dir, "LigandMPNN", "")))
+    # LigandMPNN finds its weights relative to the cache it is given, so use the shared cache only if it has both
+    mpnn_cache = cache_root(cache_dir, "LigandMPNN", "LigandMPNN_weights")
+    mpnn_dir = populate(os.path.join(mpnn_cache, "LigandMPNN"),
+                        lambda tmp: Repo.clone_from("https://github.com/martinez-zacharya/LigandMPNN", tmp),
+                        after=lambda path: subprocess.run(("pip", "install", "-e", path)), installed=pip_installed)
+    sys.path.insert(0, os.path.join(mpnn_dir, ""))
 
     logger.info("Looking for LigandMPNN model weights...")
-    if not os.path.exists((os.path.join(cache_dir, "LigandMPNN_weights"))):
-        logger.info("Downloading LigandMPNN model weights")
-        download_ligmpnn_weights(cache_dir)
-        logger.info(f"Finished downloading LigandMPNN model weights to {cache_dir}/LigandMPNN_weights")
+    populate(os.path.join(mpnn_cache, "LigandMPNN_weights"),
+             lambda tmp: download_ligmpnn_weights(mpnn_cache, weights_dir=tmp))
     logger.info("Found LigandMPNN model weights!")
     from score import ligmpnn_score
     logger.info("LigandMPNN scoring starting...")
     args.verbose = 1
-    ligmpnn_score(args, cache_dir)
\ No newline at end of file
+    ligmpnn_score(args, mpnn_cache)
\ No newline at end of file
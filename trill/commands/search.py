@@ -0,0 +1,157 @@
+def setup(subparsers):
+    search = subparsers.add_parser("search", help="Find the nearest neighbours of query embeddings in an embedding "
+                                                  "database with an on-disk approximate nearest-neighbour index")
+
+    search.add_argument(
+        "query",
+        help="Query embeddings, either a TRILL embedding CSV (e.g. from trill embed --avg) or an embedding store "
+             "(.npy with a matching _labels.txt from trill embed --emb_store)",
+        action="store"
+    )
+
+    search.add_argument(
+        "--db",
+        help="Embeddings to search against: an embedding store (.npy), a TRILL embedding CSV or a UniProt "
+             "per-protein .h5 (e.g. from trill utils fetch_embeddings). Needed to build the index.",
+        action="store",
+        default=False
+    )
+
+    search.add_argument(
+        "--index",
+        help="Directory of the index. It is built there from --db if it does not exist yet and reused otherwise. "
+             "Default is {outdir}/{name}_ann_index",
+        action="store",
+        default=False
+    )
+
+    search.add_argument(
+        "--metric",
+        help="Similarity used to build the index and rank hits. Default is cosine",
+        action="store",
+        choices=("cosine", "L2"),
+        default="cosine"
+    )
+
+    search.add_argument(
+        "--k",
+        help="Number of nearest neighbours to return per query. Default is 10",
+        action="store",
+        default=10
+    )
+
+    search.add_argument(
+        "--nlist",
+        help="Number of IVF cells (k-means centroids) to split the database into. Default is 4 * sqrt(N), capped "
+             "so that every cell has at least 32 of the (at most 1M, 1 GB) k-means training vectors",
+        action="store",
+        default=False
+    )
+
+    search.add_argument(
+        "--nprobe",
+        help="Number of IVF cells visited per query. Higher is slower but more accurate. Default is 16",
+        action="store",
+        default=16
+    )
+
+    search.add_argument(
+        "--half",
+        help="Store the indexed vectors in float16, halving the index size on disk",
+        action="store_true",
+        default=False
+    )
+
+    search.add_argument(
+        "--query_batch",
+        help="Number of queries searched together. Default is 1024",
+        action="store",
+        default=1024
+    )
+
+    search.add_argument(
+        "--recall_sample",
+        help="Also run an exact search for this many queries against --db and report the recall@k of the index. "
+             "Default is 0",
+        action="store",
+        default=0
+    )
+
+
+def run(args):
+    import os
+    import time
+
+    import numpy as np
+    import pandas as pd
+    from loguru import logger
+
+    from trill.utils.ann_index import EmbeddingSource, IVFIndex, build_ivf_index, exact_search
+    from trill.utils.embedding_store import load_embeddings
+
+    index_dir = args.index if args.index else os.path.join(args.outdir, f"{args.name}_ann_index")
+    metric = args.metric.lower()
+    k = int(args.k)
+
+    if IVFIndex.exists(index_dir):
+        index = IVFIndex(index_dir)
+        logger.info(f"Using IVF index at {index_dir} ({index.meta['n']} vectors, {index.meta['metric']})")
+        if args.db and not index.matches_source(args.db):
+            logger.error(f"The index at {index_dir} was built from {index.meta.get('source')}, not from the current "
+                         f"{args.db}! Pass another --index to build a new one, or remove the old index.")
+            raise RuntimeError
+        if index.metric != metric:
+            logger.warning(f"Index was built for {index.metric}, ignoring --metric {args.metric}")
+            metric = index.metric
+    else:
+        if not args.db:
+            logger.error(f"No index found at {index_dir}, --db is needed to build one!")
+            raise RuntimeError
+        source = EmbeddingSource(args.db)
+        index = build_ivf_index(source, index_dir, metric=metric, nlist=int(args.nlist) if args.nlist else None,
+                                half=args.half)
+        source.close()
+
+    queries, query_labels = load_embeddings(args.query)
+    if queries.shape[1] != index.meta["dim"]:
+        logger.error(f"Query embeddings have {queries.shape[1]} dimensions but the index has {index.meta['dim']}!")
+        raise RuntimeError
+
+    all_scores, all_rows = [], []
+    batch = int(args.query_batch)
+    start = time.time()
+    for i in range(0, len(queries), batch):
+        scores, rows = index.search(queries[i:i + batch], k=k, nprobe=int(args.nprobe))
+        all_scores.append(scores)
+        all_rows.append(rows)
+    elapsed = time.time() - start
+    scores, rows = np.concatenate(all_scores), np.concatenate(all_rows)
+    logger.info(f"Searched {len(queries)} queries in {elapsed:.2f}s ({len(queries) / max(elapsed, 1e-9):.0f} "
+                f"queries/s, nprobe={args.nprobe})")
+
+    labels = np.asarray(index.labels, dtype=object)
+    found = rows >= 0
+    results = pd.DataFrame({
+        "Query": np.repeat(np.asarray(query_labels, dtype=object), k)[found.ravel()],
+        "Rank": np.tile(np.arange(1, k + 1), len(queries))[found.ravel()],
+        "Hit": labels[rows[found]],
+        "Cosine_Similarity" if metric == "cosine" else "L2_Distance":
+            scores[found] if metric == "cosine" else np.sqrt(np.maximum(scores[found], 0)),
+    })
+    out_path = os.path.join(args.outdir, f"{args.name}_search_results.csv")
+    results.to_csv(out_path, index=False)
+    logger.info(f"Search results saved to {out_path}")
+
+    n_recall = min(int(args.recall_sample), len(queries))
+    if n_recall > 0:
+        if not args.db:
+            logger.warning("--recall_sample needs --db for the exact search, skipping")
+            return
+        source = EmbeddingSource(args.db)
+        start = time.time()
+        _, exact_rows = exact_search(source, queries[:n_recall], k=k, metric=metric)
+        exact_elapsed = time.time() - start
+        source.close()
+        recall = np.mean([len(set(a[a >= 0]) & set(b[b >= 0])) / k for a, b in zip(rows[:n_recall], exact_rows)])
+        logger.info(f"Recall@{k} over {n_recall} queries: {recall:.4f} "
+                    f"(exact search: {n_recall / max(exact_elapsed, 1e-9):.1f} queries/s)")
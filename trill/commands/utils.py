@@ -40,17 +40,38 @@ def setup(subparsers):
         choices=("per_AA", "avg"),
         action="store"
     )
+    utils.add_argument(
+        "--emb_format",
+        help="fetch_embeddings: Format to convert the downloaded avg embeddings to. 'store' writes a memory-mappable "
+             "embedding store (.npy plus _labels.txt), which is much smaller and faster to read than a CSV. per_AA "
+             "embeddings are always written as a ragged store (.npy, _offsets.npy and _labels.txt). Default is csv",
+        choices=("csv", "store"),
+        default="csv",
+        action="store"
+    )
+    utils.add_argument(
+        "--half",
+        help="fetch_embeddings: Down-convert the embeddings to float16 when writing an embedding store.",
+        action="store_true",
+        default=False
+    )
 
 
 def run(args):
     import os
 
     from trill.utils.classify_utils import generate_class_key_csv
-    from trill.utils.fetch_embs import convert_embeddings_to_csv, download_embeddings
+    from trill.utils.fetch_embs import convert_embeddings_to_csv, convert_embeddings_to_store, \
+        convert_per_residue_to_store, download_embeddings
 
     if args.tool == "prepare_class_key":
         generate_class_key_csv(args)
     elif args.tool == "fetch_embeddings":
         h5_path = download_embeddings(args)
         h5_name = os.path.splitext(os.path.basename(h5_path))[0]
-        convert_embeddings_to_csv(h5_path, os.path.join(args.outdir, f"{h5_name}.csv"))
+        if args.rep == "per_AA":
+            convert_per_residue_to_store(h5_path, os.path.join(args.outdir, f"{h5_name}.npy"), half=args.half)
+        elif args.emb_format == "store":
+            convert_embeddings_to_store(h5_path, os.path.join(args.outdir, f"{h5_name}.npy"), half=args.half)
+        else:
+            convert_embeddings_to_csv(h5_path, os.path.join(args.outdir, f"{h5_name}.csv"))
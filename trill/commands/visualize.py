@@ -3,7 +3,8 @@ def setup(subparsers):
 
     visualize.add_argument(
         "embeddings",
-        help="Embeddings to be visualized",
+        help="Embeddings to be visualized, either a TRILL embedding CSV or an embedding store (.npy) from trill embed "
+             "--emb_store",
         action="store"
     )
 
@@ -21,6 +22,51 @@ def setup(subparsers):
         action="store",
         default=False
     )
+    visualize.add_argument(
+        "--pca_solver",
+        help="PCA solver. 'incremental' fits PCA on chunks of --chunk_rows embeddings, so embedding stores never have "
+             "to fit in memory, and 'randomized' uses a randomized SVD. 'auto' picks 'incremental' for embedding "
+             "stores. Default is auto",
+        action="store",
+        choices=("auto", "full", "randomized", "incremental"),
+        default="auto"
+    )
+    visualize.add_argument(
+        "--pca_dims",
+        help="UMAP/tSNE: Reduce embeddings with PCA to this many dimensions first, e.g. 50. Default is 0 (off)",
+        action="store",
+        default=0
+    )
+    visualize.add_argument(
+        "--landmarks",
+        help="UMAP/tSNE: Fit on a sample of this many embeddings, stratified by the groups in --key if given, and "
+             "project the rest onto the map (UMAP transform, kNN interpolation for tSNE). The cached tSNE reducer "
+             "keeps the embeddings it was fit on, so without landmarks it holds a copy of all of them. Default is 0 "
+             "(fit on all)",
+        action="store",
+        default=0
+    )
+    visualize.add_argument(
+        "--project_onto",
+        help="Reducer saved by an earlier visualize run (the .joblib path it logs). Only projects the input embeddings "
+             "onto that map, instead of fitting a new one, and writes the whole map to this run's --outdir. The saved "
+             "reducer is not modified, projected embeddings are kept in a <reducer>_projected.csv table next to it",
+        action="store",
+        default=None
+    )
+    visualize.add_argument(
+        "--max_points",
+        help="Maps with more points than this are drawn as a density image, with individual points (stored in a "
+             "tile folder next to the HTML) only loaded once you zoom in to at most this many. Default is 200000",
+        action="store",
+        default=200000
+    )
+    visualize.add_argument(
+        "--chunk_rows",
+        help="Number of embeddings processed at once by incremental PCA and projection. Default is 65536",
+        action="store",
+        default=65536
+    )
 
 
 def run(args):
@@ -28,10 +74,17 @@ def run(args):
 
     import bokeh
 
-    from trill.utils.visualize import reduce_dims, viz
+    from trill.utils.visualize import project_onto, reduce_dims, viz
 
-    reduced_df, incsv = reduce_dims(args.name, args.embeddings, args.method)
-    layout = viz(reduced_df, args)
-    bokeh.io.output_file(filename=os.path.join(args.outdir, f"{args.name}_{args.method}_{incsv}.html"), title=args.name)
-    bokeh.io.save(layout, filename=os.path.join(args.outdir, f"{args.name}_{args.method}_{incsv}.html"),
+    if args.project_onto:
+        reduced_df, incsv, method = project_onto(args.project_onto, args.embeddings, args.outdir, args.name,
+                                                  chunk_rows=int(args.chunk_rows))
+    else:
+        method = args.method
+        reduced_df, incsv = reduce_dims(args.name, args.embeddings, args.method, pca_solver=args.pca_solver,
+                                        pca_dims=int(args.pca_dims), landmarks=int(args.landmarks), key=args.key,
+                                        chunk_rows=int(args.chunk_rows))
+    layout = viz(reduced_df, args, tile_dir=os.path.join(args.outdir, f"{args.name}_{method}_{incsv}_tiles"))
+    bokeh.io.output_file(filename=os.path.join(args.outdir, f"{args.name}_{method}_{incsv}.html"), title=args.name)
+    bokeh.io.save(layout, filename=os.path.join(args.outdir, f"{args.name}_{method}_{incsv}.html"),
                   title=args.name)
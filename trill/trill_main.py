@@ -11,6 +11,7 @@ from pyfiglet import Figlet
 from transformers import set_seed
 from loguru import logger
 
+from trill.utils.cache import SHARED_CACHE_ENV
 from trill.utils.logging import setup_logger
 
 os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
@@ -30,6 +31,7 @@ for command in {
     "simulate",
     "dock",
     "score",
+    "search",
     "utils",
 }:
     commands[command] = importlib.import_module(f"trill.commands.{command}")
@@ -93,6 +95,15 @@ def return_parser():
         default=1
     )
 
+    parser.add_argument(
+        "--shared_cache",
+        help="Read-only TRILL cache shared between users or nodes (e.g. on a parallel filesystem). Models and "
+             "databases found there are used instead of being fetched into ~/.trill_cache. Can also be set with "
+             "the TRILL_SHARED_CACHE environment variable",
+        action="store",
+        default=False
+    )
+
     ##############################################################################################################
 
     subparsers = parser.add_subparsers(dest='command')
@@ -117,6 +128,8 @@ def main(args):
 
     if not os.path.exists(args.outdir):
         os.mkdir(args.outdir)
+    if args.shared_cache:
+        os.environ[SHARED_CACHE_ENV] = os.path.abspath(args.shared_cache)
 
     torch.backends.cuda.matmul.allow_tf32 = True
     if int(args.GPUs) == 0:
@@ -1,5 +1,7 @@
 # Taken straight from TemStaPro!
 
+import numpy as np
+import torch
 from torch import nn
 
 class MLP_C2H2(nn.Module):
@@ -33,6 +35,43 @@ class MLP_C2H2(nn.Module):
         return self.layers(x)
 
 
+class MLP_C2H2_Ensemble(nn.Module):
+    """
+    Stacks the weights of several MLP_C2H2 models so that the whole ensemble scores a batch of
+    embeddings with one batched matmul per layer instead of one forward pass per model and sequence.
+    """
+    def __init__(self, models):
+        super().__init__()
+        linears = [[layer for layer in model.layers if isinstance(layer, nn.Linear)] for model in models]
+        self.n_models = len(models)
+        self.n_layers = len(linears[0])
+        for depth in range(self.n_layers):
+            # n_models x in x out and n_models x 1 x out, so that baddbmm broadcasts the bias over the batch
+            self.register_buffer(f"weight_{depth}", torch.stack([layers[depth].weight.t() for layers in linears]).contiguous())
+            self.register_buffer(f"bias_{depth}", torch.stack([layers[depth].bias for layers in linears]).unsqueeze(1))
+
+    def forward(self, x):
+        # IN: B x F; OUT: n_models x B x 2
+        x = x.unsqueeze(0).expand(self.n_models, -1, -1)
+        for depth in range(self.n_layers):
+            x = torch.baddbmm(getattr(self, f"bias_{depth}"), x, getattr(self, f"weight_{depth}"))
+            x = torch.relu(x) if depth < self.n_layers - 1 else torch.sigmoid(x)
+        return x
+
+
+def ensemble_inference(ensemble, embeddings, device="cpu", batch_size=4096):
+    """
+    Scores an (N x F) embedding matrix, which may be memory-mapped, with an MLP_C2H2_Ensemble.
+    Returns an (n_models x N) array of the positive-class outputs.
+    """
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, len(embeddings), batch_size):
+            chunk = torch.from_numpy(np.ascontiguousarray(embeddings[start:start + batch_size], dtype=np.float32))
+            outputs.append(ensemble(chunk.to(device))[..., 1].cpu().numpy())
+    return np.concatenate(outputs, axis=1)
+
+
 def inference_epoch(model, test_loader, device="cpu"):
     """
     From TemStaPro repo 
@@ -0,0 +1,300 @@
+import json
+import os
+import time
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+from trill.utils.embedding_store import is_embedding_store, open_embedding_store, load_embeddings, write_labels, \
+    read_labels
+
+# On-disk inverted-file (IVF) index for approximate nearest-neighbour search over embeddings, CPU only.
+# A k-means coarse quantizer splits the vectors into nlist cells. vectors.npy holds every vector grouped by cell
+# (optionally float16) and is memory-mapped at query time, so only the nprobe cells closest to a query are read.
+#
+#   meta.json       dim, metric, nlist, n, dtype and the path, size and mtime of the source it was built from
+#   centroids.npy   nlist x dim coarse centroids
+#   offsets.npy     nlist + 1 start offsets of each cell in vectors.npy
+#   vectors.npy     n x dim vectors sorted by cell (unit length for cosine)
+#   sq_norms.npy    squared norms of the stored vectors, for L2
+#   ids.npy         row of each stored vector in the source, which indexes labels.txt
+#
+# Memory stays bounded at any database size: vectors x centroids distances are computed DISTANCE_BUDGET bytes at a
+# time, and k-means trains on at most TRAIN_BUDGET bytes (MAX_TRAIN_VECTORS vectors) of the database.
+
+DISTANCE_BUDGET = 256 * 1024 ** 2
+TRAIN_BUDGET = 1024 ** 3
+MAX_TRAIN_VECTORS = 1000000
+MIN_TRAIN_PER_CELL = 32
+
+
+class EmbeddingSource():
+    '''Chunked read access to an embedding store, TRILL embedding CSV or UniProt per-protein .h5'''
+
+    def __init__(self, path):
+        self.path = path
+        self.h5 = None
+        if path.endswith(".h5"):
+            import h5py
+            self.h5 = h5py.File(path, "r")
+            self.labels = list(self.h5.keys())
+            self.dim = int(np.asarray(self.h5[self.labels[0]]).shape[-1])
+        else:
+            if is_embedding_store(path):
+                self.matrix, self.labels = open_embedding_store(path)
+            else:
+                self.matrix, self.labels = load_embeddings(path)
+            self.dim = int(self.matrix.shape[1])
+        self.n = len(self.labels)
+
+    def rows(self, idx):
+        idx = np.asarray(idx)
+        if self.h5 is not None:
+            return np.stack([np.asarray(self.h5[self.labels[i]], dtype=np.float32) for i in idx])
+        return np.asarray(self.matrix[idx], dtype=np.float32)
+
+    def chunks(self, chunk_size=65536):
+        for start in range(0, self.n, chunk_size):
+            stop = min(start + chunk_size, self.n)
+            if self.h5 is not None:
+                yield start, self.rows(range(start, stop))
+            else:
+                yield start, np.asarray(self.matrix[start:stop], dtype=np.float32)
+
+    def close(self):
+        if self.h5 is not None:
+            self.h5.close()
+
+
+def _normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def distance_batch_rows(nlist):
+    '''Number of vectors whose float32 distances to nlist centroids fit in DISTANCE_BUDGET'''
+    return max(1, DISTANCE_BUDGET // (4 * nlist))
+
+
+def max_train_size(dim):
+    return max(1, min(MAX_TRAIN_VECTORS, TRAIN_BUDGET // (4 * dim)))
+
+
+def _nearest_centroid(x, centroids, centroid_sq_norms):
+    # argmin ||x - c||^2 = argmin ||c||^2 - 2 x.c, a bounded number of rows at a time
+    batch_rows = distance_batch_rows(len(centroids))
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch_rows):
+        batch = x[start:start + batch_rows]
+        assign[start:start + len(batch)] = np.argmin(centroid_sq_norms[None, :] - 2 * batch @ centroids.T, axis=1)
+    return assign
+
+
+def train_kmeans(x, nlist, n_iter=20, seed=0, batch_size=None):
+    '''Lloyd's k-means with a random-sample initialization, batched so the n x nlist distances stay bounded'''
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size or distance_batch_rows(nlist)
+    centroids = x[rng.choice(len(x), nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        sq_norms = (centroids ** 2).sum(1)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        counts = np.zeros(nlist, dtype=np.int64)
+        for start in range(0, len(x), batch_size):
+            batch = x[start:start + batch_size]
+            assign = _nearest_centroid(batch, centroids, sq_norms)
+            order = np.argsort(assign, kind="stable")
+            cells, starts = np.unique(assign[order], return_index=True)
+            sums[cells] += np.add.reduceat(batch[order], starts, axis=0)
+            counts += np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        centroids[~empty] = (sums[~empty] / counts[~empty, None]).astype(np.float32)
+        # Re-seed empty cells from random training points
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def build_ivf_index(source, index_dir, metric="cosine", nlist=None, half=False, train_size=None, chunk_size=65536,
+                    seed=0):
+    '''Builds an IVF index over an EmbeddingSource into index_dir'''
+    start_time = time.time()
+    os.makedirs(index_dir, exist_ok=True)
+    n, dim = source.n, source.dim
+    train_cap = max_train_size(dim)
+    if nlist is None:
+        # Every cell keeps at least MIN_TRAIN_PER_CELL training vectors within the training budget
+        nlist = int(np.clip(4 * np.sqrt(n), 1, max(1, train_cap // MIN_TRAIN_PER_CELL)))
+    nlist = min(nlist, n)
+    train_size = min(n, train_size or max(64 * nlist, 10000), train_cap)
+    rng = np.random.default_rng(seed)
+
+    logger.info(f"Training {nlist} IVF centroids on {train_size} of {n} vectors")
+    train = source.rows(np.sort(rng.choice(n, train_size, replace=False)))
+    if metric == "cosine":
+        train = _normalize(train)
+    centroids = train_kmeans(train, nlist, seed=seed)
+    del train
+    centroid_sq_norms = (centroids ** 2).sum(1)
+
+    # First pass: assign every vector to its cell
+    assign = np.empty(n, dtype=np.int32)
+    for start, chunk in tqdm(source.chunks(chunk_size), total=-(-n // chunk_size), desc="Assigning"):
+        if metric == "cosine":
+            chunk = _normalize(chunk)
+        assign[start:start + len(chunk)] = _nearest_centroid(chunk, centroids, centroid_sq_norms)
+    counts = np.bincount(assign, minlength=nlist)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    # Second pass: scatter the vectors into their cells
+    dtype = np.float16 if half else np.float32
+    vectors = np.lib.format.open_memmap(os.path.join(index_dir, "vectors.npy"), mode="w+", dtype=dtype,
+                                        shape=(n, dim))
+    ids = np.empty(n, dtype=np.int64)
+    sq_norms = np.empty(n, dtype=np.float32)
+    cursor = offsets[:-1].copy()
+    for start, chunk in tqdm(source.chunks(chunk_size), total=-(-n // chunk_size), desc="Writing index"):
+        if metric == "cosine":
+            chunk = _normalize(chunk)
+        chunk_assign = assign[start:start + len(chunk)]
+        order = np.argsort(chunk_assign, kind="stable")
+        sorted_assign = chunk_assign[order]
+        chunk_counts = np.bincount(sorted_assign, minlength=nlist)
+        group_start = np.cumsum(chunk_counts) - chunk_counts
+        dest = cursor[sorted_assign] + np.arange(len(order)) - group_start[sorted_assign]
+        vectors[dest] = chunk[order].astype(dtype)
+        ids[dest] = start + order
+        sq_norms[dest] = (chunk[order] ** 2).sum(1)
+        cursor += chunk_counts
+    vectors.flush()
+    del vectors
+
+    np.save(os.path.join(index_dir, "centroids.npy"), centroids)
+    np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(index_dir, "ids.npy"), ids)
+    np.save(os.path.join(index_dir, "sq_norms.npy"), sq_norms)
+    write_labels(os.path.join(index_dir, "labels.txt"), source.labels)
+    with open(os.path.join(index_dir, "meta.json"), "w") as f:
+        json.dump({"dim": dim, "metric": metric, "nlist": nlist, "n": n, "dtype": np.dtype(dtype).name,
+                   **source_fingerprint(source.path)}, f)
+
+    elapsed = time.time() - start_time
+    logger.info(f"Built IVF index over {n} vectors in {elapsed:.1f}s ({n / max(elapsed, 1e-9):.0f} vectors/s)")
+    return IVFIndex(index_dir)
+
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {"source": os.path.abspath(path), "source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def _merge_topk(best_scores, best_ids, scores, ids, k, largest):
+    '''Merges candidate (b x m) scores/ids into the running (b x k) top-k'''
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_ids = np.concatenate([best_ids, ids], axis=1)
+    key = -all_scores if largest else all_scores
+    if all_scores.shape[1] > k:
+        part = np.argpartition(key, k - 1, axis=1)[:, :k]
+        all_scores = np.take_along_axis(all_scores, part, axis=1)
+        all_ids = np.take_along_axis(all_ids, part, axis=1)
+    return all_scores, all_ids
+
+
+class IVFIndex():
+    '''Memory-mapped IVF index written by build_ivf_index'''
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.metric = self.meta["metric"]
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+        self.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(index_dir, "ids.npy"), mmap_mode="r")
+        self.sq_norms = np.load(os.path.join(index_dir, "sq_norms.npy"), mmap_mode="r")
+        self.labels = read_labels(os.path.join(index_dir, "labels.txt"))
+
+    def matches_source(self, path):
+        '''Whether the index was built from the embeddings at path, as they are now'''
+        return all(self.meta.get(key) == value for key, value in source_fingerprint(path).items())
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(os.path.join(index_dir, "meta.json"))
+
+    def search(self, queries, k=10, nprobe=16):
+        '''
+        Returns (scores, ids) of the k nearest stored vectors for each query, best first. Scores are cosine
+        similarities for cosine indices and squared L2 distances for L2 indices.
+        '''
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == "cosine":
+            queries = _normalize(queries)
+        largest = self.metric == "cosine"
+        b = len(queries)
+        nprobe = min(nprobe, len(self.centroids))
+        coarse = _nearest_cells(queries, self.centroids, nprobe)
+        q_sq_norms = (queries ** 2).sum(1)
+        fill = -np.inf if largest else np.inf
+        best_scores = np.full((b, k), fill, dtype=np.float32)
+        best_ids = np.full((b, k), -1, dtype=np.int64)
+
+        # Visit each probed cell once and score all the queries that probe it together
+        cell_of, query_of = coarse.ravel(), np.repeat(np.arange(b), nprobe)
+        order = np.argsort(cell_of, kind="stable")
+        cell_of, query_of = cell_of[order], query_of[order]
+        bounds = np.flatnonzero(np.diff(cell_of)) + 1
+        for cell_queries, cell in zip(np.split(query_of, bounds), cell_of[np.r_[0, bounds]]):
+            lo, hi = self.offsets[cell], self.offsets[cell + 1]
+            if hi == lo:
+                continue
+            vecs = np.asarray(self.vectors[lo:hi], dtype=np.float32)
+            dots = queries[cell_queries] @ vecs.T
+            if largest:
+                scores = dots
+            else:
+                scores = q_sq_norms[cell_queries, None] - 2 * dots + self.sq_norms[lo:hi][None, :]
+            if scores.shape[1] > k:
+                key = -scores if largest else scores
+                part = np.argpartition(key, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, part, axis=1)
+                cand = lo + part
+            else:
+                cand = np.broadcast_to(np.arange(lo, hi), scores.shape)
+            best_scores[cell_queries], best_ids[cell_queries] = _merge_topk(
+                best_scores[cell_queries], best_ids[cell_queries], scores, cand, k, largest)
+
+        order = np.argsort(-best_scores if largest else best_scores, axis=1, kind="stable")
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        found = best_ids >= 0
+        rows = np.where(found, np.asarray(self.ids)[np.where(found, best_ids, 0)], -1)
+        return best_scores, rows
+
+
+def _nearest_cells(queries, centroids, nprobe):
+    dists = (centroids ** 2).sum(1)[None, :] - 2 * queries @ centroids.T
+    if nprobe >= len(centroids):
+        return np.argsort(dists, axis=1)
+    return np.argpartition(dists, nprobe - 1, axis=1)[:, :nprobe]
+
+
+def exact_search(source, queries, k=10, metric="cosine", chunk_size=65536):
+    '''Brute-force top-k over an EmbeddingSource, used to measure the recall of the IVF index'''
+    queries = np.asarray(queries, dtype=np.float32)
+    if metric == "cosine":
+        queries = _normalize(queries)
+    largest = metric == "cosine"
+    fill = -np.inf if largest else np.inf
+    best_scores = np.full((len(queries), k), fill, dtype=np.float32)
+    best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for start, chunk in source.chunks(chunk_size):
+        if metric == "cosine":
+            scores = queries @ _normalize(chunk).T
+        else:
+            scores = (queries ** 2).sum(1)[:, None] - 2 * queries @ chunk.T + (chunk ** 2).sum(1)[None, :]
+        ids = np.broadcast_to(np.arange(start, start + len(chunk)), scores.shape)
+        best_scores, best_ids = _merge_topk(best_scores, best_ids, scores, ids, k, largest)
+    order = np.argsort(-best_scores if largest else best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
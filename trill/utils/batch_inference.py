@@ -0,0 +1,41 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from trill.utils.embedding_store import iter_embedding_chunks
+
+# Streaming inference for the pre-trained classify/regress models. Embeddings are read in chunks from a store or CSV,
+# up to 2 * n_workers chunks are scored concurrently in threads (XGBoost, LightGBM, scikit-learn and BLAS all release
+# the GIL), and results are appended to the output CSVs in input order, so memory is bounded by the chunks in flight.
+
+
+def predict_in_chunks(emb_path, predict, out_paths, n_workers=1, chunk_rows=65536):
+    '''
+    Runs predict(features, labels) over every chunk of emb_path and appends the DataFrames it returns, one per path
+    in out_paths, to those CSVs. Returns the number of embeddings scored.
+    '''
+    n_workers = max(1, int(n_workers))
+    chunks = iter_embedding_chunks(emb_path, int(chunk_rows))
+    pending = deque()
+    n_scored = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        def submit():
+            chunk = next(chunks, None)
+            if chunk is not None:
+                pending.append(pool.submit(predict, *chunk))
+
+        for _ in range(2 * n_workers):
+            submit()
+        while pending:
+            frames = pending.popleft().result()
+            submit()
+            for frame, path in zip(frames, out_paths):
+                frame.to_csv(path, mode="w" if n_scored == 0 else "a", header=n_scored == 0, index=False)
+            n_scored += len(frames[0])
+    elapsed = time.time() - start
+    logger.info(f"Scored {n_scored} embeddings in {elapsed:.2f}s ({n_scored / max(elapsed, 1e-9):.0f}/s) "
+                f"with {n_workers} workers")
+    return n_scored
@@ -0,0 +1,190 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from importlib import metadata
+from urllib.parse import unquote, urlparse
+
+from loguru import logger
+
+# Helpers for populating ~/.trill_cache safely when many jobs (e.g. a SLURM array) start at once, possibly on
+# different nodes sharing a home directory over NFS. One process fetches an entry while the others wait on a lock,
+# and entries are built under a temporary name and renamed into place so nobody ever sees a partial clone.
+# An optional read-only shared cache (TRILL_SHARED_CACHE or trill --shared_cache) is consulted first.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".trill_cache")
+SHARED_CACHE_ENV = "TRILL_SHARED_CACHE"
+
+
+def shared_cache_dir():
+    path = os.environ.get(SHARED_CACHE_ENV)
+    return path if path and os.path.isdir(path) else None
+
+
+def cache_root(cache_dir, *entries):
+    '''Returns the shared cache if it already holds every one of entries, otherwise cache_dir'''
+    shared = shared_cache_dir()
+    if shared and entries and all(os.path.exists(os.path.join(shared, entry)) for entry in entries):
+        return shared
+    return cache_dir
+
+
+def resolve(path):
+    '''Maps a path inside the per-user cache to its copy in the shared cache, if the shared cache has it'''
+    shared = shared_cache_dir()
+    if shared:
+        rel = os.path.relpath(os.path.abspath(path), CACHE_DIR)
+        if not rel.startswith(os.pardir):
+            candidate = os.path.join(shared, rel)
+            if os.path.exists(candidate):
+                return candidate
+    return path
+
+
+class FileLock():
+    '''
+    Lock file that works between processes and across NFS clients. A uniquely named file is hard-linked to the
+    lock path, which is atomic on NFS, and the link count decides who won. The holder keeps refreshing the lock's
+    mtime, so waiters can break a lock left behind by a killed job once it has gone stale.
+    '''
+
+    def __init__(self, path, poll=1.0, stale=600, heartbeat=30, timeout=None):
+        self.path = path
+        self.poll = poll
+        self.stale = stale
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self._inode = None
+        self._stop = None
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        unique = f"{self.path}.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex}"
+        with open(unique, "w") as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}\n")
+        start = time.time()
+        waiting = False
+        try:
+            while True:
+                try:
+                    os.link(unique, self.path)
+                except OSError:
+                    pass
+                # On NFS link() can fail after succeeding on the server, so the link count is the real answer
+                if os.stat(unique).st_nlink == 2:
+                    self._inode = os.stat(unique).st_ino
+                    break
+                self._break_if_stale()
+                if not waiting:
+                    logger.info(f"Waiting for another TRILL process to finish populating the cache ({self.path})")
+                    waiting = True
+                if self.timeout is not None and time.time() - start > self.timeout:
+                    raise TimeoutError(f"Timed out waiting for {self.path}")
+                time.sleep(self.poll)
+        finally:
+            os.remove(unique)
+
+        self._stop = threading.Event()
+        threading.Thread(target=self._beat, daemon=True).start()
+        return self
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    def _break_if_stale(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        age = time.time() - stat.st_mtime
+        if age > self.stale:
+            logger.warning(f"Breaking stale cache lock {self.path} (no heartbeat for {age:.0f}s)")
+            try:
+                # Only remove the lock that was judged stale, not one a faster waiter just took
+                if os.stat(self.path).st_ino == stat.st_ino:
+                    os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def release(self):
+        if self._stop is not None:
+            self._stop.set()
+        try:
+            if os.stat(self.path).st_ino == self._inode:
+                os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def pip_installed(*paths):
+    '''Whether every one of paths has been pip installed (editable or not) into the running environment'''
+    wanted = {os.path.realpath(path) for path in paths}
+    for dist in metadata.distributions():
+        try:
+            url = json.loads(dist.read_text("direct_url.json") or "{}").get("url", "")
+        except ValueError:
+            continue
+        if url.startswith("file://"):
+            wanted.discard(os.path.realpath(unquote(urlparse(url).path)))
+    return not wanted
+
+
+def populate(path, fill, after=None, lock_timeout=None, installed=None):
+    '''
+    Makes sure the cache entry at path exists and returns where to read it from, which is the shared cache copy
+    if there is one. Otherwise fill(tmp_path) builds the entry at a temporary path that is then renamed to path,
+    and after(path) (e.g. a pip install) runs once it is in place. All of this happens under a lock, so
+    concurrent processes wait for the first one instead of fetching the same thing again. A <path>.done marker
+    is written once after(path) has finished, and after(path) is retried by the next call until it exists.
+    installed(path), if given, tells whether after(path) has taken effect in the running environment (see
+    pip_installed). When it has not, after runs again, also on the shared cache copy, which is never written to.
+    '''
+    found = resolve(path)
+    if found != path:
+        if after is not None and installed is not None and not installed(found):
+            with FileLock(f"{path}.lock", timeout=lock_timeout):
+                if not installed(found):
+                    after(found)
+        return found
+    marker = f"{path}.done"
+
+    def after_done():
+        return after is None or (os.path.exists(marker) and (installed is None or installed(path)))
+
+    if os.path.exists(path) and after_done():
+        return path
+    with FileLock(f"{path}.lock", timeout=lock_timeout):
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp-{socket.gethostname()}-{os.getpid()}"
+            _remove(tmp_path)
+            try:
+                fill(tmp_path)
+                os.rename(tmp_path, path)
+            except BaseException:
+                _remove(tmp_path)
+                raise
+        if not after_done():
+            after(path)
+            with open(marker, "w") as f:
+                f.write(f"{socket.gethostname()} {os.getpid()}\n")
+    return path
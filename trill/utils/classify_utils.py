@@ -1,3 +1,5 @@
+import hashlib
+import inspect
 import multiprocessing
 import os
 import subprocess
@@ -8,22 +10,25 @@ import xgboost as xgb
 import lightgbm as lgb
 import esm
 import time
-from sklearn.metrics import make_scorer
-from sklearn.metrics import precision_recall_fscore_support, f1_score
+from sklearn.metrics import precision_recall_fscore_support
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 from transformers import EsmForSequenceClassification, Trainer, TrainingArguments, AutoTokenizer
+from transformers.trainer_utils import PredictionOutput
 from datasets import Dataset
 from evaluate import load
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.data import DataLoader
 from transformers import T5EncoderModel, T5Tokenizer
-from skopt import BayesSearchCV
 from icecream import ic
-from skopt.space import Real, Categorical, Integer
+from trill.utils.cache import CACHE_DIR
 from trill.utils.logging import setup_logger
-import requests
+from trill.utils.download import download
+from trill.utils.batch_inference import predict_in_chunks
+from trill.utils.sweep_utils import run_sweep
+from trill.utils.embedding_store import is_embedding_store, open_embedding_store, write_embedding_store
 from Bio import SeqIO
 from loguru import logger
 from tqdm import tqdm
@@ -93,6 +98,111 @@ def compute_f1(eval_pred):
     predictions = np.argmax(predictions, axis=1)
     return f1_metric.compute(predictions=predictions, references=labels, average='macro') 
 
+def token_budget_batches(lengths, toks_per_batch, extra_toks=2, max_seqs=None):
+    '''
+    Groups indices, sorted by length, into batches of at most toks_per_batch padded tokens (incl. <cls>/<eos>), and
+    of at most max_seqs sequences if given
+    '''
+    batches, batch, max_len = [], [], 0
+    for i in np.argsort(lengths, kind="stable"):
+        size = int(lengths[i]) + extra_toks
+        if batch and (max(max_len, size) * (len(batch) + 1) > toks_per_batch or len(batch) == max_seqs):
+            batches.append(batch)
+            batch, max_len = [], 0
+        batch.append(int(i))
+        max_len = max(max_len, size)
+    if batch:
+        batches.append(batch)
+    return batches
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    '''Yields the token_budget_batches of a dataset, in a new random order every epoch if shuffle is set'''
+    def __init__(self, lengths, toks_per_batch, shuffle=False, seed=0, max_seqs=None):
+        self.batches = token_budget_batches(lengths, toks_per_batch, extra_toks=0, max_seqs=max_seqs)
+        self.shuffle = shuffle
+        self.generator = torch.Generator().manual_seed(seed)
+        # Sequences handed out so far, over all epochs
+        self.n_yielded = 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        order = torch.randperm(len(self.batches), generator=self.generator).tolist() if self.shuffle else range(len(self.batches))
+        for i in order:
+            self.n_yielded += len(self.batches[i])
+            yield self.batches[i]
+
+class TokenBudgetTrainer(Trainer):
+    '''
+    Trainer that feeds length-grouped batches of at most toks_per_batch tokens, padded per batch by the tokenizer's
+    collator, instead of fixed-size batches that mix short and long proteins. Training batches also hold at most
+    per_device_train_batch_size sequences, so the number of sequences per optimizer step stays what --batch_size set.
+    Predictions are returned in dataset order. With more than one process, evaluation and prediction keep the
+    default fixed-size batches, since the predictions gathered from the processes could not be put back in order.
+    '''
+    def __init__(self, *trainer_args, toks_per_batch=4096, **trainer_kwargs):
+        super().__init__(*trainer_args, **trainer_kwargs)
+        self.toks_per_batch = toks_per_batch
+        self._train_sampler = None
+        self._test_order = None
+
+    def model_inputs(self, dataset):
+        '''dataset without the columns the model\'s forward() does not take, which the collator could not pad'''
+        accepted = set(inspect.signature(self.model.forward).parameters) | {'label', 'label_ids'}
+        return dataset.remove_columns([column for column in dataset.column_names if column not in accepted])
+
+    def _token_budget_dataloader(self, dataset, shuffle, description, max_seqs=None):
+        dataset = self.model_inputs(dataset)
+        lengths = np.array([len(ids) for ids in dataset['input_ids']])
+        sampler = TokenBudgetBatchSampler(lengths, self.toks_per_batch, shuffle=shuffle, seed=self.args.seed,
+                                          max_seqs=max_seqs)
+        padded = sum(len(batch) * lengths[batch].max() for batch in sampler.batches)
+        logger.info(f"{description.capitalize()}: {len(lengths)} sequences in {len(sampler)} length-grouped batches, "
+                    f"{100 * lengths.sum() / padded:.1f}% of padded tokens are real")
+        loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=self.data_collator,
+                            num_workers=self.args.dataloader_num_workers, pin_memory=self.args.dataloader_pin_memory)
+        return self.accelerator.prepare(loader), sampler
+
+    def get_train_dataloader(self):
+        loader, self._train_sampler = self._token_budget_dataloader(self.train_dataset, True, "training",
+                                                                    max_seqs=self.args.per_device_train_batch_size)
+        return loader
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        if self.args.world_size > 1:
+            return super().get_eval_dataloader(eval_dataset)
+        return self._token_budget_dataloader(eval_dataset if eval_dataset is not None else self.eval_dataset, False, "evaluation")[0]
+
+    def get_test_dataloader(self, test_dataset):
+        if self.args.world_size > 1:
+            self._test_order = None
+            return super().get_test_dataloader(test_dataset)
+        loader, sampler = self._token_budget_dataloader(test_dataset, False, "test")
+        self._test_order = np.concatenate(sampler.batches)
+        return loader
+
+    def train(self, *train_args, **train_kwargs):
+        output = super().train(*train_args, **train_kwargs)
+        # Hugging Face counts every step as a full per_device_train_batch_size batch, token budget batches are often
+        # smaller, so the throughput is taken from the sequences the sampler actually handed out
+        runtime = output.metrics.get("train_runtime")
+        if self._train_sampler is not None and runtime:
+            output.metrics["train_samples_per_second"] = round(self._train_sampler.n_yielded / runtime, 3)
+        return output
+
+    def predict(self, test_dataset, *predict_args, **predict_kwargs):
+        output = super().predict(test_dataset, *predict_args, **predict_kwargs)
+        if self._test_order is None:
+            return output
+        predictions = np.empty_like(output.predictions)
+        predictions[self._test_order] = output.predictions
+        label_ids = output.label_ids
+        if label_ids is not None:
+            label_ids = np.empty_like(output.label_ids)
+            label_ids[self._test_order] = output.label_ids
+        return PredictionOutput(predictions=predictions, label_ids=label_ids, metrics=output.metrics)
+
 def setup_esm2_hf(train, test, args, n_classes):
     if float(args.lr) == 0.2:
         args.lr = 0.0001
@@ -132,22 +242,24 @@ def setup_esm2_hf(train, test, args, n_classes):
         fp16 = fp16
     )
     if n_classes == 2:
-        trainer = Trainer(
+        trainer = TokenBudgetTrainer(
         model,
         config,
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
         tokenizer=tokenizer,
         compute_metrics=binary_compute_f1,
+        toks_per_batch=int(args.toks_per_batch),
         )
     else:
-        trainer = Trainer(
+        trainer = TokenBudgetTrainer(
         model,
         config,
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
         tokenizer=tokenizer,
         compute_metrics=compute_f1,
+        toks_per_batch=int(args.toks_per_batch),
         ) 
     logger.info("Starting training of ESM2+MLP!")
     return trainer, test_dataset
@@ -186,14 +298,85 @@ def custom_esm2mlp_test(args):
         # log_level='debug',
         fp16 = fp16
     )
-    trainer = Trainer(
+    trainer = TokenBudgetTrainer(
         model,
         config,
         eval_dataset=dataset,
         tokenizer=tokenizer,
+        toks_per_batch=int(args.toks_per_batch),
         ) 
     return trainer, dataset, seq_df['Label'].to_list()
 
+ESM2_FEATURE_CACHE = os.path.join(CACHE_DIR, "ESM2_MLP_features")
+
+@torch.no_grad()
+def esm2_cls_features(esm_model, tokenizer, sequences, toks_per_batch, device):
+    '''Returns the final-layer <cls> hidden states of the ESM2 backbone, which is what the classification head reads'''
+    feats = np.zeros((len(sequences), esm_model.config.hidden_size), dtype=np.float32)
+    batches = token_budget_batches(np.array([len(seq) for seq in sequences]), toks_per_batch)
+    for batch in tqdm(batches, desc="Embedding"):
+        inputs = tokenizer([sequences[i] for i in batch], padding=True, return_tensors="pt").to(device)
+        with torch.autocast("cuda", dtype=torch.float16, enabled=device != "cpu"):
+            hidden = esm_model(**inputs).last_hidden_state[:, 0]
+        feats[batch] = hidden.float().cpu().numpy()
+    return feats
+
+def cached_esm2_cls_features(esm_model, tokenizer, labels, sequences, args, device):
+    sha = hashlib.sha256(args.emb_model.encode())
+    for seq in sequences:
+        sha.update(f"\n{seq}".encode())
+    path = os.path.join(ESM2_FEATURE_CACHE, f"{args.emb_model}_{sha.hexdigest()}.npy")
+    if is_embedding_store(path):
+        logger.info(f"Using cached {args.emb_model} features from {path}")
+        return np.asarray(open_embedding_store(path)[0])
+    feats = esm2_cls_features(esm_model, tokenizer, sequences, int(args.toks_per_batch), device)
+    os.makedirs(ESM2_FEATURE_CACHE, exist_ok=True)
+    write_embedding_store(path, feats, labels)
+    return feats
+
+def train_frozen_esm2_mlp(train, test, args, n_classes):
+    '''
+    Trains only the classification head of EsmForSequenceClassification, on <cls> features that the frozen
+    backbone computes once per sequence. Returns the full model, so it saves and loads like an end-to-end one,
+    and the logits for the test set.
+    '''
+    if float(args.lr) == 0.2:
+        args.lr = 0.0001
+    device = "cuda" if int(args.GPUs) > 0 else "cpu"
+    model = EsmForSequenceClassification.from_pretrained(f"facebook/{args.emb_model}_UR50D", use_safetensors=False, num_labels=n_classes)
+    model.config.problem_type = "single_label_classification"
+    tokenizer = AutoTokenizer.from_pretrained(f"facebook/{args.emb_model}_UR50D")
+    model.esm.to(device).eval()
+    train_x, test_x = [
+        torch.from_numpy(cached_esm2_cls_features(model.esm, tokenizer, df['Label'].to_list(), df['Sequence'].to_list(), args, device)).to(device)
+        for df in (train, test)]
+    model.esm.cpu()
+
+    head = model.classifier.to(device).train()
+    train_y = torch.as_tensor(train['NewLab'].to_numpy(dtype=np.int64), device=device)
+    optimizer = torch.optim.AdamW(head.parameters(), lr=float(args.lr))
+    generator = torch.Generator().manual_seed(int(args.RNG_seed))
+    batch_size = int(args.batch_size)
+    logger.info("Starting training of the ESM2+MLP head on frozen features!")
+    for epoch in range(int(args.epochs)):
+        start = time.time()
+        epoch_loss = 0.0
+        for idx in torch.randperm(len(train_x), generator=generator).split(batch_size):
+            idx = idx.to(device)
+            # The head reads position 0 of the hidden states, so the features go in as length-1 sequences
+            loss = F.cross_entropy(head(train_x[idx].unsqueeze(1)), train_y[idx])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item() * len(idx)
+        logger.info(f"Epoch {epoch + 1}/{args.epochs}: loss {epoch_loss / len(train_x):.4f} ({time.time() - start:.2f}s)")
+
+    head.eval()
+    with torch.no_grad():
+        test_logits = head(test_x.unsqueeze(1)).float().cpu().numpy()
+    model.to("cpu")
+    return model, test_logits
+
 def train_model(train_df, args):
     if args.classifier == 'LightGBM':
         d_train = lgb.Dataset(train_df.iloc[:, :-2], label=train_df['NewLab'])
@@ -252,34 +435,38 @@ def predict_and_evaluate(model, le, test_df, args):
                                                                          
     return precision, recall, fscore, support
 
-def custom_model_test(model, test_df, args):
-    # Generate probability predictions based on the model type
+def custom_model_test(model, emb_path, args):
+    # Generate probability predictions based on the model type, a chunk of embeddings at a time
     model_type = args.classifier
-    if model_type == 'XGBoost':
-        test_preds_proba = model.predict_proba(test_df.iloc[:, :-1])
-        proba_df = pd.DataFrame(test_preds_proba)
-        test_preds = proba_df.idxmax(axis=1)
-    elif model_type == 'LightGBM':
-        test_preds_proba = model.predict(test_df.iloc[:, :-1], raw_score=True)
-        proba_df = pd.DataFrame(test_preds_proba)
-        if test_preds_proba.ndim == 1:
-            test_preds = (test_preds_proba > 0).astype(int)
-        else:
+    # With several workers each chunk is predicted single-threaded, otherwise the library uses every core
+    n_threads = 1 if int(args.n_workers) > 1 else 0
+    if model_type == 'XGBoost' and n_threads:
+        model.set_params(n_jobs=n_threads)
+
+    def predict(features, labels):
+        if model_type == 'XGBoost':
+            test_preds_proba = model.predict_proba(features)
+            proba_df = pd.DataFrame(test_preds_proba)
             test_preds = proba_df.idxmax(axis=1)
+        elif model_type == 'LightGBM':
+            test_preds_proba = model.predict(features, raw_score=True, num_threads=n_threads)
+            proba_df = pd.DataFrame(test_preds_proba)
+            if test_preds_proba.ndim == 1:
+                test_preds = (test_preds_proba > 0).astype(int)
+            else:
+                test_preds = proba_df.idxmax(axis=1)
 
-    # Add the original labels to the DataFrame
-    proba_df['Label'] = test_df['Label'].values
-    
-    # Save the probabilities to a CSV file
+        # Add the original labels to the DataFrame
+        proba_df['Label'] = labels
+        pred_df = pd.DataFrame(np.asarray(test_preds), columns=['Prediction'])
+        pred_df['Label'] = labels
+        return proba_df, pred_df
+
+    # Save the probabilities and predictions to CSV files as they are computed
     proba_file_name = f'{args.name}_{model_type}_class_probs.csv'
-    proba_df.to_csv(os.path.join(args.outdir, proba_file_name), index=False)
-    
-    # Prepare and save the predictions to a CSV file
-    pred_df = pd.DataFrame(test_preds, columns=['Prediction'])
-    pred_df['Label'] = test_df['Label']
-    
     pred_file_name = f'{args.name}_{model_type}_predictions.csv'
-    pred_df.to_csv(os.path.join(args.outdir, pred_file_name), index=False)
+    predict_in_chunks(emb_path, predict, [os.path.join(args.outdir, proba_file_name), os.path.join(args.outdir, pred_file_name)],
+                      n_workers=args.n_workers, chunk_rows=args.chunk_rows)
 
     return
 
@@ -410,56 +597,16 @@ def generate_class_key_csv(args):
 def sweep(train_df, args):
     model_type = args.classifier
     logger.info(f"Setting up hyperparameter sweep for {model_type}")
-    np.int = np.int64
     if args.n_workers == 1:
         logger.warning("WARNING!")
         logger.warning("You are trying to perform a hyperparameter sweep with only 1 core!")
         logger.warning(f"In your case, you have {multiprocessing.cpu_count()} CPU cores available!")
     logger.info(f"Using {args.n_workers} CPU cores for sweep")
-    # Define model and parameter grid based on the specified model_type
-    if model_type == 'LightGBM':
-        if train_df['NewLab'].nunique() == 2:
-            objective = 'binary'
-            f1_avg_method = 'binary'
-        else:
-            objective = 'multiclass'
-            f1_avg_method = 'macro'
-        model = lgb.LGBMClassifier(objective=objective, verbose=-1)
-        param_grid = {
-            'learning_rate': Real(0.01, 0.3),
-            'num_leaves': Integer(10, 255),
-            'max_depth': Integer(-1, 20),
-            'n_estimators': Integer(50, 250),
-            'feature_fraction': Real(0.1, 1.0),
-            'bagging_fraction': Real(0, 1),
-            'bagging_freq': Integer(0, 10),
-        }
-    elif model_type == 'XGBoost':
-        if train_df['NewLab'].nunique() == 2:
-            model = xgb.XGBClassifier(objective='binary:logitraw')
-            f1_avg_method = 'binary'
-        else:
-            model = xgb.XGBClassifier(objective='multi:softprob')
-            f1_avg_method = 'macro'
-        param_grid = {
-            'booster': Categorical(['gbtree']),
-            'gamma': Real(0, 5),
-            'learning_rate': Real(0.01, 0.3),
-            'max_depth': Integer(5, 20),
-            'n_estimators': Integer(50, 250),
-            'reg_alpha': Real(0, 1),
-            'reg_lambda': Real(0, 1),
-            'subsample': Real(0.5, 1.0),
-            'colsample_bytree': Real(0.5, 1.0),
-            'min_child_weight': Integer(1, 10),
-        }
-    
-    f1_scorer = make_scorer(f1_score, average=f1_avg_method)
-    
-    clf = BayesSearchCV(estimator=model, search_spaces=param_grid, n_iter=10, n_jobs=int(args.n_workers),scoring=f1_scorer, cv=int(args.sweep_cv), return_train_score=True, verbose=1)
-    
+    n_classes = train_df['NewLab'].nunique()
+    f1_avg_method = 'binary' if n_classes == 2 else 'macro'
+
     logger.info("Sweeping...")
-    clf.fit(train_df.iloc[:, :-2], train_df['NewLab'])
+    clf = run_sweep(model_type, 'classification', train_df.iloc[:, :-2], train_df['NewLab'], args, n_classes=n_classes, f1_avg_method=f1_avg_method)
     
     # Save the best model
     if model_type == 'LightGBM':
@@ -541,7 +688,7 @@ def write_probs(predictions, args, input):
     
     # Write to the output file
     with open(out_path, 'w+') as out_f:
-        for seq_id, (_, prob) in predictions.items():
+        for seq_id, (_, prob, *_) in predictions.items():
             # Write each line as a formatted string, ensuring CSV compatibility
             out_f.write(f'{seq_id.strip()},{prob}\n')
     
@@ -550,35 +697,16 @@ def write_probs(predictions, args, input):
     return out_path
 
 
+THREE_DI_STATES = "ACDEFGHIKLMNPQRSTVWY"
+
+
 def write_predictions(predictions, args, input):
-    ss_mapping = {
-        0: "A",
-        1: "C",
-        2: "D",
-        3: "E",
-        4: "F",
-        5: "G",
-        6: "H",
-        7: "I",
-        8: "K",
-        9: "L",
-        10: "M",
-        11: "N",
-        12: "P",
-        13: "Q",
-        14: "R",
-        15: "S",
-        16: "T",
-        17: "V",
-        18: "W",
-        19: "Y"
-    }
     out_path = os.path.join(args.outdir, f'{args.name}_{input}_3Di.fasta')
     with open(out_path, 'w+') as out_f:
         out_f.write('\n'.join(
             [">{}{}".format(
-                seq_id, "".join(list(map(lambda yhat: ss_mapping[int(yhat)], yhats))))
-             for seq_id, (yhats, _) in predictions.items()
+                seq_id, three_di_string(yhats))
+             for seq_id, (yhats, *_) in predictions.items()
              ]
         ))
     logger.info(f"Finished writing results to {out_path}")
@@ -597,15 +725,13 @@ def load_predictor(args, cache_dir, weights_link="https://github.com/mheinzinger
     model = CNN()
     checkpoint_p = os.path.join(cache_dir, 'ProstT5_3Di_CNN.pt')
     # if no pre-trained model is available, yet --> download it
-    if not os.path.exists(weights_link):
-        r = requests.get(weights_link)
+    if not os.path.exists(checkpoint_p):
         logger.info('Downloading ProstT5 3Di CNN weights...')
-        with open(checkpoint_p, "wb") as file:
-            file.write(r.content)
+        checkpoint_p = download(weights_link, checkpoint_p)
         logger.info('Finished downloading ProstT5 3Di CNN weights!')
 
 
-    state = torch.load(checkpoint_p)
+    state = torch.load(checkpoint_p, map_location='cpu')
 
     model.load_state_dict(state["state_dict"])
 
@@ -615,15 +741,7 @@ def load_predictor(args, cache_dir, weights_link="https://github.com/mheinzinger
     return model
 
 
-def get_3di_embeddings(args, cache_dir,
-                   max_residues=4000, max_seq_len=4000, max_batch=500):
-
-    seq_dict = dict()
-    predictions = dict()
-
-    # Read in fasta
-    prefix = "<AA2fold>"
-
+def load_3di_models(args, cache_dir):
     model, vocab = get_T5_model()
     predictor = load_predictor(args, cache_dir)
 
@@ -643,83 +761,110 @@ def get_3di_embeddings(args, cache_dir,
     #     model.to(torch.float32)
     #     predictor.to(torch.float32)
     #     print("Using models in full-precision.")
-    pred_path_list = []
-    for input in ['query', 'db']:
-        current_input = getattr(args, input)
-        seq_dict = read_fasta(current_input)
-        logger.info('Total number of sequences: {}'.format(len(seq_dict)))
+    return model, vocab, predictor, device
 
 
-        # sort sequences by length to trigger OOM at the beginning
-        seq_dict = sorted(seq_dict.items(), key=lambda kv: len(
-            seq_dict[kv[0]]), reverse=True)
-
-        batch = list()
-        standard_aa = "ACDEFGHIKLMNPQRSTVWY"
-        standard_aa_dict = {aa: aa for aa in standard_aa}
-        for seq_idx, (pdb_id, seq) in tqdm(enumerate(seq_dict, 1)):
-            # replace the non-standard amino acids with 'X'
-            seq = ''.join([standard_aa_dict.get(aa, 'X') for aa in seq])
-            #seq = seq.replace('U', 'X').replace('Z', 'X').replace('O', 'X')
-            seq_len = len(seq)
-            seq = prefix + ' ' + ' '.join(list(seq))
-            batch.append((pdb_id, seq, seq_len))
-
-            # count residues in current batch and add the last sequence length to
-            # avoid that batches with (n_res_batch > max_residues) get processed
-            n_res_batch = sum([s_len for _, _, s_len in batch]) + seq_len
-            if len(batch) >= max_batch or n_res_batch >= max_residues or seq_idx == len(seq_dict) or seq_len > max_seq_len:
-                pdb_ids, seqs, seq_lens = zip(*batch)
-                batch = list()
-
-                token_encoding = vocab.batch_encode_plus(seqs,
-                                                        add_special_tokens=True,
-                                                        padding="longest",
-                                                        return_tensors='pt'
-                                                        ).to(device)
-                try:
-                    with torch.no_grad():
-                        embedding_repr = model(token_encoding.input_ids,
-                                            attention_mask=token_encoding.attention_mask
-                                            )
-                except RuntimeError:
-                    print("RuntimeError during embedding for {} (L={})".format(
-                        pdb_id, seq_len)
-                    )
-                    continue
+def three_di_string(yhats):
+    return "".join(THREE_DI_STATES[int(yhat)] for yhat in yhats)
 
-                # ProtT5 appends a special tokens at the end of each sequence
-                # Mask this also out during inference while taking into account the prefix
-                for idx, s_len in enumerate(seq_lens):
-                    token_encoding.attention_mask[idx, s_len+1] = 0
 
-                # extract last hidden states (=embeddings)
-                residue_embedding = embedding_repr.last_hidden_state.detach()
-                # mask out padded elements in the attention output (can be non-zero) for further processing/prediction
-                residue_embedding = residue_embedding * \
-                    token_encoding.attention_mask.unsqueeze(dim=-1)
-                # slice off embedding of special token prepended before to each sequence
-                residue_embedding = residue_embedding[:, 1:]
+def predict_3di(model, vocab, predictor, seq_dict, device, max_residues=4000, max_seq_len=4000, max_batch=500):
+    '''
+        Predicts 3Di states with the ProstT5 encoder and the CNN head, batching sequences by residue budget.
+        Returns a dictionary mapping each id to (3Di class indices, mean confidence, per-residue confidence).
+    '''
+    predictions = dict()
+    prefix = "<AA2fold>"
 
-                # IN: X = (B x L x F) - OUT: ( B x N x L )
+    # sort sequences by length to trigger OOM at the beginning
+    seq_dict = sorted(seq_dict.items(), key=lambda kv: len(
+        seq_dict[kv[0]]), reverse=True)
+
+    batch = list()
+    standard_aa = "ACDEFGHIKLMNPQRSTVWY"
+    standard_aa_dict = {aa: aa for aa in standard_aa}
+    for seq_idx, (pdb_id, seq) in tqdm(enumerate(seq_dict, 1)):
+        # replace the non-standard amino acids with 'X'
+        seq = ''.join([standard_aa_dict.get(aa, 'X') for aa in seq])
+        #seq = seq.replace('U', 'X').replace('Z', 'X').replace('O', 'X')
+        seq_len = len(seq)
+        seq = prefix + ' ' + ' '.join(list(seq))
+        batch.append((pdb_id, seq, seq_len))
+
+        # count residues in current batch and add the last sequence length to
+        # avoid that batches with (n_res_batch > max_residues) get processed
+        n_res_batch = sum([s_len for _, _, s_len in batch]) + seq_len
+        if len(batch) >= max_batch or n_res_batch >= max_residues or seq_idx == len(seq_dict) or seq_len > max_seq_len:
+            pdb_ids, seqs, seq_lens = zip(*batch)
+            batch = list()
+
+            token_encoding = vocab.batch_encode_plus(seqs,
+                                                    add_special_tokens=True,
+                                                    padding="longest",
+                                                    return_tensors='pt'
+                                                    ).to(device)
+            try:
+                with torch.no_grad():
+                    embedding_repr = model(token_encoding.input_ids,
+                                        attention_mask=token_encoding.attention_mask
+                                        )
+            except RuntimeError:
+                print("RuntimeError during embedding for {} (L={})".format(
+                    pdb_id, seq_len)
+                )
+                continue
+
+            # ProtT5 appends a special tokens at the end of each sequence
+            # Mask this also out during inference while taking into account the prefix
+            for idx, s_len in enumerate(seq_lens):
+                token_encoding.attention_mask[idx, s_len+1] = 0
+
+            # extract last hidden states (=embeddings)
+            residue_embedding = embedding_repr.last_hidden_state.detach()
+            # mask out padded elements in the attention output (can be non-zero) for further processing/prediction
+            residue_embedding = residue_embedding * \
+                token_encoding.attention_mask.unsqueeze(dim=-1)
+            # slice off embedding of special token prepended before to each sequence
+            residue_embedding = residue_embedding[:, 1:]
+
+            # IN: X = (B x L x F) - OUT: ( B x N x L )
+            with torch.no_grad():
                 prediction = predictor(residue_embedding)
-                probabilities = toCPU(torch.max(
-                    F.softmax(prediction, dim=1), dim=1, keepdim=True)[0])
-                
-                prediction = toCPU(torch.max(prediction, dim=1, keepdim=True)[
-                                1]).astype(np.byte)
-
-                # batch-size x seq_len x embedding_dim
-                # extra token is added at the end of the seq
-                for batch_idx, identifier in enumerate(pdb_ids):
-                    s_len = seq_lens[batch_idx]
-                    # slice off padding and special token appended to the end of the sequence
-                    pred = prediction[batch_idx, :, 0:s_len].squeeze()
-                    prob = int( 100* np.mean(probabilities[batch_idx, :, 0:s_len]))
-                    predictions[identifier] = (pred, prob)
-                    assert s_len == len(predictions[identifier][0]), logger.warning(
-                        f"Length mismatch for {identifier}: is:{len(predictions[identifier])} vs should:{s_len}")
+            probabilities = toCPU(torch.max(
+                F.softmax(prediction, dim=1), dim=1, keepdim=True)[0])
+
+            prediction = toCPU(torch.max(prediction, dim=1, keepdim=True)[
+                            1]).astype(np.byte)
+
+            # batch-size x seq_len x embedding_dim
+            # extra token is added at the end of the seq
+            for batch_idx, identifier in enumerate(pdb_ids):
+                s_len = seq_lens[batch_idx]
+                # slice off padding and special token appended to the end of the sequence
+                pred = prediction[batch_idx, :, 0:s_len].squeeze()
+                residue_probs = probabilities[batch_idx, :, 0:s_len].flatten()
+                prob = int( 100* np.mean(residue_probs))
+                predictions[identifier] = (pred, prob, residue_probs)
+                assert s_len == len(predictions[identifier][0]), logger.warning(
+                    f"Length mismatch for {identifier}: is:{len(predictions[identifier])} vs should:{s_len}")
+
+    return predictions
+
+
+def get_3di_embeddings(args, cache_dir, inputs=('query', 'db'), models=None,
+                   max_residues=4000, max_seq_len=4000, max_batch=500):
+
+    if models is None:
+        models = load_3di_models(args, cache_dir)
+    model, vocab, predictor, device = models
+    pred_path_list = []
+    for input in inputs:
+        current_input = getattr(args, input)
+        seq_dict = read_fasta(current_input)
+        logger.info('Total number of sequences: {}'.format(len(seq_dict)))
 
+        predictions = predict_3di(model, vocab, predictor, seq_dict, device,
+                                  max_residues=max_residues, max_seq_len=max_seq_len, max_batch=max_batch)
 
         preds_out_path = write_predictions(predictions, args, input)
         probs_out_path = write_probs(predictions, args, input)
@@ -0,0 +1,67 @@
+import re
+
+import numpy as np
+import torch
+
+from .esm_utils import masked_log_probs
+
+# Deep mutational scans with ESM.
+# A protein is turned into an L x 20 matrix of log-probabilities, either with every residue masked in turn
+# (masked marginal, L masked copies batched together) or from one unmasked pass (wild-type marginal).
+# A mutant then scores sum(log p(mutant aa) - log p(wild-type aa)) over its substitutions, so any list of single or
+# multi-mutants is scored by table lookups. Ensembles average the matrices of several models.
+
+DMS_AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+MUTATION = re.compile(r"^([A-Z])(\d+)([A-Z])$")
+
+
+def marginal_matrix(model, alphabet, seq, scoring="masked_marginal", toks_per_batch=16384):
+    '''L x 20 log-probabilities of every amino acid (in DMS_AMINO_ACIDS order) at every position of seq'''
+    device = next(model.parameters()).device
+    _, _, tokens = alphabet.get_batch_converter()([("wt", seq)])
+    tokens = tokens.to(device)
+    aa_idx = torch.tensor([alphabet.get_idx(aa) for aa in DMS_AMINO_ACIDS], device=device)
+    offset = int(alphabet.prepend_bos)
+    if scoring == "wt_marginal":
+        with torch.no_grad():
+            logits = model(tokens)["logits"][0, offset:offset + len(seq)]
+        return torch.log_softmax(logits.float(), -1)[:, aa_idx].cpu().numpy()
+    matrix = torch.zeros(len(seq), len(DMS_AMINO_ACIDS), device=device)
+    for _, pos_idx, logprobs in masked_log_probs(model, alphabet, tokens, toks_per_batch=toks_per_batch):
+        matrix[pos_idx - offset] = logprobs[:, aa_idx]
+    return matrix.cpu().numpy()
+
+
+def single_mutants(seq):
+    '''Every single substitution of seq, as 1-indexed mutant strings like A12G'''
+    return [f"{wt}{pos + 1}{aa}" for pos, wt in enumerate(seq) for aa in DMS_AMINO_ACIDS if aa != wt]
+
+
+def parse_mutant(mutant, seq):
+    '''(positions, wild-type indexes, mutant indexes) of a mutant such as A12G or A12G:K15R, checked against seq'''
+    positions, wt_idx, mt_idx = [], [], []
+    for mutation in re.split(r"[:;,+]", mutant.strip()):
+        match = MUTATION.match(mutation.strip().upper())
+        if match is None:
+            raise ValueError(f"Cannot parse mutation {mutation} of {mutant}, expected something like A12G")
+        wt, pos, mt = match.group(1), int(match.group(2)) - 1, match.group(3)
+        if not 0 <= pos < len(seq) or seq[pos] != wt:
+            raise ValueError(f"Mutation {mutation} of {mutant} does not match the wild-type sequence")
+        if mt not in DMS_AMINO_ACIDS:
+            raise ValueError(f"Mutation {mutation} of {mutant} is to a non-standard amino acid")
+        positions.append(pos)
+        wt_idx.append(DMS_AMINO_ACIDS.index(wt))
+        mt_idx.append(DMS_AMINO_ACIDS.index(mt))
+    return positions, wt_idx, mt_idx
+
+
+def score_mutants(matrices, seq, mutants):
+    '''
+    Score of every mutant: its summed log-probability ratios of mutant to wild-type amino acids. matrices is an
+    L x 20 matrix or a stack of them (models x L x 20), in which case every mutant gets one score per model.
+    '''
+    scores = []
+    for mutant in mutants:
+        positions, wt_idx, mt_idx = parse_mutant(mutant, seq)
+        scores.append((matrices[..., positions, mt_idx] - matrices[..., positions, wt_idx]).sum(-1))
+    return np.array(scores).reshape(len(mutants), *matrices.shape[:-2])
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from loguru import logger
+from tqdm import tqdm
+
+from trill.utils.cache import FileLock, resolve
+
+# Shared downloader for model weights and databases.
+# Servers that accept byte ranges are fetched in parallel chunks written straight into a preallocated <dest>.part
+# file. Finished chunks are recorded in <dest>.part.json, so an interrupted download resumes where it stopped.
+# The file only appears at dest, through an atomic rename, once it is complete and (optionally) SHA256-verified.
+# Its digest is recorded in <dest>.sha256, and copies reused from the cache or the shared cache are checked against
+# it, so truncated or corrupted files are caught instead of being loaded.
+
+CHUNK_SIZE = 16 * 1024 * 1024
+STREAM_BLOCK = 1024 * 1024
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def sha256sum(path, block_size=STREAM_BLOCK):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _probe(session, url, timeout):
+    '''Returns (size, supports_ranges, etag) of url, using a one-byte range request'''
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout, allow_redirects=True) as r:
+        r.raise_for_status()
+        etag = r.headers.get("ETag")
+        if r.status_code == 206 and "Content-Range" in r.headers:
+            total = r.headers["Content-Range"].rsplit("/", 1)[-1]
+            if total != "*":
+                return int(total), True, etag
+        size = r.headers.get("Content-Length")
+        return (int(size) if size is not None and r.status_code == 200 else None), False, etag
+
+
+def _load_state(state_path, url, size, etag):
+    if not os.path.exists(state_path):
+        return set()
+    try:
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if state.get("url") != url or state.get("size") != size or state.get("etag") != etag:
+        return set()
+    return set(state.get("done", []))
+
+
+def _save_state(state_path, url, size, etag, done):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"url": url, "size": size, "etag": etag, "done": sorted(done)}, f)
+    os.replace(tmp_path, state_path)
+
+
+def _download_ranges(session, url, part_path, state_path, size, etag, n_workers, chunk_size, timeout, retries,
+                     progress_bar):
+    n_chunks = max(1, -(-size // chunk_size))
+    done = _load_state(state_path, url, size, etag)
+    if not done or not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+        done = set()
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+    elif done:
+        logger.info(f"Resuming download of {url} ({len(done)}/{n_chunks} chunks already fetched)")
+    progress_bar.update(sum(min(chunk_size, size - i * chunk_size) for i in done))
+    lock = threading.Lock()
+
+    def fetch(index):
+        start = index * chunk_size
+        stop = min(start + chunk_size, size) - 1
+        for attempt in range(retries + 1):
+            written = 0
+            try:
+                with session.get(url, headers={"Range": f"bytes={start}-{stop}"}, stream=True, timeout=timeout) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise DownloadError(f"Server ignored the range request for {url}")
+                    with open(part_path, "r+b") as f:
+                        f.seek(start)
+                        for block in r.iter_content(chunk_size=STREAM_BLOCK):
+                            f.write(block)
+                            written += len(block)
+                            progress_bar.update(len(block))
+                if written != stop - start + 1:
+                    raise DownloadError(f"Chunk {index} of {url} was truncated ({written} of {stop - start + 1} bytes)")
+                break
+            except (requests.RequestException, DownloadError) as e:
+                progress_bar.update(-written)
+                if attempt == retries:
+                    raise DownloadError(f"Failed to download chunk {index} of {url}: {e}") from e
+                logger.warning(f"Retrying chunk {index} of {url} after error: {e}")
+        with lock:
+            done.add(index)
+            _save_state(state_path, url, size, etag, done)
+
+    todo = [i for i in range(n_chunks) if i not in done]
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+        for future in [pool.submit(fetch, i) for i in todo]:
+            future.result()
+
+
+def _download_stream(session, url, part_path, timeout, progress_bar):
+    with session.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        with open(part_path, "wb") as f:
+            for block in r.iter_content(chunk_size=STREAM_BLOCK):
+                f.write(block)
+                progress_bar.update(len(block))
+
+
+def download(url, dest, sha256=None, n_workers=4, chunk_size=CHUNK_SIZE, timeout=60, retries=3, desc=None,
+             session=None):
+    '''
+    Downloads url to dest unless dest already exists, and returns the path to use (the shared cache copy if
+    there is one). Byte-range capable servers are fetched with n_workers parallel chunk requests and interrupted
+    downloads resume from the finished chunks. If sha256 is given, the download is verified against it before
+    being moved into place. Existing copies are verified against sha256 or their recorded digest; a bad local copy
+    is downloaded again and a bad shared copy is ignored.
+    '''
+    found = resolve(dest)
+    if found != dest and os.path.exists(found):
+        if _verified(found, sha256):
+            return found
+        logger.warning(f"Ignoring the shared cache copy {found}, which does not match its SHA256")
+    elif os.path.exists(dest) and _verified(dest, sha256):
+        return dest
+    # Concurrent jobs wait for the one already downloading instead of fetching the same file again
+    with FileLock(f"{dest}.lock"):
+        if os.path.exists(dest):
+            if _verified(dest, sha256):
+                return dest
+            logger.warning(f"{dest} does not match its SHA256, downloading it again")
+            os.remove(dest)
+        return _download(url, dest, sha256, n_workers, chunk_size, timeout, retries, desc, session)
+
+
+def _verified(path, sha256=None):
+    '''Whether path matches sha256, or the digest recorded when it was downloaded. Unrecorded files are trusted'''
+    expected = sha256
+    if expected is None and os.path.exists(f"{path}.sha256"):
+        with open(f"{path}.sha256", "r") as f:
+            expected = f.read().split()[0]
+    return expected is None or sha256sum(path) == expected.lower()
+
+
+def _download(url, dest, sha256, n_workers, chunk_size, timeout, retries, desc, session):
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    part_path, state_path = f"{dest}.part", f"{dest}.part.json"
+    session = session or requests.Session()
+    size, ranges, etag = _probe(session, url, timeout)
+
+    logger.info(f"Downloading {url} to {dest}")
+    progress_bar = tqdm(total=size, unit="B", unit_scale=True, unit_divisor=1024,
+                        desc=desc or os.path.basename(dest))
+    try:
+        if ranges and size:
+            _download_ranges(session, url, part_path, state_path, size, etag, n_workers, chunk_size, timeout,
+                             retries, progress_bar)
+        else:
+            _download_stream(session, url, part_path, timeout, progress_bar)
+    finally:
+        progress_bar.close()
+
+    if size is not None and os.path.getsize(part_path) != size:
+        raise DownloadError(f"Downloaded {os.path.getsize(part_path)} bytes from {url}, expected {size}")
+    digest = sha256sum(part_path)
+    if sha256 is not None and digest != sha256.lower():
+        os.remove(part_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        raise DownloadError(f"SHA256 mismatch for {url}: expected {sha256}, got {digest}")
+    # The digest is recorded first, so a file at dest always has one
+    with open(f"{dest}.sha256", "w") as f:
+        f.write(f"{digest}  {os.path.basename(dest)}\n")
+    os.replace(part_path, dest)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return dest
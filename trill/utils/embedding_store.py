@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# An embedding store is an (N x D) .npy matrix that can be memory-mapped, plus a text file with one label per row.
+# Reading it back is a single mmap instead of parsing N x D floats out of a CSV.
+# A ragged store holds per-residue embeddings: every protein's (L x D) block stacked into one (sum(L) x D) matrix,
+# plus an (N + 1) offsets .npy so protein i is rows offsets[i]:offsets[i + 1].
+
+
+def store_paths(path):
+    base = os.path.splitext(path)[0]
+    return f"{base}.npy", f"{base}_labels.txt"
+
+
+def ragged_offsets_path(path):
+    return f"{os.path.splitext(path)[0]}_offsets.npy"
+
+
+def is_embedding_store(path):
+    return path.endswith(".npy") and os.path.exists(store_paths(path)[1]) and not is_ragged_store(path)
+
+
+def is_ragged_store(path):
+    return path.endswith(".npy") and os.path.exists(ragged_offsets_path(path))
+
+
+def write_embedding_store(path, embeddings, labels):
+    emb_path, label_path = store_paths(path)
+    embeddings = np.ascontiguousarray(embeddings)
+    if len(embeddings) != len(labels):
+        raise ValueError(f"Got {len(embeddings)} embeddings but {len(labels)} labels")
+    np.save(emb_path, embeddings)
+    write_labels(label_path, labels)
+    return emb_path
+
+
+def create_embedding_store(path, n, dim, dtype=np.float32):
+    """Creates an (n x dim) store on disk and returns it as a writable memmap, for filling in blocks"""
+    emb_path, _ = store_paths(path)
+    return np.lib.format.open_memmap(emb_path, mode="w+", dtype=dtype, shape=(n, dim))
+
+
+def create_ragged_store(path, lengths, dim, dtype=np.float32):
+    """Creates a ragged store for proteins of the given lengths and returns the writable memmap and offsets"""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    np.save(ragged_offsets_path(path), offsets)
+    return create_embedding_store(path, int(offsets[-1]), dim, dtype), offsets
+
+
+def write_labels(label_path, labels):
+    with open(label_path, "w") as f:
+        for label in labels:
+            f.write(f"{str(label).strip()}\n")
+
+
+def read_labels(label_path):
+    with open(label_path, "r") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def open_embedding_store(path, mmap_mode="r"):
+    """Returns the memory-mapped (N x D) embedding matrix and its labels"""
+    emb_path, label_path = store_paths(path)
+    embeddings = np.load(emb_path, mmap_mode=mmap_mode)
+    labels = read_labels(label_path)
+    if len(embeddings) != len(labels):
+        raise ValueError(f"{emb_path} has {len(embeddings)} rows but {label_path} has {len(labels)} labels")
+    return embeddings, labels
+
+
+def open_ragged_store(path, mmap_mode="r"):
+    """Returns the memory-mapped (sum(L) x D) residue matrix, the offsets and the labels of a ragged store"""
+    emb_path, label_path = store_paths(path)
+    embeddings = np.load(emb_path, mmap_mode=mmap_mode)
+    offsets = np.load(ragged_offsets_path(path))
+    labels = read_labels(label_path)
+    if len(offsets) != len(labels) + 1 or offsets[-1] != len(embeddings):
+        raise ValueError(f"{emb_path} does not match its offsets and labels")
+    return embeddings, offsets, labels
+
+
+def load_embeddings(path, dtype=np.float32):
+    """
+    Loads embeddings from either an embedding store or a TRILL embedding CSV (one column per dimension, then Label).
+    Returns an (N x D) array and the list of labels.
+    """
+    if is_embedding_store(path):
+        return open_embedding_store(path)
+    df = pd.read_csv(path)
+    return df.iloc[:, :-1].to_numpy(dtype=dtype), df.iloc[:, -1].tolist()
+
+
+def iter_embedding_chunks(path, chunk_rows=65536):
+    """
+    Yields (features, labels) blocks of at most chunk_rows embeddings from an embedding store or a TRILL embedding
+    CSV. features is a DataFrame with the CSV's column names ("0", "1", ...), so models trained on CSVs accept it.
+    """
+    if is_embedding_store(path):
+        embeddings, labels = open_embedding_store(path)
+        columns = [str(i) for i in range(embeddings.shape[1])]
+        for start in range(0, len(labels), chunk_rows):
+            block = np.asarray(embeddings[start:start + chunk_rows], dtype=np.float32)
+            yield pd.DataFrame(block, columns=columns), labels[start:start + chunk_rows]
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunk_rows):
+            yield chunk.iloc[:, :-1], chunk.iloc[:, -1].tolist()
+
+
+def remove_embedding_store(path):
+    for store_path in (*store_paths(path), ragged_offsets_path(path)):
+        if os.path.exists(store_path):
+            os.remove(store_path)
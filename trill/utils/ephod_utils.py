@@ -15,12 +15,16 @@ import subprocess
 from collections import OrderedDict
 
 import esm
+import numpy as np
 import pytorch_lightning as pl
-import requests
 import torch
 import torch.nn as nn
 from loguru import logger
 from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from trill.utils.cache import CACHE_DIR, resolve
+from trill.utils.download import download
 
 
 def print(*args, **kwargs):
@@ -79,17 +83,8 @@ def download_models(get_from='zenodo'):
         
         # Download from Zenodo
         zlink = "https://zenodo.org/record/8011249/files/saved_models.tar.gz?download=1"
-        logger.info('Downloading EpHod models from Zenodo with requests\n')
-        response = requests.get(zlink, stream=True)
-        if response.status_code == 200:
-            with requests.get(zlink, stream=True) as r:
-                r.raise_for_status()
-                with open("saved_models.tar.gz", 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=1024):
-                        if chunk:
-                            f.write(chunk)
-        else:
-            logger.warning(f"Request failed with status code {response.status_code}")
+        logger.info('Downloading EpHod models from Zenodo\n')
+        tarfile = download(zlink, "saved_models.tar.gz")
 
     
     else: 
@@ -99,10 +94,10 @@ def download_models(get_from='zenodo'):
     # Move downloaded models to proper location
     this_dir, this_filename = os.path.split(__file__)
     if get_from == 'zenodo':
-        # Untar downloaded file
-        tarfile = os.path.join(this_dir, 'saved_models') 
+        # Untar downloaded file, which may be a read-only shared cache copy
         _ = subprocess.call(f"tar -xvzf {tarfile}", shell=True)
-        _ = subprocess.call(f"rm -rfv {tarfile}", shell=True)
+        if tarfile == "saved_models.tar.gz":
+            _ = subprocess.call(f"rm -rfv {tarfile}", shell=True)
     
     save_path = os.path.join(this_dir, 'saved_models') 
     cmd = f"mv -f ./saved_models {save_path}/"
@@ -270,6 +265,11 @@ class ResidualLightAttention(pl.LightningModule):
         x, mask = x
         x = x.unsqueeze(0)
         mask = mask.unsqueeze(0)
+        return self.predict_batch(x, mask)
+
+
+    def predict_batch(self, x, mask):
+        '''Forward pass over a whole (batch, features, seqlen) batch with its (batch, seqlen) mask'''
         x_2, weights = self.light_attention(x, mask)
         x_2 = self.batchnorm(x_2)
         x_2 = self.dropout(x_2)
@@ -335,15 +335,20 @@ class ESM1v(pl.LightningModule):
 
 
 class EpHodModel():
+    '''Long-lived EpHod inference engine that keeps ESM1v and RLAT resident on the device'''
+
     def __init__(self, args):
-        self.esm1v_model, self.esm1v_batch_converter, self.pl = self.load_ESM1v_model()
-        self.rlat_model = self.load_RLAT_model()
-        _ = self.esm1v_model.eval()
-        _ = self.rlat_model.eval()
         if int(args.GPUs) >= 1:
             self.device = 'cuda'
         else:
             self.device = 'cpu'
+        self.esm1v_model, self.esm1v_batch_converter, self.pl = self.load_ESM1v_model()
+        self.rlat_model = self.load_RLAT_model()
+        _ = self.esm1v_model.eval()
+        _ = self.rlat_model.eval()
+        self.esm1v_model.to(self.device)
+        self.rlat_model.to(self.device)
+        self.repr_layer = self.esm1v_model.num_layers
     
     def load_ESM1v_model(self):
         '''Return pretrained ESM1v model weights and batch converter'''
@@ -353,8 +358,9 @@ class EpHodModel():
         return model.esm, batch_converter, model
     
     
-    def get_ESM1v_embeddings(self, accs, seqs, args):
-        '''Return per-residue embeddings (padded) for protein sequences from ESM1v model'''
+    def get_ESM1v_embeddings(self, accs, seqs):
+        '''Return per-residue embeddings (padded) for protein sequences from ESM1v model, left on the device
+        as (batch, features, seqlen) so they can go straight into RLAT'''
 
         seqs = [replace_noncanonical(seq, 'X') for seq in seqs]
 
@@ -362,36 +368,24 @@ class EpHodModel():
         batch_labels, batch_strs, batch_tokens = self.esm1v_batch_converter(data)
         batch_tokens = batch_tokens.to(device=self.device, non_blocking=True)
 
+        emb = self.esm1v_model(batch_tokens, repr_layers=[self.repr_layer], return_contacts=False)
+        emb = emb["representations"][self.repr_layer]
+        emb = emb.transpose(2, 1) # From (batch, seqlen, features) to (batch, features, seqlen)
 
-        if int(args.GPUs) == 0:
-            trainer = pl.Trainer(enable_checkpointing=False, num_nodes=int(args.nodes), enable_progress_bar=False)
-        else:
-            trainer = pl.Trainer(enable_checkpointing=False, devices=int(args.GPUs), accelerator='gpu', num_nodes=int(args.nodes), precision = 16,  enable_progress_bar=False)
-        # self.esm1v_model = self.esm1v_model.to(device=self.device)
-        logging.getLogger("lightning").addHandler(logging.NullHandler())
-        logging.getLogger("lightning").propagate = False
-        reps = trainer.predict(self.pl, batch_tokens)
-        # emb = self.esm1v_model(batch_tokens, repr_layers=[33], return_contacts=False)
-        # emb = emb["representations"][33]
-        # emb = emb.transpose(2,1) # From (batch, seqlen, features) to (batch, features, seqlen)
-        # emb = emb.to(self.device)
-
-
-        return reps
+        return emb
     
     
     def load_RLAT_model(self):
         '''Return fine-tuned residual light attention top model'''
 
-        # Path to RLAT model
-        home_dir = os.path.expanduser("~")
-        cache_dir = os.path.join(home_dir, ".trill_cache")
+        # Path to RLAT model, preferring the shared cache if it has one
+        models_dir = resolve(os.path.join(CACHE_DIR, 'EpHod_Models'))
 
-        params_path = os.path.join(cache_dir, 'EpHod_Models', 'RLAT', 'params.json')
-        rlat_path = os.path.join(cache_dir, 'EpHod_Models', 'RLAT', 'RLAT.pt')
+        params_path = os.path.join(models_dir, 'RLAT', 'params.json')
+        rlat_path = os.path.join(models_dir, 'RLAT', 'RLAT.pt')
         
         # Load RLAT model from path
-        checkpoint = torch.load(rlat_path)
+        checkpoint = torch.load(rlat_path, map_location='cpu')
         params = read_json(params_path)        
         model = ResidualLightAttention(**params)
         # model = DataParallel(model)
@@ -404,28 +398,31 @@ class EpHodModel():
         return model
 
     
-    def batch_predict(self, accs, seqs, args):
+    def batch_predict(self, accs, seqs):
         '''Predict pHopt with EpHod on a batch of sequences'''
         
-        reps = self.get_ESM1v_embeddings(accs, seqs, args)
-        maxlen = reps[0].shape[-2]
-        masks = [[1] * len(seqs[i]) + [0] * (maxlen - len(seqs[i])) \
-                 for i in range(len(seqs))]
-        masks = torch.tensor(masks, dtype=torch.int32)
-        masks = masks.to(self.device)
-        reps = torch.from_numpy(reps[0])
-        reps = reps.permute(0, 2, 1)
-        logging.getLogger("lightning").addHandler(logging.NullHandler())
-        logging.getLogger("lightning").propagate = False
-        if int(args.GPUs) == 0:
-            trainer = pl.Trainer(enable_checkpointing=False, num_nodes=int(args.nodes), enable_progress_bar=False)
-        else:
-            trainer = pl.Trainer(enable_checkpointing=False, devices=int(args.GPUs), accelerator='gpu', num_nodes=int(args.nodes), precision = 16, enable_progress_bar=False)
-
-        dataset = CustomDataset(reps, masks)
-        output = trainer.predict(self.rlat_model, dataset)
-        return output[0]
-    
-    
-    
-
+        with torch.no_grad(), torch.autocast(device_type=self.device, dtype=torch.float16, enabled=self.device == 'cuda'):
+            reps = self.get_ESM1v_embeddings(accs, seqs)
+            # Like upstream EpHod, the first len(seq) positions of the (BOS-prefixed) representation are unmasked
+            lengths = torch.tensor([len(seq) for seq in seqs], device=self.device)
+            masks = (torch.arange(reps.shape[-1], device=self.device)[None, :] < lengths[:, None]).to(torch.int32)
+            ypred, emb_ephod, attention_weights = self.rlat_model.predict_batch(reps, masks)
+        return ypred, emb_ephod, attention_weights
+
+
+    def predict(self, accs, seqs, toks_per_batch=4096):
+        '''Predict pHopt for all sequences in length-sorted, token-budget batches. Returns predictions and
+        RLAT embeddings in input order'''
+
+        batches = esm.data.FastaBatchedDataset(list(accs), list(seqs)).get_batch_indices(
+            toks_per_batch, extra_toks_per_seq=2)
+        all_ypred = np.zeros(len(seqs), dtype=np.float32)
+        all_emb = None
+        for idx in tqdm(batches, desc="Predicting pHopt"):
+            ypred, emb_ephod, _ = self.batch_predict([accs[i] for i in idx], [seqs[i] for i in idx])
+            if all_emb is None:
+                all_emb = np.zeros((len(seqs), emb_ephod.shape[-1]), dtype=np.float32)
+            all_ypred[idx] = ypred.float().cpu().numpy()
+            all_emb[idx] = emb_ephod.float().cpu().numpy()
+
+        return all_ypred, all_emb
@@ -1,4 +1,5 @@
 import glob
+import hashlib
 import itertools
 import os
 import re
@@ -15,9 +16,11 @@ from loguru import logger
 from transformers.models.esm.openfold_utils.feats import atom14_to_atom37
 from transformers.models.esm.openfold_utils.protein import to_pdb, Protein as OFProtein
 
+from .cache import CACHE_DIR
 from .inverse_folding.gvp_transformer import lightning_GVPTransformerModel
 from .inverse_folding.multichain_util import extract_coords_from_complex, score_sequence_in_complex
 from .inverse_folding.util import load_structure, score_sequence
+from .embedding_store import write_embedding_store
 
 
 class coordDataset(torch.utils.data.Dataset):
@@ -125,6 +128,103 @@ def convert_outputs_to_pdb(outputs):
         pdbs.append(to_pdb(pred))
     return pdbs
 
+# ESMFold maps every non-standard residue to X before running ESM-2, so only these sequences can be cached
+ESMFOLD_STATES_DIR = os.path.join(CACHE_DIR, "ESMFold_LM_states")
+ESMFOLD_STATE_ALPHABET = set("ACDEFGHIKLMNPQRSTVWYX")
+
+def esmfold_state_path(states_dir, seq):
+    key = hashlib.sha256(seq.encode()).hexdigest()
+    return os.path.join(states_dir, key[:2], f"{key}.npy")
+
+def save_esmfold_lm_states(states_dir, seqs, representations):
+    """
+    Caches the hidden states of every ESM-2 layer for each sequence, in the L x layers x dim layout that
+    EsmForProteinFolding.compute_language_model_representations returns.
+    """
+    layers = sorted(representations.keys())
+    stacked = torch.stack([representations[layer] for layer in layers], dim=2)
+    for i, seq in enumerate(seqs):
+        if not set(seq).issubset(ESMFOLD_STATE_ALPHABET):
+            logger.debug(f"Not caching ESMFold language model states for sequence {i}, it contains non-standard residues")
+            continue
+        path = esmfold_state_path(states_dir, seq)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # slice off <cls>, <eos> and padding
+        states = stacked[i, 1:len(seq) + 1].to(device="cpu", dtype=torch.float16).numpy()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, states)
+        os.replace(tmp_path, path)
+
+def load_esmfold_lm_states(states_dir, seqs):
+    """
+    Returns a zero-padded B x L x layers x dim tensor of cached ESM-2 states for seqs, or None if any of them
+    has not been cached yet.
+    """
+    paths = [esmfold_state_path(states_dir, seq) for seq in seqs]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    states = [torch.from_numpy(np.load(path)) for path in paths]
+    max_len = max(state.shape[0] for state in states)
+    padded = states[0].new_zeros((len(states), max_len) + tuple(states[0].shape[1:]))
+    for i, state in enumerate(states):
+        padded[i, :state.shape[0]] = state
+    return padded
+
+def fold_with_lm_states(model, tokenized_input, esm_s):
+    """Runs ESMFold with precomputed language model states in place of its ESM-2 stem, so only the trunk is run"""
+    model.compute_language_model_representations = lambda esmaa: esm_s
+    try:
+        return model(tokenized_input)
+    finally:
+        del model.compute_language_model_representations
+
+def masked_log_probs(model, alphabet, tokens, mask_distance=None, toks_per_batch=16384, stats=None):
+    """
+    Runs masked copies of a batch of ESM tokens. Each residue is masked in one copy of its sequence, along with
+    every mask_distance-th residue around it (only itself if None). The copies of all sequences are run together,
+    longest first, packed into batches of at most toks_per_batch tokens.
+    Yields the sequence indexes, token positions and log-probabilities over the vocabulary of the masked residues
+    of every batch. If stats is a dict, the forward passes and the masked copies they ran are added to
+    stats['forward_passes'] and stats['forward_rows'].
+    """
+    special = torch.tensor([alphabet.cls_idx, alphabet.eos_idx, alphabet.padding_idx], device=tokens.device)
+    scored = ~torch.isin(tokens, special)
+    residue = scored.cumsum(1) - 1
+    lengths = scored.sum(1).tolist()
+    widths = (tokens != alphabet.padding_idx).sum(1).tolist()
+    distance = int(mask_distance) if mask_distance is not None else tokens.shape[1]
+    # (sequence, offset) of every masked copy, the copy masks the residues at offset modulo distance
+    copies = [(seq, offset) for seq in sorted(range(len(tokens)), key=lambda seq: -widths[seq])
+              for offset in range(min(distance, lengths[seq]))]
+    with torch.no_grad():
+        start = 0
+        while start < len(copies):
+            width = widths[copies[start][0]]
+            stop = min(len(copies), start + max(1, toks_per_batch // width))
+            seq_idx = torch.tensor([seq for seq, _ in copies[start:stop]], device=tokens.device)
+            offsets = torch.tensor([offset for _, offset in copies[start:stop]], device=tokens.device)
+            masked = scored[seq_idx, :width] & (residue[seq_idx, :width] % distance == offsets[:, None])
+            logits = model(tokens[seq_idx, :width].masked_fill(masked, alphabet.mask_idx))["logits"]
+            if stats is not None:
+                stats['forward_passes'] = stats.get('forward_passes', 0) + 1
+                stats['forward_rows'] = stats.get('forward_rows', 0) + len(seq_idx)
+            rows, cols = masked.nonzero(as_tuple=True)
+            yield seq_idx[rows], cols, torch.log_softmax(logits[rows, cols].float(), -1)
+            start = stop
+
+def pseudo_log_likelihoods(model, alphabet, tokens, mask_distance=None, toks_per_batch=16384, stats=None):
+    """
+    Masked log-probabilities of every residue of a batch of ESM tokens, see masked_log_probs.
+    Returns a batch_size x seq_len tensor of log-probabilities (0 at special tokens) and the mask of scored residues.
+    """
+    special = torch.tensor([alphabet.cls_idx, alphabet.eos_idx, alphabet.padding_idx], device=tokens.device)
+    scored = ~torch.isin(tokens, special)
+    logprobs = torch.zeros(tokens.shape, device=tokens.device)
+    for seq_idx, pos_idx, token_logprobs in masked_log_probs(model, alphabet, tokens, mask_distance, toks_per_batch, stats):
+        logprobs[seq_idx, pos_idx] = token_logprobs.gather(-1, tokens[seq_idx, pos_idx, None]).squeeze(-1)
+    return logprobs, scored
+
 def sample_sequence_in_complex(model, coords, target_chain_id, temperature=1.,
         padding_length=10):
     """
@@ -269,7 +369,7 @@ def _load_model_and_alphabet_core_v1(model_data):
     return model, alphabet, model_state
 
 
-def parse_and_save_all_predictions(args):
+def parse_and_save_all_predictions(args, as_store=False):
     # Look for all 'predictions_*.pt' files in the specified directory
     prediction_files = glob.glob(f"{args.outdir}/predictions_*.pt")
     
@@ -321,16 +421,21 @@ def parse_and_save_all_predictions(args):
         all_parsed_data_avg.extend(parsed_data_avg)
         all_batched_per_aa_embeddings_with_labels.extend(batched_per_aa_embeddings_with_labels)  # Modified to store labels
 
-    # Save average embeddings as CSV
+    # Save average embeddings as CSV, or as a memory-mappable embedding store
     if all_parsed_data_avg:
-        df_parsed_avg = pd.DataFrame(all_parsed_data_avg, columns=['Embeddings', 'Label'])
-        finaldf_parsed_avg = df_parsed_avg['Embeddings'].apply(pd.Series)
-        finaldf_parsed_avg['Label'] = df_parsed_avg['Label']
         if args.command == 'embed':
             outname = os.path.join(args.outdir, f'{args.name}_{args.model}_AVG.csv')
         elif args.command == 'classify':
             outname = os.path.join(args.outdir, f'{args.name}_ProtT5_AVG.csv')
-        finaldf_parsed_avg.to_csv(outname, index=False)
+        if as_store:
+            embeddings = np.stack([_to_numpy(embedding) for embedding, _ in all_parsed_data_avg]).astype(np.float32)
+            labels = [label for _, label in all_parsed_data_avg]
+            write_embedding_store(outname, embeddings, labels)
+        else:
+            df_parsed_avg = pd.DataFrame(all_parsed_data_avg, columns=['Embeddings', 'Label'])
+            finaldf_parsed_avg = df_parsed_avg['Embeddings'].apply(pd.Series)
+            finaldf_parsed_avg['Label'] = df_parsed_avg['Label']
+            finaldf_parsed_avg.to_csv(outname, index=False)
     
     # Save batched per_AA embeddings as .pt file
     if all_batched_per_aa_embeddings_with_labels:  # Modified to store labels
@@ -340,6 +445,11 @@ def parse_and_save_all_predictions(args):
 
     return 
 
+def _to_numpy(embedding):
+    if isinstance(embedding, torch.Tensor):
+        return embedding.detach().float().cpu().numpy().flatten()
+    return np.asarray(embedding).flatten()
+
 class premasked_FastaBatchedDataset(object):
     def __init__(self, sequence_labels, sequence_strs, sequence_masked):
         self.sequence_labels = sequence_labels
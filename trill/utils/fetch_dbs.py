@@ -1,17 +1,13 @@
-import requests
 import os
 import subprocess
 from loguru import logger
+from trill.utils.download import download
 
 def download_file(url, download_path):
     """
-    Download a file from a URL to a given path, chunk by chunk.
+    Download a file from a URL to a given path, resumably and in parallel chunks.
     """
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()  # Raises a HTTPError if the response status code is 4XX/5XX
-        with open(download_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):  # 8KB chunks
-                f.write(chunk)
+    return download(url, download_path)
 
 def extract_tar_gz(tar_path, extract_to):
     """
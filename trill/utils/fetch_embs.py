@@ -3,10 +3,12 @@ import os
 import h5py
 import numpy as np
 import pandas as pd
-import requests
 from tqdm import tqdm
 from loguru import logger
 
+from trill.utils.download import download
+from trill.utils.embedding_store import create_embedding_store, create_ragged_store, store_paths, write_labels
+
 dataset_ids = {
     'UniProtKB': 'uniprot_sprot',
     'A.thaliana': 'UP000006548_3702',
@@ -18,26 +20,63 @@ dataset_ids = {
     'SARS-CoV-2': 'UP000464024_2697049'
 }
 
-def convert_embeddings_to_csv(h5_file_path, csv_file_path):
-    # Open the HDF5 file
+def convert_embeddings_to_csv(h5_file_path, csv_file_path, block_size=4096):
+    # Stream blocks of proteins into the CSV so memory stays bounded by block_size
     with h5py.File(h5_file_path, 'r') as h5_file:
-        emb_dict = {}
-        data_list = []
-        for prot in h5_file.keys():
-            h5_data = h5_file[prot]
-            np_data = np.array(h5_data)
-            emb_dict[prot] = np_data
-        for label, array in emb_dict.items():
-            item_dict = {str(i): value for i, value in enumerate(array)}
-            item_dict['Label'] = label
-            data_list.append(item_dict)
+        labels = list(h5_file.keys())
+        dim = h5_file[labels[0]].shape[-1]
+        header = True
+        for start in tqdm(range(0, len(labels), block_size), desc='Converting to CSV'):
+            block_labels = labels[start:start + block_size]
+            df = pd.DataFrame(np.stack([h5_file[label][()] for label in block_labels]),
+                              columns=[str(i) for i in range(dim)])
+            df['Label'] = block_labels
+            df.to_csv(csv_file_path, index=False, header=header, mode='w' if header else 'a')
+            header = False
+    logger.info(f'CSV file saved to {csv_file_path}')
 
 
-    df = pd.DataFrame(data_list)
+def convert_embeddings_to_store(h5_file_path, store_path, half=False, block_size=4096):
+    """Streams a per-protein .h5 into an embedding store, one block of proteins at a time"""
+    dtype = np.float16 if half else np.float32
+    with h5py.File(h5_file_path, 'r') as h5_file:
+        labels = list(h5_file.keys())
+        dim = h5_file[labels[0]].shape[-1]
+        out = create_embedding_store(store_path, len(labels), dim, dtype)
+        for start in tqdm(range(0, len(labels), block_size), desc='Converting to embedding store'):
+            block_labels = labels[start:start + block_size]
+            out[start:start + len(block_labels)] = np.stack([h5_file[label][()] for label in block_labels])
+        out.flush()
+        del out
+    write_labels(store_paths(store_path)[1], labels)
+    logger.info(f'Embedding store saved to {store_paths(store_path)[0]}')
+    return store_paths(store_path)[0]
+
+
+def convert_per_residue_to_store(h5_file_path, store_path, half=False, block_residues=1 << 20):
+    """Streams a per-residue .h5 into a ragged store, copying up to block_residues rows at a time"""
+    dtype = np.float16 if half else np.float32
+    with h5py.File(h5_file_path, 'r') as h5_file:
+        labels = list(h5_file.keys())
+        # Dataset shapes come from the HDF5 metadata, so sizing the store reads no embeddings
+        lengths = np.array([h5_file[label].shape[0] for label in labels], dtype=np.int64)
+        dim = h5_file[labels[0]].shape[-1]
+        out, offsets = create_ragged_store(store_path, lengths, dim, dtype)
+        progress_bar = tqdm(total=int(offsets[-1]), unit='res', unit_scale=True, desc='Converting to ragged store')
+        block, block_start = [], 0
+        for i, label in enumerate(labels):
+            block.append(h5_file[label][()])
+            if offsets[i + 1] - block_start >= block_residues or i == len(labels) - 1:
+                out[block_start:offsets[i + 1]] = np.concatenate(block)
+                progress_bar.update(int(offsets[i + 1] - block_start))
+                block, block_start = [], offsets[i + 1]
+        progress_bar.close()
+        out.flush()
+        del out
+    write_labels(store_paths(store_path)[1], labels)
+    logger.info(f'Ragged per-residue store saved to {store_paths(store_path)[0]}')
+    return store_paths(store_path)[0]
 
-    df = df[[col for col in df if col != 'Label'] + ['Label']]
-    df.to_csv(csv_file_path, index=False)
-    logger.info(f'CSV file saved to {csv_file_path}')
 
 def download_embeddings(args):
     dataset_id = dataset_ids[args.uniprotDB]
@@ -50,27 +89,8 @@ def download_embeddings(args):
         save_path = os.path.join(args.outdir, f'{args.uniprotDB}_ProtT5-XL_AVG.h5')
         file_url = f"{base_url}{dataset_id}/per-protein.h5"
     
-    response = requests.get(file_url, stream=True)
-    response.raise_for_status()  # Check if the request was successful
-    
-    # Get the total file size
-    file_size = int(response.headers.get('Content-Length', 0))
-    
-    # Set up the progress bar
-    progress_bar = tqdm(total=file_size, unit='B', unit_scale=True, unit_divisor=1024)
-    
-    with open(save_path, 'wb') as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            file.write(chunk)
-            # Update the progress bar
-            progress_bar.update(len(chunk))
-    
-    # Close the progress bar
-    progress_bar.close()
-    
-    if file_size != 0 and progress_bar.n != file_size:
-        logger.error("ERROR, something went wrong")
-    
+    download(file_url, save_path, n_workers=8)
+
     logger.info(f'Embeddings file downloaded to {save_path}')
     return save_path
 
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import subprocess
+
+from Bio import SeqIO
+from loguru import logger
+
+from trill.utils.cache import CACHE_DIR, FileLock, _remove, populate
+from trill.utils.classify_utils import predict_3di, three_di_string
+
+# 3Di-Search databases are cached under ~/.trill_cache/3Di_Search_DBs/<sha256 of the database fasta>/.
+# Each entry holds the foldseek DB (db, db_ss, db_h) plus records.tsv with the id, sequence, 3Di string and mean
+# confidence of every record, so a later version of the same fasta only needs ProstT5 for sequences not seen before.
+FOLDSEEK_DB_CACHE = os.path.join(CACHE_DIR, "3Di_Search_DBs")
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_db_records(entry_dir):
+    records = []
+    with open(os.path.join(entry_dir, "records.tsv"), "r") as f:
+        for line in f:
+            seq_id, aa, tdi, prob = line.rstrip("\n").split("\t")
+            records.append((seq_id, aa, tdi, int(prob)))
+    return records
+
+
+def write_db_records(entry_dir, records):
+    with open(os.path.join(entry_dir, "records.tsv"), "w") as f:
+        for seq_id, aa, tdi, prob in records:
+            f.write(f"{seq_id}\t{aa}\t{tdi}\t{prob}\n")
+
+
+def foldseek_tsv2db(records, out_dir, db_name="db"):
+    """Writes the aa/3Di/header TSVs for records and converts them with foldseek tsv2db into out_dir/db_name"""
+    with open(os.path.join(out_dir, "aa.tsv"), "w") as f_aa, \
+            open(os.path.join(out_dir, "tdi.tsv"), "w") as f_tdi, \
+            open(os.path.join(out_dir, "header.tsv"), "w") as f_header:
+        for i, (seq_id, aa, tdi, _) in enumerate(records, 1):
+            f_aa.write(f"{i}\t{aa}\n")
+            f_tdi.write(f"{i}\t{tdi.upper()}\n")
+            f_header.write(f"{i}\t{seq_id}\n")
+
+    for type, code, suff in [('aa', 0, ''), ('tdi', 0, '_ss'), ('header', 12, '_h')]:
+        cmd = ["foldseek", "tsv2db", os.path.join(out_dir, f"{type}.tsv"), os.path.join(out_dir, f"{db_name}{suff}"),
+               "--output-dbtype", str(code), "-v", "0"]
+        subprocess.run(cmd, check=True)
+    return os.path.join(out_dir, db_name)
+
+
+def remove_tsvs(out_dir):
+    for type in ('aa', 'tdi', 'header'):
+        os.remove(os.path.join(out_dir, f"{type}.tsv"))
+
+
+def _cached_entries_for(source):
+    if not os.path.isdir(FOLDSEEK_DB_CACHE):
+        return []
+    entries = []
+    for key in os.listdir(FOLDSEEK_DB_CACHE):
+        # Skips the .lock/.done files and entries still being built under a temporary name
+        if "." in key:
+            continue
+        manifest_path = os.path.join(FOLDSEEK_DB_CACHE, key, "manifest.json")
+        if not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("source") == source:
+            entries.append(os.path.join(FOLDSEEK_DB_CACHE, key))
+    return entries
+
+
+def _add_foldseek_db(entry_dir):
+    # Entries built for the native backend only hold records.tsv, the foldseek DB is added the first time it's needed
+    if not os.path.exists(os.path.join(entry_dir, "db.dbtype")):
+        foldseek_tsv2db(read_db_records(entry_dir), entry_dir)
+        remove_tsvs(entry_dir)
+
+
+def _remove_entry(entry_dir):
+    # Under the entry's own lock, so it isn't removed while another run reads it or adds its foldseek DB
+    with FileLock(f"{entry_dir}.lock"):
+        _remove(entry_dir)
+        _remove(f"{entry_dir}.done")
+
+
+def get_cached_foldseek_db(fasta_path, get_models, foldseek=True, max_residues=4000, max_seq_len=4000,
+                           max_batch=500):
+    """
+    Returns the cache entry directory holding a foldseek DB (entry/db) for fasta_path, building it if needed.
+    Sequences already predicted for an earlier version of the same fasta are reused, so only new or changed
+    records go through ProstT5. get_models is called (at most once) to load the ProstT5 models when needed.
+    With foldseek=False only the 3Di records are cached, for the native search backend.
+    """
+    key = file_sha256(fasta_path)
+    entry_dir = os.path.join(FOLDSEEK_DB_CACHE, key)
+    source = os.path.realpath(fasta_path)
+    previous_entries, built = [], []
+
+    def build(tmp_dir):
+        built.append(tmp_dir)
+        known_3di = {}
+        for previous in _cached_entries_for(source):
+            with FileLock(f"{previous}.lock"):
+                if not os.path.exists(os.path.join(previous, "manifest.json")):
+                    continue
+                for _, aa, tdi, prob in read_db_records(previous):
+                    known_3di[aa] = (tdi, prob)
+            previous_entries.append(previous)
+
+        records = [(record.id, str(record.seq).replace("-", "")) for record in SeqIO.parse(fasta_path, "fasta")]
+        missing = {i: aa for i, (_, aa) in enumerate(records) if aa not in known_3di}
+        logger.info(f"Database {fasta_path}: reusing 3Di for {len(records) - len(missing)} sequences, "
+                    f"predicting {len(missing)} new sequences")
+        if missing:
+            model, vocab, predictor, device = get_models()
+            predictions = predict_3di(model, vocab, predictor, missing, device,
+                                      max_residues=max_residues, max_seq_len=max_seq_len, max_batch=max_batch)
+            for i, (yhats, prob, *_) in predictions.items():
+                known_3di[missing[i]] = (three_di_string(yhats), prob)
+
+        db_records = [(seq_id, aa, *known_3di[aa]) for seq_id, aa in records if aa in known_3di]
+        if len(db_records) < len(records):
+            logger.warning(f"{len(records) - len(db_records)} sequences failed 3Di prediction and are left out of "
+                           f"the database")
+        os.makedirs(tmp_dir)
+        write_db_records(tmp_dir, db_records)
+        if foldseek:
+            foldseek_tsv2db(db_records, tmp_dir)
+            remove_tsvs(tmp_dir)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump({"source": source, "sha256": key, "n_seqs": len(db_records)}, f)
+
+    # populate() builds the entry under a temporary name and adds the foldseek DB while holding the entry's lock, so
+    # concurrent runs on the same database wait for the first one instead of writing into the entry alongside it
+    entry_dir = populate(entry_dir, build, after=_add_foldseek_db if foldseek else None)
+    if not built:
+        logger.info(f"Using cached Foldseek database for {fasta_path} from {entry_dir}")
+        return entry_dir
+
+    # Older versions of the same fasta have been folded into this entry
+    for previous in previous_entries:
+        _remove_entry(previous)
+    logger.info(f"Cached Foldseek database for {fasta_path} in {entry_dir}")
+    return entry_dir
+
+
+def write_db_3di_outputs(entry_dir, args):
+    """Writes the cached 3Di fasta and confidences of the database in the same format as the query side"""
+    records = read_db_records(entry_dir)
+    fasta_path = os.path.join(args.outdir, f'{args.name}_db_3Di.fasta')
+    with open(fasta_path, 'w+') as f:
+        f.write('\n'.join(f">{seq_id}\n{tdi}" for seq_id, _, tdi, _ in records))
+    probs_path = os.path.join(args.outdir, f"{args.name}_db_3Di_output_probabilities.csv")
+    with open(probs_path, 'w+') as f:
+        for seq_id, _, _, prob in records:
+            f.write(f'{seq_id},{prob}\n')
+    return fasta_path
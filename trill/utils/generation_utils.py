@@ -0,0 +1,316 @@
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+from loguru import logger
+from tqdm import tqdm
+
+# Sampling loop shared by the GPT2-style generators (ProtGPT2, ZymCTRL).
+# The prompt is encoded once and its key/value cache is copied into every batch slot. All slots decode in
+# lockstep, and a slot whose sequence hits EOS (or max_length) is refilled with a new sample straight away
+# (continuous batching), so the batch stays full until the last samples are being drawn. A refilled slot gets the
+# prompt's cache back and masks out the columns of its previous sample, and the cache is trimmed whenever the
+# masked columns take up more room than one sample can use. Finished samples are yielded as soon as they are done.
+
+
+def legacy_cache(past_key_values):
+    '''((key, value) per layer) of a model output, whatever cache class this transformers version returns'''
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple(tuple(layer) for layer in past_key_values)
+
+
+def model_cache(layers):
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple(layers)
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+
+def processed_logits(logits, seen, do_sample=True, temperature=1.0, top_k=0, repetition_penalty=1.0):
+    '''
+    Applies the repetition penalty to the tokens in seen (a batch x vocab mask), then temperature and top-k when
+    sampling, in the order transformers' generate() does
+    '''
+    if repetition_penalty != 1.0:
+        penalized = torch.where(logits > 0, logits / repetition_penalty, logits * repetition_penalty)
+        logits = torch.where(seen, penalized, logits)
+    if not do_sample:
+        return logits
+    logits = logits / temperature
+    if 0 < top_k < logits.size(-1):
+        kth = torch.topk(logits, top_k, dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    return logits
+
+
+def process_logits(logits, seen, do_sample=True, temperature=1.0, top_k=0, repetition_penalty=1.0):
+    '''Returns the sampled (or greedy) token of every row of logits, see processed_logits'''
+    logits = processed_logits(logits, seen, do_sample, temperature, top_k, repetition_penalty)
+    if not do_sample:
+        return logits.argmax(dim=-1)
+    return torch.multinomial(F.softmax(logits, dim=-1), 1).squeeze(-1)
+
+
+class PromptCache():
+    '''Key/value cache, next-token logits and token ids of a prompt, encoded once and shared by every sample'''
+
+    def __init__(self, model, prompt_ids):
+        self.ids = prompt_ids.view(1, -1).to(model.device)
+        with torch.no_grad():
+            out = model(self.ids, use_cache=True)
+        self.layers = legacy_cache(out.past_key_values)
+        self.logits = out.logits[:, -1].float()
+        self.prompt_logprobs = F.log_softmax(out.logits[0, :-1].float(), dim=-1).gather(
+            -1, self.ids[0, 1:, None]).squeeze(-1)
+
+    def __len__(self):
+        return self.ids.size(1)
+
+
+def perplexity(prompt, logprobs):
+    '''
+    Perplexity of a prompt (PromptCache) and a sample with the given token log-probabilities, i.e. the exp of the mean
+    loss a forward pass over prompt + sample with labels=input_ids reports, without running that pass
+    '''
+    total = float(prompt.prompt_logprobs.sum()) + sum(logprobs)
+    return math.exp(-total / (len(prompt) - 1 + len(logprobs)))
+
+
+def stream_samples(model, prompt_ids, n_samples, batch_size, max_length, eos_token_id, pad_token_id=None,
+                   do_sample=True, temperature=1.0, top_k=0, repetition_penalty=1.0, desc="Generating", stats=None):
+    '''
+    Draws n_samples continuations of prompt_ids (token ids or a PromptCache) from a causal LM, batch_size at a time, and yields
+    (sample index, generated token ids, log-probabilities of those tokens) as each sample finishes. Samples stop at
+    eos_token_id (which is kept) or once prompt and sample reach max_length tokens. The log-probabilities are
+    taken from the unprocessed logits, so they score the sample under the model itself. If given, the stats dict
+    receives the number of generated tokens and the seconds it took.
+    '''
+    pad_token_id = eos_token_id if pad_token_id is None else pad_token_id
+    prompt = prompt_ids if isinstance(prompt_ids, PromptCache) else PromptCache(model, prompt_ids)
+    n_prompt = len(prompt)
+    max_new = max(1, int(max_length) - n_prompt)
+    n_slots = min(int(batch_size), int(n_samples))
+    vocab = prompt.logits.size(-1)
+    device = prompt.ids.device
+
+    layers = [(k.expand(n_slots, -1, -1, -1).contiguous(), v.expand(n_slots, -1, -1, -1).contiguous())
+              for k, v in prompt.layers]
+    mask = torch.ones(n_slots, n_prompt, dtype=torch.long, device=device)
+    logits = prompt.logits.expand(n_slots, -1).clone()
+    prompt_seen = torch.zeros(1, vocab, dtype=torch.bool, device=device)
+    prompt_seen[0, prompt.ids[0]] = True
+    seen = prompt_seen.expand(n_slots, -1).clone()
+    sample_of = list(range(n_slots))
+    tokens = [[] for _ in range(n_slots)]
+    logprobs = [[] for _ in range(n_slots)]
+    started, n_tokens, start = n_slots, 0, time.time()
+
+    progress_bar = tqdm(total=int(n_samples), desc=desc)
+    with torch.no_grad():
+        while sample_of:
+            next_tokens = process_logits(logits, seen, do_sample, temperature, top_k, repetition_penalty)
+            next_logprobs = F.log_softmax(logits, dim=-1).gather(-1, next_tokens[:, None]).squeeze(-1)
+            seen[torch.arange(len(sample_of), device=device), next_tokens] = True
+            n_tokens += len(sample_of)
+
+            reset, keep = [], []
+            for slot, (token, logprob) in enumerate(zip(next_tokens.tolist(), next_logprobs.tolist())):
+                tokens[slot].append(token)
+                logprobs[slot].append(logprob)
+                if token != eos_token_id and len(tokens[slot]) < max_new:
+                    keep.append(slot)
+                    continue
+                yield sample_of[slot], tokens[slot], logprobs[slot]
+                progress_bar.update(1)
+                if started < int(n_samples):
+                    sample_of[slot], tokens[slot], logprobs[slot] = started, [], []
+                    started += 1
+                    reset.append(slot)
+                    keep.append(slot)
+
+            if len(keep) < len(sample_of):
+                # No samples left to start, so the finished slots leave the batch
+                rows = torch.tensor(keep, dtype=torch.long, device=device)
+                layers = [(k[rows], v[rows]) for k, v in layers]
+                mask, logits, seen, next_tokens = mask[rows], logits[rows], seen[rows], next_tokens[rows]
+                sample_of = [sample_of[slot] for slot in keep]
+                tokens = [tokens[slot] for slot in keep]
+                logprobs = [logprobs[slot] for slot in keep]
+                reset = [keep.index(slot) for slot in reset]
+                if not sample_of:
+                    break
+
+            fresh = torch.zeros(len(sample_of), dtype=torch.bool, device=device)
+            fresh[reset] = True
+            positions = torch.tensor([n_prompt + len(t) - 1 for t in tokens], dtype=torch.long, device=device)
+            # Refilled slots feed a masked pad token this step and take their logits from the prompt instead
+            step_ids = torch.where(fresh, torch.full_like(next_tokens, pad_token_id), next_tokens)
+            mask = torch.cat([mask, (~fresh).long()[:, None]], dim=1)
+            out = model(step_ids[:, None], past_key_values=model_cache(layers), attention_mask=mask,
+                        position_ids=positions.clamp(min=0)[:, None], use_cache=True)
+            layers = list(legacy_cache(out.past_key_values))
+            logits = out.logits[:, -1].float()
+
+            if reset:
+                rows = torch.tensor(reset, dtype=torch.long, device=device)
+                for (k, v), (prompt_k, prompt_v) in zip(layers, prompt.layers):
+                    k[rows, :, :n_prompt] = prompt_k
+                    v[rows, :, :n_prompt] = prompt_v
+                mask[rows] = 0
+                mask[rows, :n_prompt] = 1
+                logits[rows] = prompt.logits
+                seen[rows] = prompt_seen
+
+            # Keep the prompt and the last max_new columns, which hold every slot's current sample
+            if mask.size(1) > n_prompt + 2 * max_new:
+                keep_cols = torch.cat([torch.arange(n_prompt, device=device),
+                                       torch.arange(mask.size(1) - max_new, mask.size(1), device=device)])
+                layers = [(k[:, :, keep_cols], v[:, :, keep_cols]) for k, v in layers]
+                mask = mask[:, keep_cols]
+    progress_bar.close()
+
+    _report(n_samples, n_tokens, time.time() - start, stats)
+
+
+def _report(n_samples, n_tokens, seconds, stats):
+    logger.info(f"Generated {n_samples} sequences ({n_tokens} tokens) in {seconds:.2f}s, "
+                f"{n_tokens / max(seconds, 1e-9):.1f} tokens/s")
+    if stats is not None:
+        stats.update(tokens=n_tokens, seconds=seconds)
+
+
+def load_draft_model(path, device):
+    '''Draft model for speculative_samples, a smaller causal LM with the same tokenizer as the model it drafts for'''
+    from transformers import AutoModelForCausalLM
+    return AutoModelForCausalLM.from_pretrained(path, low_cpu_mem_usage=True).to(device).eval()
+
+
+class _CachedLM():
+    '''A causal LM with the cache of every token of a sequence but the last, which the next feed() passes in'''
+
+    def __init__(self, model, prompt):
+        self.model = model
+        self.layers = [(k[:, :, :-1], v[:, :, :-1]) for k, v in prompt.layers]
+        self.length = len(prompt) - 1
+
+    def feed(self, ids):
+        '''Runs ids through the model after the cached tokens and returns their next-token logits'''
+        device = self.model.device
+        positions = torch.arange(self.length, self.length + len(ids), device=device)
+        out = self.model(torch.tensor([ids], device=device), past_key_values=model_cache(self.layers),
+                         position_ids=positions[None], use_cache=True)
+        self.layers = list(legacy_cache(out.past_key_values))
+        self.length += len(ids)
+        return out.logits[0].float()
+
+    def crop(self, length):
+        if self.length > length:
+            self.layers = [(k[:, :, :length], v[:, :, :length]) for k, v in self.layers]
+            self.length = length
+
+
+def speculative_samples(model, draft_model, prompt_ids, n_samples, max_length, eos_token_id, n_draft=4,
+                        do_sample=True, temperature=1.0, top_k=0, repetition_penalty=1.0, desc="Generating",
+                        stats=None):
+    '''
+    Same samples as stream_samples (yielded one at a time), drawn with speculative decoding: draft_model proposes
+    n_draft tokens, and model scores all of them in one forward pass. Each draft token is accepted with probability
+    min(1, p/q) of the processed model (p) and draft (q) distributions, and the first rejected one is resampled from
+    max(0, p - q), so the samples follow exactly the distribution of model alone. With greedy decoding, draft tokens
+    are accepted while they match the model's choice. Logs the acceptance rate and tokens per model forward pass.
+    '''
+    target_prompt = prompt_ids if isinstance(prompt_ids, PromptCache) else PromptCache(model, prompt_ids)
+    draft_prompt = PromptCache(draft_model, target_prompt.ids[0])
+    vocab = target_prompt.logits.size(-1)
+    if draft_prompt.logits.size(-1) != vocab:
+        raise Exception(f"The draft model's vocabulary ({draft_prompt.logits.size(-1)} tokens) does not match the "
+                        f"model's ({vocab} tokens)")
+    prompt = target_prompt.ids[0].tolist()
+    max_new = max(1, int(max_length) - len(prompt))
+    device = target_prompt.ids.device
+    process = dict(do_sample=do_sample, temperature=temperature, top_k=top_k, repetition_penalty=repetition_penalty)
+    n_tokens, drafted, accepted, target_passes, start = 0, 0, 0, 0, time.time()
+
+    with torch.no_grad():
+        for i in tqdm(range(int(n_samples)), desc=desc):
+            seq, tokens, logprobs = list(prompt), [], []
+            target, draft = _CachedLM(model, target_prompt), _CachedLM(draft_model, draft_prompt)
+            seen = torch.zeros(1, vocab, dtype=torch.bool, device=device)
+            seen[0, target_prompt.ids[0]] = True
+            done = False
+            while not done:
+                # The draft proposes up to k tokens, stopping early at EOS
+                k = min(int(n_draft), max_new - len(tokens) - 1)
+                proposals, draft_probs, draft_seen = [], [], seen.clone()
+                if k > 0:
+                    logits = draft.feed(seq[draft.length:])[-1:]
+                for j in range(k):
+                    q = F.softmax(processed_logits(logits, draft_seen, **process), dim=-1)
+                    x = int(torch.multinomial(q, 1)) if do_sample else int(q.argmax())
+                    proposals.append(x)
+                    draft_probs.append(q[0])
+                    draft_seen[0, x] = True
+                    if x == eos_token_id:
+                        break
+                    if j < k - 1:
+                        logits = draft.feed([x])
+                drafted += len(proposals)
+
+                # The model scores the pending token and every proposal in one pass
+                pending = seq[target.length:]
+                target_logits = target.feed(pending + proposals)[len(pending) - 1:]
+                target_passes += 1
+                new = []
+                for j in range(len(proposals) + 1):
+                    p = F.softmax(processed_logits(target_logits[j:j + 1], seen, **process), dim=-1)[0]
+                    if j == len(proposals):
+                        x = int(torch.multinomial(p, 1)) if do_sample else int(p.argmax())
+                    else:
+                        x, q = proposals[j], draft_probs[j]
+                        keep = bool(torch.rand(()) * q[x] < p[x]) if do_sample else int(p.argmax()) == x
+                        if keep:
+                            accepted += 1
+                        elif do_sample:
+                            residual = (p - q).clamp(min=0)
+                            x = int(torch.multinomial(residual if residual.sum() > 0 else p, 1))
+                        else:
+                            x = int(p.argmax())
+                    new.append(x)
+                    seen[0, x] = True
+                    if x == eos_token_id or j == len(proposals) or not keep:
+                        break
+
+                raw = F.log_softmax(target_logits[:len(new)], dim=-1)
+                for j, x in enumerate(new):
+                    tokens.append(x)
+                    logprobs.append(float(raw[j, x]))
+                    if x == eos_token_id or len(tokens) >= max_new:
+                        done = True
+                        break
+                seq = prompt + tokens
+                target.crop(len(seq) - 1)
+                draft.crop(len(seq) - 1)
+            n_tokens += len(tokens)
+            yield i, tokens, logprobs
+
+    logger.info(f"Speculative decoding accepted {accepted}/{drafted} draft tokens "
+                f"({100 * accepted / max(drafted, 1):.1f}%), {n_tokens / max(target_passes, 1):.2f} tokens per model "
+                f"forward pass")
+    _report(n_samples, n_tokens, time.time() - start, stats)
+
+
+
+def log_speculative_speedup(model, prompt_ids, n_samples, batch_size, max_length, eos_token_id, speculative_stats,
+                            **sampling):
+    '''Draws n_samples without a draft model and logs how much faster the speculative run in speculative_stats was'''
+    stats = {}
+    for _ in stream_samples(model, prompt_ids, n_samples, batch_size, max_length, eos_token_id, stats=stats,
+                            desc="Benchmarking without a draft model", **sampling):
+        pass
+    speculative_rate = speculative_stats['tokens'] / max(speculative_stats['seconds'], 1e-9)
+    rate = stats['tokens'] / max(stats['seconds'], 1e-9)
+    logger.info(f"Speculative decoding: {speculative_rate:.1f} tokens/s against {rate:.1f} tokens/s without a draft "
+                f"model ({speculative_rate / rate:.2f}x)")
@@ -23,6 +23,7 @@ from typing import Sequence, Tuple, List
 import os
 from icecream import ic
 from esm.data import BatchConverter
+from trill.utils.download import download
 
 
 def load_structure(fpath, chain=None):
@@ -324,7 +325,7 @@ class CoordBatchConverter(BatchConverter):
             result_i[tuple(slice(0, k) for k in t.shape)] = t
         return result
 
-def download_ligmpnn_weights(directory):
+def download_ligmpnn_weights(directory, weights_dir=None):
     base_url = "https://files.ipd.uw.edu/pub/ligandmpnn/"
     file_names = [
         "ligandmpnn_v_32_005_25.pt",
@@ -345,14 +346,14 @@ def download_ligmpnn_weights(directory):
     ]
     
     # Create the directory if it does not exist
-    weights_dir = os.path.join(directory, "LigandMPNN_weights")
-    os.makedirs(weights_dir)
+    if weights_dir is None:
+        weights_dir = os.path.join(directory, "LigandMPNN_weights")
+    os.makedirs(weights_dir, exist_ok=True)
     
     # Download each file
     for file_name in file_names:
         file_path = os.path.join(weights_dir, file_name)
-        if not os.path.exists(file_path):  # Check if the file already exists before downloading
-            os.system(f"wget -q {base_url}{file_name} -O {file_path}")
+        download(f"{base_url}{file_name}", file_path)
 
     return
 
@@ -368,9 +369,6 @@ import argparse
 import time
 from pathlib import Path
 
-from urllib import request
-import shutil
-
 import numpy as np
 import torch
 import torch.nn as nn
@@ -505,26 +503,12 @@ def toCPU(tensor):
         return tensor.detach().cpu().numpy()
 
 
-def download_file(url, local_path):
-    # if not local_path.parent.is_dir():
-    #     local_path.parent.mkdir()
-
-    print("Downloading: {}".format(url))
-    req = request.Request(url, headers={
-        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)'
-    })
-
-    with request.urlopen(req) as response, open(local_path, 'wb') as outfile:
-        shutil.copyfileobj(response, outfile)
-    return None
-
-
 def load_predictor(cache_dir, weights_link="https://github.com/mheinzinger/ProstT5/raw/main/cnn_chkpnt/model.pt"):
     model = CNN()
     checkpoint_p = os.path.join(cache_dir, "model.pt")
     # if no pre-trained model is available, yet --> download it
     if not os.path.exists(checkpoint_p):
-        download_file(weights_link, checkpoint_p)
+        checkpoint_p = download(weights_link, checkpoint_p)
 
     # Torch load will map back to device from state, which often is GPU:0.
     # to overcome, need to explicitly map to active device
@@ -12,10 +12,11 @@ from pytorch_lightning.callbacks import BasePredictionWriter
 from torch.utils.data import Dataset
 from tqdm import trange
 from loguru import logger
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM, DataCollatorForLanguageModeling, T5EncoderModel, \
+from transformers import AutoTokenizer, AutoModelForCausalLM, DataCollatorForLanguageModeling, T5EncoderModel, \
     T5Tokenizer, AutoModelForSeq2SeqLM
 
-from .esm_utils import Alphabet
+from .esm_utils import Alphabet, save_esmfold_lm_states, pseudo_log_likelihoods, ESMFOLD_STATES_DIR
+from .generation_utils import PromptCache, perplexity, speculative_samples, stream_samples
 from .mask import maskInputs
 
 ESM_ALLOWED_AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
@@ -41,6 +42,9 @@ class ESM(pl.LightningModule):
         if args.command == 'embed' or args.command == 'dock':
             self.per_AA = args.per_AA
             self.avg = args.avg
+        self.esmfold_states_dir = None
+        if getattr(args, 'esmfold_states', False):
+            self.esmfold_states_dir = ESMFOLD_STATES_DIR
 
     def training_step(self, batch, batch_idx):
         torch.cuda.empty_cache()
@@ -71,8 +75,14 @@ class ESM(pl.LightningModule):
     
     def predict_step(self, batch, batch_idx):
         labels, seqs, toks = batch
-        pred = self.esm(toks, repr_layers=self.repr_layers, return_contacts=False)
-        representations = {layer: t.to(device="cpu") for layer, t in pred["representations"].items()}
+        if self.esmfold_states_dir:
+            # ESMFold combines the hidden states of every layer, not just the last one
+            all_layers = list(range(self.esm.num_layers + 1))
+            pred = self.esm(toks, repr_layers=all_layers, return_contacts=False)
+            save_esmfold_lm_states(self.esmfold_states_dir, seqs, pred["representations"])
+        else:
+            pred = self.esm(toks, repr_layers=self.repr_layers, return_contacts=False)
+        representations = {layer: t.to(device="cpu") for layer, t in pred["representations"].items() if layer in self.repr_layers}
         rep_numpy = representations[self.repr_layers[0]].cpu().detach().numpy()[:, 1:-1, :]
         aa_reps = []
         avg_reps = []
@@ -138,11 +148,23 @@ class ProtGPT2(pl.LightningModule):
             optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr)
         return optimizer
     
+    def stream_generate(self, seed_seq = "M", n_samples = 1, batch_size = 1, max_length = 100, do_sample = True, temperature = 1.0, top_k = 950, repetition_penalty = 1.2, eos_token_id=0, draft_model=None, n_draft=4, stats=None):
+        """
+        Yields (sample index, sequence) as samples finish, see generation_utils.stream_samples. With a draft_model,
+        samples are drawn one at a time with speculative decoding instead.
+        """
+        prompt_ids = self.tokenizer(seed_seq, return_tensors='pt')['input_ids'][0]
+        sampling = dict(do_sample=do_sample, temperature=temperature, top_k=top_k, repetition_penalty=repetition_penalty, stats=stats)
+        if draft_model is not None:
+            samples = speculative_samples(self.model, draft_model, prompt_ids, n_samples, max_length, eos_token_id, n_draft=n_draft, **sampling)
+        else:
+            samples = stream_samples(self.model, prompt_ids, n_samples, batch_size, max_length, eos_token_id, **sampling)
+        for i, tokens, _ in samples:
+            yield i, self.tokenizer.decode(prompt_ids.tolist() + tokens, skip_special_tokens=True).replace('\n', '')
+
     def generate(self, seed_seq = "M", max_length = 100, do_sample = True, temperature = 1.0, top_k = 950, repetition_penalty = 1.2, num_return_sequences = 1, eos_token_id=0):
-        generator = pipeline('text-generation', model = self.model, tokenizer=self.tokenizer, device_map='auto')
-        outseqs = generator(seed_seq, max_length=max_length, temperature = temperature, do_sample =do_sample, top_k=top_k, repetition_penalty=repetition_penalty, num_return_sequences=num_return_sequences, pad_token_id=eos_token_id, eos_token_id=eos_token_id)
-        outseqs = [samp['generated_text'].replace('\n','') for samp in outseqs]
-        return outseqs
+        outseqs = dict(self.stream_generate(seed_seq, num_return_sequences, num_return_sequences, max_length, do_sample, temperature, top_k, repetition_penalty, eos_token_id))
+        return [outseqs[i] for i in range(num_return_sequences)]
 
 class ESM_Gibbs(pl.LightningModule):
     """adapted from bert-gen bert-babble.ipynb"""
@@ -162,44 +184,29 @@ class ESM_Gibbs(pl.LightningModule):
 
 
     
-    def generate_step(self, out, gen_idx, temperature=None, top_k=0, valid_idx=None):
-        """ Generate a word from from out[gen_idx]
-        
+    def gibbs_step(self, logits, batch, targets, temperature=None, top_k=0, valid_idx=None):
+        """ Samples new amino acids for the target positions of every sequence in batch at once, in place
+
         args:
-            - out (torch.Tensor): tensor of logits of size seq_len x vocab_size
-            - gen_idx (int): location for which to generate for
-            - top_k (int): if >0, only sample from the top k most probable words
-            - sample (Bool): if True, sample from full distribution. Otherwise sample from top_k amino acids
-            - valid_idx (list): list of valid indexes to return. If none, all indexes are valid
-        returns:
-            tensor containing the selected amino acid index
+            - logits (torch.Tensor): tensor of logits of size batch_size x seq_len x vocab_size
+            - batch (torch.Tensor): tokens of size batch_size x seq_len, updated in place
+            - targets (torch.Tensor): positions to sample for each sequence, of size batch_size x n_positions
+            - top_k (int): if >0, only sample from the top k most probable AAs
+            - valid_idx (torch.Tensor): indexes of the tokens that may be sampled. If none, all indexes are valid
         """
-        #TODO: repetition penalty.
-        #TODO: this could be vectorized a lot better, but I think this isn't the rate limiting step (inferrence is), so it probably doesn't matter.
-
-        logits = out[gen_idx] # 1 x vocab_size
+        logits = logits.gather(1, targets[..., None].expand(-1, -1, logits.size(-1)))
         if temperature is not None:
             logits = logits / temperature
-
-        if valid_idx is None:
-            valid_idx = list(range(len(logits)))
-
-        sub_logits = logits[valid_idx]
-
-        if(top_k <= 0) or (top_k > len(sub_logits)):
-            # If sample is true, that means we are forcing sampling from the whole distribution.
-            # If top_k is 0 that means we want to sample from the whole distribution.
-            top_k = len(sub_logits)
-        else:
-            # top_k is in bounds and we aren't forcing full sampling, so just keep it as it is.
-            top_k = top_k
-
-        kth_vals, kth_idx = sub_logits.topk(top_k)  # kth_vals is the logits, kth_idx is the indexes at which the logits are found.
-        dist = torch.distributions.categorical.Categorical(logits=kth_vals)
-
-        idx = kth_idx[dist.sample()]
-
-        return torch.tensor(valid_idx[idx])
+        if valid_idx is not None:
+            logits = logits[..., valid_idx]
+        if 0 < top_k < logits.size(-1):
+            top = logits.topk(top_k, dim=-1).indices
+            logits = logits.masked_fill(~torch.zeros_like(logits, dtype=torch.bool).scatter_(-1, top, True), float('-inf'))
+        probs = F.softmax(logits.float(), dim=-1)
+        sampled = torch.multinomial(probs.view(-1, probs.size(-1)), 1).view(targets.shape)
+        if valid_idx is not None:
+            sampled = valid_idx[sampled]
+        batch.scatter_(1, targets, sampled)
     
     def untokenize_batch(self, batch, bos, eos): #TODO: maybe should be moved to the model class, or a model superclass?
         #convert tokens to AAs, but skip the first one, because that one is <cls>
@@ -243,7 +250,8 @@ class ESM_Gibbs(pl.LightningModule):
         return tokens
 
     def generate(self, seed_seq, n_samples = 1, batch_size=1, in_order=True, max_len=None, leader_length=0, leader_length_percent=None, top_k=0, temperature=None, num_iters=10,  burnin=float('inf'),
-                            mask=True, num_positions=0, num_positions_percent=None, indexes=None, rollover_from_start=False, show_progress_bar=True):
+                            mask=True, num_positions=0, num_positions_percent=None, indexes=None, rollover_from_start=False, show_progress_bar=True,
+                            schedule=None, dilation=3, num_steps=10, stats=None):
         """ generate sequences
 
             n_samples: number of sequences to output
@@ -264,6 +272,12 @@ class ESM_Gibbs(pl.LightningModule):
 
             show_progress_bar: if True then show a progress bar corresponding to the number of batches that need to be processed. Default: True.
 
+            schedule: order in which the masked positions are filled, replacing in_order/num_positions. None keeps those, otherwise one of
+                - 'dilated': fill positions i, i+dilation, i+2*dilation, ... together, so the protein takes dilation steps.
+                - 'blocked': fill random subsets in num_steps steps, with block sizes annealed from large to small.
+                - 'entropy': fill the masked positions the model is most confident about (lowest entropy) first, in num_steps steps.
+            stats: if a dict, the number of forward passes is added to stats['forward_passes'], and the number of sequences they ran to stats['forward_rows'].
+
             #### Examples #####
             seed = "MTSENPLLALREKISALDEKLLALLAERRELAVEVGKAKLLSHRPVRDIDRERDLLERLITLGKAHHLDAHYITRLFQLIIEDSVLTQQALLQQH"
 
@@ -286,8 +300,12 @@ class ESM_Gibbs(pl.LightningModule):
                 out = sampler.generate(1, seed_seq=seed, batch_size=1, max_len=product_length, in_order=True, top_k=0, leader_length=len(seed), num_positions=product_length-len(seed), num_iters=1, mask=True)
         """
 
+        if schedule == 'dilated' and dilation < 1:
+            raise ValueError(f"dilation must be at least 1, got {dilation}")
+        if schedule in ('blocked', 'entropy') and num_steps < 1:
+            raise ValueError(f"num_steps must be at least 1, got {num_steps}")
+
         #TODO: repetition penalty, somehow?
-        #TODO: add dilated sequential sampling, like sampling every third or fifth amino acid and then doing the whole protein in like 3 or 5 steps, or something like that.
         with torch.no_grad(): # I'm not sure if this no_grad is necessary or not, but it couldn't hurt!
             if isinstance(seed_seq, str):
                 sequence_length = len(seed_seq)
@@ -313,48 +331,71 @@ class ESM_Gibbs(pl.LightningModule):
             if leader_length < 0:
                 leader_length = 0
 
+            # Chains stay on the model's device, and each iteration samples every target position of every chain at once
+            device = next(self.model.parameters()).device
+            valid_idx = torch.tensor(self.valid_aa_idx, device=device)
             for batch_n in trange(n_batches, disable=(not show_progress_bar)):
 
-                batch = self.get_init_seq(seed_seq, max_len, batch_size)
-                # batch = batch.cuda() if cuda else batch
+                batch = self.get_init_seq(seed_seq, max_len, batch_size).to(device)
 
                 indexes, last_i = self.calculate_indexes(indexes, leader_length, max_len, rollover_from_start)
+                index_tensor = torch.tensor(list(indexes), device=device)
 
                 if num_positions > len(indexes):
                     num_positions = len(indexes)
-
-                flag = True
-                while flag == True:
-                # for ii in range(num_iters):
-                    if 32 not in batch:
-                        flag = False
-                        break
-                    if num_positions > 0: #do some subset of positions
+                strides = [index_tensor[offset::dilation] for offset in range(min(dilation, len(index_tensor)))]
+
+                step = 0
+                while (batch == self.alphabet.mask_idx).any():
+                    out = None
+                    if schedule in ('blocked', 'entropy'):
+                        # Blocks are picked among the still masked positions of each chain, list seeds of different
+                        # lengths leave chains with different numbers of them
+                        masked = batch == self.alphabet.mask_idx
+                        n_masked = masked.sum(1)
+                        steps_left = max(num_steps - step, 1)
+                        out = self.model(batch)["logits"]
+                        if schedule == 'blocked':
+                            # Block sizes decrease linearly over the remaining steps and sum up to n_masked
+                            block = torch.minimum(n_masked, (2 * n_masked / (steps_left + 1)).round().long().clamp(min=1))
+                            scores = torch.rand(masked.shape, device=device)
+                        else:
+                            block = torch.div(n_masked + steps_left - 1, steps_left, rounding_mode='floor')
+                            logits = out[..., valid_idx].float()
+                            if temperature is not None:
+                                logits = logits / temperature
+                            # negative entropy, so the most confident positions score highest
+                            scores = (F.softmax(logits, -1) * F.log_softmax(logits, -1)).sum(-1)
+                        targets = scores.masked_fill(~masked, float('-inf')).topk(int(block.max()), dim=1).indices
+                        # Chains with smaller blocks repeat their best target instead of taking unmasked positions,
+                        # and chains that are already complete are left alone
+                        keep = torch.arange(targets.size(1), device=device) < block[:, None]
+                        targets = torch.where(keep, targets, targets[:, :1])
+                        active = n_masked > 0
+                        chains = batch[active]
+                        self.gibbs_step(out[active], chains, targets[active], top_k=top_k, temperature=temperature, valid_idx=valid_idx)
+                        batch[active] = chains
+                    elif schedule == 'dilated':
+                        targets = strides[step % len(strides)].expand(batch_size, -1)
+                    elif num_positions > 0: #do some subset of positions
                         if in_order: #cycle through the indexes
-                            next_i = last_i
-                            last_i, target_indexes = self.get_target_index_in_order(batch_size, indexes, next_i,
-                                                                                    num_positions)
+                            last_i, targets = self.get_target_index_in_order(batch_size, index_tensor, last_i, num_positions)
                         else:
-                            target_indexes = self.get_random_target_index(batch_size, indexes, num_positions)
+                            targets = self.get_random_target_index(batch_size, index_tensor, num_positions)
                     else:
-                        target_indexes = [indexes] * batch_size
-
-                    if mask:
-                        self.mask_target_indexes(batch, target_indexes)
-                    if self.GPUs != 0:
-                        batch = batch.cuda()
-                    out = self.model(batch)["logits"]
-
-                    for batch_index in range(batch_size):
-                        for kk in target_indexes[batch_index]:
-                            idx = self.generate_step(out[batch_index],
-                                                gen_idx=kk,
-                                                top_k=top_k,
-                                                temperature=temperature,
-                                                valid_idx=self.valid_aa_idx)
-
-                            batch[batch_index][kk] = idx
-
+                        targets = index_tensor.expand(batch_size, -1)
+
+                    if out is None:
+                        if mask:
+                            batch.scatter_(1, targets, self.alphabet.mask_idx)
+                        out = self.model(batch)["logits"]
+                        self.gibbs_step(out, batch, targets, top_k=top_k, temperature=temperature, valid_idx=valid_idx)
+                    if stats is not None:
+                        stats['forward_passes'] = stats.get('forward_passes', 0) + 1
+                        stats['forward_rows'] = stats.get('forward_rows', 0) + batch_size
+                    step += 1
+
+                batch = batch.tolist()
                 if batch_n == (n_batches - 1): #last batch, so maybe don't take all of them, just take enough to get to n_samples
                     sequences += self.untokenize_batch(batch, self.alphabet.prepend_bos, self.alphabet.append_eos)[0:n_samples - len(sequences)]
                 else:
@@ -362,26 +403,15 @@ class ESM_Gibbs(pl.LightningModule):
             return sequences
 
     def get_random_target_index(self, batch_size, indexes, num_positions):
-        target_indexes = list()
-        for b in range(batch_size):
-            target_indexes.append(random.sample(indexes, num_positions))
-        return target_indexes
+        """num_positions distinct positions out of indexes for each sequence, as a batch_size x num_positions tensor"""
+        order = torch.rand(batch_size, len(indexes), device=indexes.device).argsort(dim=1)
+        return indexes[order[:, :num_positions]]
 
     def get_target_index_in_order(self, batch_size, indexes, next_i, num_positions):
-        sampled = 0
-        target_indexes = list()
-        while sampled < num_positions:
-            sampled += 1
-            next_i = (next_i + 1) % len(indexes)
-            target_indexes.append(indexes[next_i])
-        target_indexes = [target_indexes] * batch_size
-        last_i = next_i
-        return last_i, target_indexes
-
-    def mask_target_indexes(self, batch, target_indexes):
-        for batch_index in range(len(target_indexes)):
-            for kk in target_indexes[batch_index]:
-                batch[batch_index][kk] = self.alphabet.mask_idx
+        """The num_positions indexes after next_i, wrapping around, for every sequence"""
+        positions = (next_i + 1 + torch.arange(num_positions, device=indexes.device)) % len(indexes)
+        last_i = int(positions[-1])
+        return last_i, indexes[positions].expand(batch_size, -1)
 
     def calculate_indexes(self, indexes, leader_length, max_len, rollover_from_start):
         if indexes is None:
@@ -423,14 +453,20 @@ class ESM_Gibbs(pl.LightningModule):
         return next(self.log_likelihood_batch([seq], with_masking, verbose, mask_distance, batch_size))
 
     #TODO: convert to iterator
-    def log_likelihood_batch(self, seq_list, with_masking=True, verbose=False, mask_distance=float("inf"), batch_size=None):
-
-        # TODO: Allow batching to calculate likelihoods for multiple sequences at a time (how does padding effect likelihoods for sequences shorter than the longest sequence, hopefully not at all).
+    def log_likelihood_batch(self, seq_list, with_masking=True, verbose=False, mask_distance=float("inf"), batch_size=None, batched=True, toks_per_batch=None, stats=None):
+        """
+            batched: if True, the masked copies of all sequences are scored together by esm_utils.pseudo_log_likelihoods, in batches of batch_size copies.
+                     if False, every sequence is scored on its own, position by position.
+            toks_per_batch: if not None, batched copies are packed into batches of at most this many tokens instead.
+            stats: if a dict, the batched forward passes and masked copies are counted in it, see esm_utils.masked_log_probs.
+        """
 
         # Inspired by and borrowing code from:
         # https://github.com/facebookresearch/esm/blob/master/variant-prediction/predict.py
 
         n_batches = len(seq_list)
+        if toks_per_batch is None and batch_size is None:
+            toks_per_batch = 16384
         if batch_size is None:
             batch_size = n_batches
 
@@ -449,6 +485,17 @@ class ESM_Gibbs(pl.LightningModule):
             assert len(seq_list[b_idx]) == len(range(range_start, batch_range_end[b_idx]))
 
         # tokens = tokens.cuda() if self.cuda else tokens
+        if with_masking and batched:
+            tokens = tokens.to(next(self.model.parameters()).device)
+            logprobs, scored = pseudo_log_likelihoods(self.model, self.alphabet, tokens,
+                                                      mask_distance=None if mask_distance == float("inf") else mask_distance,
+                                                      toks_per_batch=toks_per_batch or batch_size * tokens.shape[1],
+                                                      stats=stats)
+            for seq_logprobs, seq_scored in zip(logprobs, scored):
+                seq_logprobs = seq_logprobs[seq_scored]
+                yield (float(seq_logprobs.mean()), seq_logprobs.tolist())
+            return
+
         with torch.no_grad():
             if with_masking:
                 old_toks = tokens.clone().detach()
@@ -626,23 +673,28 @@ class ZymCTRL(pl.LightningModule):
             optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr)
         return optimizer
     
-    def generator(self, tag, seed_seq = "", max_length = 100, do_sample = True, temperature = 1.0, top_k = 9, repetition_penalty = 1.2, num_return_sequences = 1, eos_token_id=1, pad_token_id=0, device = 'cpu'):
-        tokenized_tag = self.tokenizer.encode(tag, return_tensors='pt').to(device)
-        out = self.model.generate(tokenized_tag.to(device), top_k=top_k, temperature = temperature, repetition_penalty=repetition_penalty,max_length=max_length,eos_token_id=1,pad_token_id=0,do_sample=do_sample,num_return_sequences=1)
-        out = out.squeeze(0)
-        ppls = [(self.tokenizer.decode(output), self.calculatePerplexity(output)) for output in out.unsqueeze(0)]
-        
-        sequence_ppl = [(self.remove_characters(x[0], self.special_tokens), x[1]) for x in ppls]
-        return sequence_ppl
+    def generator(self, tag, seed_seq = "", max_length = 100, do_sample = True, temperature = 1.0, top_k = 9, repetition_penalty = 1.2, num_return_sequences = 1, eos_token_id=1, pad_token_id=0, device = None):
+        if device is not None:
+            logger.warning("ZymCTRL.generator's device argument is deprecated and ignored, proteins are generated on the model's device")
+        samples = sorted(self.stream_generate(tag, num_return_sequences, num_return_sequences, max_length, do_sample, temperature, top_k, repetition_penalty, eos_token_id, pad_token_id))
+        return [(sequence, ppl) for _, sequence, ppl in samples]
+
+    def stream_generate(self, tag, n_samples = 1, batch_size = 1, max_length = 100, do_sample = True, temperature = 1.0, top_k = 9, repetition_penalty = 1.2, eos_token_id=1, pad_token_id=0, draft_model=None, n_draft=4, stats=None):
+        """
+        Yields (sample index, sequence, perplexity) as samples of EC tag finish, batch_size at a time (see
+        generation_utils.stream_samples), or one at a time with speculative decoding given a draft_model. Perplexities
+        come from the log-probabilities of the sampling pass, so scoring needs no extra forward pass.
+        """
+        prompt = PromptCache(self.model, self.tokenizer.encode(tag, return_tensors='pt')[0])
+        sampling = dict(do_sample=do_sample, temperature=temperature, top_k=top_k, repetition_penalty=repetition_penalty, stats=stats, desc=f"Generating {tag}")
+        if draft_model is not None:
+            samples = speculative_samples(self.model, draft_model, prompt, n_samples, max_length, eos_token_id, n_draft=n_draft, **sampling)
+        else:
+            samples = stream_samples(self.model, prompt, n_samples, batch_size, max_length, eos_token_id, pad_token_id=pad_token_id, **sampling)
+        for i, tokens, logprobs in samples:
+            sequence = self.remove_characters(self.tokenizer.decode(prompt.ids[0].tolist() + tokens), self.special_tokens)
+            yield i, sequence, perplexity(prompt, logprobs)
 
-    
-    def calculatePerplexity(self, input_ids):
-        "This function computes perplexities for the generated sequences. Got this from https://huggingface.co/nferruz/ZymCTRL"
-        with torch.no_grad():
-            outputs = self.model(input_ids, labels=input_ids)
-        loss, logits = outputs[:2]
-        return math.exp(loss)
-    
     def remove_characters(self, sequence, char_list):
         "This function removes special tokens used during training. Got this from https://huggingface.co/nferruz/ZymCTRL"
         columns = sequence.split('<sep>')
@@ -6,9 +6,13 @@ import os
 import lightgbm as lgb
 from lightgbm import LGBMRegressor
 from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LinearRegression
+from sklearn.linear_model import LinearRegression, Ridge
 from sklearn.metrics import root_mean_squared_error, r2_score
 import skops.io as sio
+from tqdm import tqdm
+from trill.utils.batch_inference import predict_in_chunks
+from trill.utils.embedding_store import load_embeddings
+from trill.utils.sweep_utils import run_sweep
 
 def prep_reg_data(df, args):
     if args.train_split is not None:
@@ -49,6 +53,122 @@ def train_reg_model(train_df, args):
     
     return clf
 
+def sweep_reg(train_df, args):
+    logger.info(f"Setting up hyperparameter sweep for {args.regressor} using {args.n_workers} CPU cores")
+    clf = run_sweep(args.regressor, 'regression', train_df.iloc[:, :-2], train_df['Score'], args)
+    logger.info("Sweep Complete! Now evaluating...")
+    return clf
+
+class StreamingLinearRegression():
+    '''
+    Least squares (or ridge, with alpha > 0) fit from sufficient statistics accumulated chunk by chunk, so the
+    embeddings never have to be in memory at once. Each chunk is centered on its own mean and merged into the
+    running scatter matrices (Chan et al.), which keeps float32 chunk products accurate.
+    '''
+    def __init__(self, n_features, n_targets, alpha=0.0):
+        self.alpha = float(alpha)
+        self.n = 0
+        self.mean_x = np.zeros(n_features)
+        self.mean_y = np.zeros(n_targets)
+        self.sxx = np.zeros((n_features, n_features))
+        self.sxy = np.zeros((n_features, n_targets))
+
+    def partial_fit(self, X, y):
+        X = np.asarray(X, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float64).reshape(len(X), -1)
+        n_b = len(X)
+        if n_b == 0:
+            return self
+        mean_xb = X.mean(axis=0, dtype=np.float64)
+        mean_yb = y.mean(axis=0)
+        Xc = X - mean_xb.astype(np.float32)
+        yc = (y - mean_yb).astype(np.float32)
+        n = self.n + n_b
+        dx, dy = mean_xb - self.mean_x, mean_yb - self.mean_y
+        self.sxx += Xc.T @ Xc + np.outer(dx, dx) * (self.n * n_b / n)
+        self.sxy += Xc.T @ yc + np.outer(dx, dy) * (self.n * n_b / n)
+        self.mean_x += dx * (n_b / n)
+        self.mean_y += dy * (n_b / n)
+        self.n = n
+        return self
+
+    def solve(self):
+        '''Returns the fitted model as a scikit-learn LinearRegression/Ridge, so it saves and predicts like one'''
+        if self.alpha > 0:
+            coef = np.linalg.solve(self.sxx + self.alpha * np.eye(len(self.sxx)), self.sxy)
+        else:
+            coef = np.linalg.lstsq(self.sxx, self.sxy, rcond=None)[0]
+        intercept = self.mean_y - self.mean_x @ coef
+        model = Ridge(alpha=self.alpha) if self.alpha > 0 else LinearRegression()
+        if coef.shape[1] == 1:
+            model.coef_, model.intercept_ = coef[:, 0], float(intercept[0])
+        else:
+            model.coef_, model.intercept_ = coef.T, intercept
+        model.n_features_in_ = len(coef)
+        # Named like the columns of TRILL embedding CSVs and iter_embedding_chunks() blocks, which it predicts on
+        model.feature_names_in_ = np.array([str(i) for i in range(len(coef))], dtype=object)
+        return model
+
+def read_reg_targets(key_path):
+    '''Reads a value key CSV (Label column, then one column per target) into a label -> row map and a target matrix'''
+    key_df = pd.read_csv(key_path)
+    label_col = 'Label' if 'Label' in key_df.columns else key_df.columns[0]
+    targets = key_df.drop(columns=label_col)
+    index = {str(label).strip(): i for i, label in enumerate(key_df[label_col])}
+    return index, targets.to_numpy(dtype=np.float64), list(targets.columns)
+
+def _iter_chunks(X, rows, chunk_rows):
+    for start in range(0, len(X), chunk_rows):
+        stop = min(start + chunk_rows, len(X))
+        selected = np.flatnonzero(rows[start:stop])
+        if len(selected):
+            yield start + selected, np.asarray(X[start:stop])[selected]
+
+def train_streaming_linear(emb_path, args):
+    '''
+    Fits regress Linear out of core from an embedding store (or CSV) in two streaming passes over the
+    embeddings: one accumulating the normal equations of the training rows, one scoring the test rows.
+    Returns the fitted model, R² and RMSE (averaged over targets).
+    '''
+    if args.key == None:
+        logger.error('Training a regressor requires a value key CSV!')
+        raise Exception('Training a regressor requires a value key CSV!')
+    X, labels = load_embeddings(emb_path)
+    index, targets, target_names = read_reg_targets(args.key)
+    target_rows = np.array([index.get(str(label).strip(), -1) for label in labels])
+    labeled = target_rows >= 0
+    if not labeled.all():
+        logger.warning(f"{(~labeled).sum()} embeddings have no value in {args.key} and are skipped")
+    is_train = np.random.default_rng(int(args.RNG_seed)).random(len(labels)) < float(args.train_split)
+    chunk_rows = int(args.chunk_rows)
+
+    logger.info(f"Fitting {'ridge' if float(args.ridge_alpha) > 0 else 'linear'} regression on "
+                f"{(is_train & labeled).sum()} embeddings, {chunk_rows} rows at a time, for targets {target_names}")
+    reg = StreamingLinearRegression(X.shape[1], targets.shape[1], alpha=args.ridge_alpha)
+    for rows, X_chunk in tqdm(_iter_chunks(X, is_train & labeled, chunk_rows), desc="Fitting"):
+        reg.partial_fit(X_chunk, targets[target_rows[rows]])
+    model = reg.solve()
+
+    n, sse, sum_y, sum_y2 = 0, 0.0, 0.0, 0.0
+    y_min, y_max = np.inf, -np.inf
+    for rows, X_chunk in tqdm(_iter_chunks(X, ~is_train & labeled, chunk_rows), desc="Evaluating"):
+        y = targets[target_rows[rows]]
+        preds = model.predict(pd.DataFrame(X_chunk, columns=model.feature_names_in_)).reshape(len(y), -1)
+        n += len(y)
+        sse = sse + ((y - preds) ** 2).sum(axis=0)
+        sum_y = sum_y + y.sum(axis=0)
+        sum_y2 = sum_y2 + (y ** 2).sum(axis=0)
+        y_min, y_max = np.minimum(y_min, y.min(axis=0)), np.maximum(y_max, y.max(axis=0))
+    if n == 0:
+        logger.warning("No test embeddings to evaluate on!")
+        return model, None, None
+    # Like r2_score, a constant target scores 1 if it is predicted exactly and 0 otherwise
+    constant = y_min == y_max
+    sst = np.where(constant, 1.0, sum_y2 - sum_y ** 2 / n)
+    r2 = float(np.mean(np.where(constant, (sse == 0).astype(float), 1 - sse / sst)))
+    rmse = float(np.mean(np.sqrt(sse / n)))
+    return model, r2, rmse
+
 def load_reg_model(args):
     # Check the model type and load accordingly
     if args.regressor == 'Linear':
@@ -73,20 +193,27 @@ def predict_and_evaluate_reg(model, test_df, args):
 
     return r2, rmse
 
-def custom_model_reg_test(model, test_df, args):
-    # Generate probability predictions based on the model type
+def custom_model_reg_test(model, emb_path, args):
+    # Generate predictions based on the model type, a chunk of embeddings at a time
     model_type = args.regressor
-    if model_type == 'Linear':
-        test_preds = model.predict(test_df.iloc[:, :-1])
-    elif model_type == 'LightGBM':
-        test_preds = model.predict(test_df.iloc[:, :-1])
-    
-    # Prepare and save the predictions to a CSV file
-    pred_df = pd.DataFrame(test_preds, columns=['Prediction'])
-    pred_df['Label'] = test_df['Label']
-    
+    n_threads = 1 if int(args.n_workers) > 1 else 0
+
+    def predict(features, labels):
+        if model_type == 'Linear':
+            test_preds = model.predict(features)
+        elif model_type == 'LightGBM':
+            test_preds = model.predict(features, num_threads=n_threads)
+        if test_preds.ndim == 2:
+            pred_df = pd.DataFrame(test_preds, columns=[f'Prediction_{i}' for i in range(test_preds.shape[1])])
+        else:
+            pred_df = pd.DataFrame(test_preds, columns=['Prediction'])
+        pred_df['Label'] = labels
+        return [pred_df]
+
+    # Save the predictions to a CSV file as they are computed
     pred_file_name = f'{args.name}_{model_type}_predictions.csv'
-    pred_df.to_csv(os.path.join(args.outdir, pred_file_name), index=False)
+    predict_in_chunks(emb_path, predict, [os.path.join(args.outdir, pred_file_name)], n_workers=args.n_workers,
+                      chunk_rows=args.chunk_rows)
 
     return
 
@@ -1,14 +1,13 @@
 import os
 from loguru import logger
-import requests
+from trill.utils.download import download
 
 
 def rfaa_setup(args, cache_dir):
     base_url = "http://files.ipd.uw.edu/pub/RF-All-Atom/weights/RFAA_paper_weights.pt"
     weights_path = f'{cache_dir}/RFAA/RFAA_paper_weights.pt'
     if not os.path.exists(weights_path):
-        r = requests.get(base_url)
         logger.info('Downloading RFAA weights...')
-        with open(weights_path, "wb") as file:
-            file.write(r.content)
+        weights_path = download(base_url, weights_path)
         logger.info('Finished downloading RFAA weights!')
+    return weights_path
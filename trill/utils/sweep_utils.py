@@ -0,0 +1,262 @@
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from loguru import logger
+from sklearn.metrics import f1_score, r2_score
+from sklearn.model_selection import KFold, StratifiedKFold
+
+# Hyperparameter sweeps for the XGBoost/LightGBM models of classify and regress.
+# Every cross-validation fold is binned once (QuantileDMatrix / constructed lgb.Dataset) and shared by all
+# candidates. Candidates are scheduled with ASHA: each one is trained for a few boosting rounds, and only the best
+# 1/ETA of every rung is promoted and keeps boosting (continuing its boosters, not restarting) up to MAX_ROUNDS.
+# Trials run in parallel threads, as both libraries release the GIL while boosting. Every finished (trial, rung) is
+# appended to a CSV, from which an interrupted sweep with the same model, seed and number of folds can be resumed.
+
+SEARCH_SPACES = {
+    'LightGBM': {
+        'learning_rate': ('real', 0.01, 0.3),
+        'num_leaves': ('int', 10, 255),
+        'max_depth': ('int', -1, 20),
+        'feature_fraction': ('real', 0.1, 1.0),
+        'bagging_fraction': ('real', 0.1, 1.0),
+        'bagging_freq': ('int', 0, 10),
+    },
+    'XGBoost': {
+        'gamma': ('real', 0, 5),
+        'learning_rate': ('real', 0.01, 0.3),
+        'max_depth': ('int', 5, 20),
+        'reg_alpha': ('real', 0, 1),
+        'reg_lambda': ('real', 0, 1),
+        'subsample': ('real', 0.5, 1.0),
+        'colsample_bytree': ('real', 0.5, 1.0),
+        'min_child_weight': ('int', 1, 10),
+    },
+}
+MAX_ROUNDS = 250
+ETA = 3
+N_RUNGS = 3
+
+
+def rung_rounds(max_rounds=MAX_ROUNDS, eta=ETA, n_rungs=N_RUNGS):
+    return [max(1, int(round(max_rounds / eta ** (n_rungs - 1 - i)))) for i in range(n_rungs)]
+
+
+def sample_params(space, seed, trial):
+    '''Draws the parameters of a trial. They only depend on (seed, trial), so a resumed sweep draws the same ones'''
+    rng = np.random.default_rng([int(seed), trial])
+    params = {}
+    for name, (kind, low, high) in space.items():
+        if kind == 'real':
+            params[name] = float(rng.uniform(low, high))
+        else:
+            params[name] = int(rng.integers(low, high + 1))
+    return params
+
+
+class SweepResult():
+    '''Best candidate of a sweep, refit on the whole training set. Has the attributes TRILL reads from BayesSearchCV'''
+
+    def __init__(self, best_estimator, best_params, best_score):
+        self.best_estimator_ = best_estimator
+        self.best_params_ = best_params
+        self.best_score_ = best_score
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+class _Trial():
+    def __init__(self, params):
+        self.params = params
+        self.boosters = {}
+        self.rounds = 0
+
+
+class BoostingSweep():
+    '''
+    ASHA sweep of model ('XGBoost' or 'LightGBM') for task ('classification' or 'regression').
+    Candidates are scored by F1 (averaged with f1_avg_method) or R², higher is better.
+    '''
+
+    def __init__(self, model, task, X, y, cv, seed, n_classes=None, f1_avg_method='macro'):
+        self.model = model
+        self.task = task
+        self.seed = int(seed)
+        self.cv = int(cv)
+        self.n_classes = n_classes
+        self.f1_avg_method = f1_avg_method
+        self.space = SEARCH_SPACES[model]
+        self.rungs = rung_rounds()
+        self._booster_lock = threading.Lock()
+
+        X = np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+        y = np.asarray(y)
+        if task == 'classification':
+            splitter = StratifiedKFold(n_splits=int(cv), shuffle=True, random_state=self.seed)
+        else:
+            splitter = KFold(n_splits=int(cv), shuffle=True, random_state=self.seed)
+        start = time.time()
+        self.folds = []
+        for train_idx, valid_idx in splitter.split(X, y):
+            if model == 'XGBoost':
+                train_set = xgb.QuantileDMatrix(X[train_idx], label=y[train_idx])
+            else:
+                train_set = lgb.Dataset(X[train_idx], label=y[train_idx], params={'verbosity': -1}).construct()
+            self.folds.append((train_set, X[valid_idx], y[valid_idx]))
+        logger.info(f"Binned {len(self.folds)} cross-validation folds in {time.time() - start:.2f}s")
+
+    def booster_params(self, params):
+        if self.model == 'XGBoost':
+            if self.task == 'regression':
+                objective = {'objective': 'reg:squarederror'}
+            elif self.n_classes == 2:
+                objective = {'objective': 'binary:logistic'}
+            else:
+                objective = {'objective': 'multi:softprob', 'num_class': self.n_classes}
+            return {**params, **objective, 'tree_method': 'hist', 'nthread': 1, 'seed': self.seed, 'verbosity': 0}
+        if self.task == 'regression':
+            objective = {'objective': 'regression'}
+        elif self.n_classes == 2:
+            objective = {'objective': 'binary'}
+        else:
+            objective = {'objective': 'multiclass', 'num_class': self.n_classes}
+        return {**params, **objective, 'num_threads': 1, 'seed': self.seed, 'verbosity': -1}
+
+    def score(self, y_true, pred):
+        if self.task == 'regression':
+            return r2_score(y_true, pred)
+        pred = np.argmax(pred, axis=1) if pred.ndim == 2 else (pred > 0.5).astype(int)
+        return f1_score(y_true, pred, average=self.f1_avg_method)
+
+    def advance(self, trial, rounds):
+        '''Boosts every fold of trial up to rounds, continuing its existing boosters, and returns the mean CV score'''
+        params = self.booster_params(trial.params)
+        scores = []
+        for fold, (train_set, X_valid, y_valid) in enumerate(self.folds):
+            booster = trial.boosters.get(fold)
+            if booster is None:
+                with self._booster_lock:
+                    if self.model == 'XGBoost':
+                        booster = xgb.Booster(params, [train_set])
+                    else:
+                        booster = lgb.Booster(params, train_set)
+                trial.boosters[fold] = booster
+            for i in range(trial.rounds, rounds):
+                if self.model == 'XGBoost':
+                    booster.update(train_set, i)
+                else:
+                    booster.update()
+            if self.model == 'XGBoost':
+                pred = booster.inplace_predict(X_valid)
+            else:
+                pred = booster.predict(X_valid, num_threads=1)
+            scores.append(self.score(y_valid, pred))
+        trial.rounds = rounds
+        return float(np.mean(scores))
+
+    def run(self, n_trials, n_workers, table_path, resume=False):
+        '''Runs the sweep and returns (params, rounds, score) of the best trial of the highest rung reached'''
+        # Scores are only comparable between trials of the same model on the same folds, so every row is keyed by them
+        key = {'model': self.model, 'seed': self.seed, 'cv': self.cv}
+        columns = [*key, 'trial', 'rung', 'rounds', 'score', 'seconds', *self.space]
+        results = {}
+        if resume and os.path.exists(table_path):
+            done = pd.read_csv(table_path)
+            mismatched = [column for column, value in key.items()
+                          if column not in done or (done[column].astype(str) != str(value)).any()]
+            if mismatched:
+                raise ValueError(f"{table_path} does not hold a {self.model} sweep with seed {self.seed} and {self.cv} "
+                                 f"cross-validation folds, so it can't be resumed. Run again without --sweep_resume "
+                                 f"to start a new sweep")
+            for row in done.itertuples(index=False):
+                if int(row.trial) < int(n_trials):
+                    results[(int(row.trial), int(row.rung))] = float(row.score)
+            logger.info(f"Resuming sweep from {table_path} ({len(results)} finished trial rungs)")
+        else:
+            with open(table_path, 'w', newline='') as f:
+                csv.writer(f).writerow(columns)
+
+        trials = {t: _Trial(sample_params(self.space, self.seed, t)) for t in range(int(n_trials))}
+        pending = [t for t in trials if (t, 0) not in results]
+        running = set()
+
+        def next_job():
+            # Promote from the highest rung first: a trial is promotable once it is in the top 1/ETA of its rung
+            for rung in reversed(range(len(self.rungs) - 1)):
+                finished = sorted(((score, t) for (t, r), score in results.items() if r == rung and t in trials),
+                                  reverse=True)
+                for score, t in finished[:len(finished) // ETA]:
+                    if (t, rung + 1) not in results and (t, rung + 1) not in running:
+                        return t, rung + 1
+            if pending:
+                return pending.pop(0), 0
+            return None
+
+        def job(t, rung):
+            start = time.time()
+            score = self.advance(trials[t], self.rungs[rung])
+            return score, time.time() - start
+
+        with ThreadPoolExecutor(max_workers=max(1, int(n_workers))) as pool, open(table_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            futures = {}
+            while True:
+                while len(futures) < max(1, int(n_workers)):
+                    next_trial = next_job()
+                    if next_trial is None:
+                        break
+                    running.add(next_trial)
+                    futures[pool.submit(job, *next_trial)] = next_trial
+                if not futures:
+                    break
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    t, rung = futures.pop(future)
+                    running.discard((t, rung))
+                    score, seconds = future.result()
+                    results[(t, rung)] = score
+                    if rung == len(self.rungs) - 1:
+                        trials[t].boosters = {}
+                    writer.writerow([*key.values(), t, rung, self.rungs[rung], score, round(seconds, 3),
+                                     *trials[t].params.values()])
+                    f.flush()
+                    logger.info(f"Trial {t} rung {rung} ({self.rungs[rung]} rounds): score {score:.4f}")
+
+        top_rung = max(rung for _, rung in results)
+        score, best = max((score, t) for (t, rung), score in results.items() if rung == top_rung)
+        return trials[best].params, self.rungs[top_rung], score
+
+
+def final_estimator(model, task, params, n_estimators, args):
+    '''The scikit-learn style estimator TRILL saves, built from swept params'''
+    if model == 'XGBoost':
+        estimator = xgb.XGBClassifier if task == 'classification' else xgb.XGBRegressor
+        return estimator(**params, n_estimators=n_estimators, tree_method='hist', n_jobs=int(args.n_workers),
+                         random_state=int(args.RNG_seed))
+    estimator = lgb.LGBMClassifier if task == 'classification' else lgb.LGBMRegressor
+    return estimator(**params, n_estimators=n_estimators, n_jobs=int(args.n_workers),
+                     random_state=int(args.RNG_seed), verbose=-1)
+
+
+def run_sweep(model, task, X, y, args, n_classes=None, f1_avg_method='macro'):
+    '''Sweeps model on (X, y), refits the best candidate on all of it and returns a SweepResult'''
+    table_path = os.path.join(args.outdir, f'{args.name}_{model}_sweep_trials.csv')
+    engine = BoostingSweep(model, task, X, y, args.sweep_cv, args.RNG_seed, n_classes=n_classes,
+                           f1_avg_method=f1_avg_method)
+    logger.info(f"Sweeping {args.sweep_trials} {model} candidates over rungs of {engine.rungs} boosting rounds "
+                f"with {args.n_workers} workers. Trials are logged to {table_path}")
+    start = time.time()
+    params, rounds, score = engine.run(int(args.sweep_trials), int(args.n_workers), table_path,
+                                       resume=args.sweep_resume)
+    logger.info(f"Sweep finished in {time.time() - start:.2f}s. Best CV score {score:.4f} with "
+                f"{json.dumps(params)} and {rounds} rounds")
+    estimator = final_estimator(model, task, params, rounds, args).fit(X, y)
+    return SweepResult(estimator, {**params, 'n_estimators': rounds}, score)
@@ -0,0 +1,282 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from Bio.Align import substitution_matrices
+from loguru import logger
+from tqdm import tqdm
+
+from trill.utils.download import download
+
+# In-process 3Di+AA search, used by classify 3Di-Search --search_backend native instead of the foldseek binary.
+# Queries are matched against the database through an inverted index of exact 3Di k-mers, and candidates are
+# aligned with an affine-gap Smith-Waterman on the sum of the 3Di and amino-acid substitution scores. The DP is
+# vectorized over a length-sorted batch of targets and all query positions, one target row at a time.
+
+MAT3DI_URL = "https://raw.githubusercontent.com/steineggerlab/foldseek/master/data/mat3di.out"
+ALPHABET = "ACDEFGHIKLMNPQRSTVWY"
+UNKNOWN = len(ALPHABET)
+PAD = UNKNOWN + 1
+NEG = -(1 << 28)
+SEARCH_COLUMNS = ("query", "target", "fident", "alnlen", "mismatch", "gapopen",
+                  "qstart", "qend", "tstart", "tend", "evalue", "bits")
+
+_LUT = np.full(256, UNKNOWN, dtype=np.uint8)
+for _i, _aa in enumerate(ALPHABET):
+    _LUT[ord(_aa)] = _i
+    _LUT[ord(_aa.lower())] = _i
+
+
+def encode(seq):
+    return _LUT[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+
+def _matrix_to_array(matrix, aa_weight=1):
+    '''Reorders a Biopython substitution matrix into an integer array over ALPHABET + X'''
+    letters = ALPHABET + "X"
+    out = np.full((len(letters), len(letters)), -1, dtype=np.int32)
+    for i, a in enumerate(letters):
+        for j, b in enumerate(letters):
+            if a in matrix.alphabet and b in matrix.alphabet:
+                out[i, j] = int(round(aa_weight * matrix[a, b]))
+    return out
+
+
+def load_substitution_matrices(cache_dir, aa_weight=1):
+    '''Returns the Foldseek 3Di matrix and the (weighted) BLOSUM62 matrix as integer arrays'''
+    mat3di_path = download(MAT3DI_URL, os.path.join(cache_dir, "mat3di.out"))
+    mat3di = _matrix_to_array(substitution_matrices.read(mat3di_path))
+    blosum = _matrix_to_array(substitution_matrices.load("BLOSUM62"), aa_weight)
+    return mat3di, blosum
+
+
+def kmer_codes(codes, k):
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes.astype(np.int64), k)
+    return windows @ (PAD ** np.arange(k - 1, -1, -1, dtype=np.int64))
+
+
+class KmerIndex():
+    '''Inverted index from exact 3Di k-mers to the database entries containing them'''
+
+    def __init__(self, tdi_codes, k=4):
+        self.k = k
+        self.n_targets = len(tdi_codes)
+        kmers = [np.unique(kmer_codes(codes, k)) for codes in tdi_codes]
+        owners = [np.full(len(km), i, dtype=np.int32) for i, km in enumerate(kmers)]
+        kmers = np.concatenate(kmers) if kmers else np.zeros(0, dtype=np.int64)
+        owners = np.concatenate(owners) if owners else np.zeros(0, dtype=np.int32)
+        order = np.argsort(kmers, kind="stable")
+        self.kmers = kmers[order]
+        self.owners = owners[order]
+
+    def candidates(self, tdi, min_hits=2, max_seqs=1000):
+        '''Database entries sharing at least min_hits distinct k-mers with the query, most hits first'''
+        query_kmers = np.unique(kmer_codes(tdi, self.k))
+        lo = np.searchsorted(self.kmers, query_kmers, side="left")
+        hi = np.searchsorted(self.kmers, query_kmers, side="right")
+        lengths = hi - lo
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        positions = np.repeat(lo - starts, lengths) + np.arange(total)
+        hits = np.bincount(self.owners[positions], minlength=self.n_targets)
+        cand = np.flatnonzero(hits >= min_hits)
+        order = np.argsort(-hits[cand], kind="stable")
+        return cand[order[:max_seqs]]
+
+
+def _profile(mat3di, blosum, q3, qa):
+    '''Per-query score lookup tables (alphabet + X + padding) x query length'''
+    prof3 = np.full((PAD + 1, len(q3)), NEG // 4, dtype=np.int32)
+    prof3[:PAD] = mat3di[:, q3]
+    profa = np.zeros((PAD + 1, len(qa)), dtype=np.int32)
+    profa[:PAD] = blosum[:, qa]
+    return prof3, profa
+
+
+def smith_waterman(prof3, profa, t3, ta, gap_open, gap_extend, keep_matrices=False):
+    '''
+    Affine-gap local alignment scores of one query profile against a batch of padded targets (n x Lt).
+    A gap of length k costs gap_open + (k - 1) * gap_extend. Horizontal gaps are resolved for a whole row at once
+    with a running maximum, which is exact because re-opening from a gap cell never beats extending it.
+    '''
+    n, lt = t3.shape
+    lq = prof3.shape[1]
+    ramp = np.arange(lq + 1, dtype=np.int32) * gap_extend
+    H = np.zeros((n, lq + 1), dtype=np.int32)
+    F = np.full((n, lq + 1), NEG, dtype=np.int32)
+    best = np.zeros(n, dtype=np.int32)
+    rows = [(H, np.full_like(H, NEG), F)] if keep_matrices else None
+    for i in range(lt):
+        scores = prof3[t3[:, i]] + profa[ta[:, i]]
+        F = np.maximum(H - gap_open, F - gap_extend)
+        H0 = np.zeros_like(H)
+        H0[:, 1:] = np.maximum(np.maximum(H[:, :-1] + scores, F[:, 1:]), 0)
+        E = np.full_like(H, NEG)
+        E[:, 1:] = np.maximum.accumulate(H0 + ramp, axis=1)[:, :-1] - gap_open - ramp[:-1]
+        H = np.maximum(H0, E)
+        best = np.maximum(best, H.max(axis=1))
+        if keep_matrices:
+            rows.append((H, E, F))
+    if keep_matrices:
+        return best, [np.stack(m) for m in zip(*rows)]
+    return best
+
+
+def traceback(prof3, profa, t3, ta, q_aa, gap_open, gap_extend):
+    '''Aligns one query/target pair and returns its score and convertalis-style alignment statistics'''
+    best, (H, E, F) = smith_waterman(prof3, profa, t3[None], ta[None], gap_open, gap_extend, keep_matrices=True)
+    H, E, F = H[:, 0], E[:, 0], F[:, 0]
+    i, j = np.unravel_index(np.argmax(H), H.shape)
+    tend, qend = i, j
+    state = "H"
+    identities = pairs = alnlen = gapopen = 0
+    while i > 0 and j > 0:
+        if state == "H":
+            if H[i, j] == 0:
+                break
+            if H[i, j] == E[i, j]:
+                state = "E"
+            elif H[i, j] == F[i, j]:
+                state = "F"
+            else:
+                identities += int(q_aa[j - 1] == ta[i - 1])
+                pairs += 1
+                alnlen += 1
+                i, j = i - 1, j - 1
+        elif state == "E":
+            alnlen += 1
+            if E[i, j] == H[i, j - 1] - gap_open:
+                gapopen += 1
+                state = "H"
+            j -= 1
+        else:
+            alnlen += 1
+            if F[i, j] == H[i - 1, j] - gap_open:
+                gapopen += 1
+                state = "H"
+            i -= 1
+    return int(best[0]), {
+        "fident": identities / max(alnlen, 1), "alnlen": alnlen, "mismatch": pairs - identities,
+        "gapopen": gapopen, "qstart": j + 1, "qend": qend, "tstart": i + 1, "tend": tend}
+
+
+def karlin_lambda(mat3di, blosum, freq3, freqa):
+    '''
+    Ungapped Karlin-Altschul lambda of the combined 3Di+AA score under the database background composition,
+    treating the 3Di and amino-acid columns as independent.
+    '''
+    def phi(lam):
+        return (freq3 @ np.exp(lam * mat3di) @ freq3) * (freqa @ np.exp(lam * blosum) @ freqa) - 1
+
+    if freq3 @ mat3di @ freq3 + freqa @ blosum @ freqa >= 0:
+        logger.warning("Expected substitution score is not negative; E-values will not be meaningful")
+        return 0.3
+    lo, hi = 1e-6, 1.0
+    while phi(hi) < 0:
+        hi *= 2
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if phi(mid) < 0:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+class NativeSearchDB():
+    '''Encoded database, k-mer index and scoring parameters shared by the search workers'''
+
+    def __init__(self, ids, aa_seqs, tdi_seqs, mat3di, blosum, k=4, gap_open=10, gap_extend=1):
+        self.ids = list(ids)
+        self.aa = [encode(seq) for seq in aa_seqs]
+        self.tdi = [encode(seq) for seq in tdi_seqs]
+        self.lengths = np.array([len(seq) for seq in self.aa], dtype=np.int64)
+        self.mat3di, self.blosum = mat3di, blosum
+        self.gap_open, self.gap_extend = gap_open, gap_extend
+        self.index = KmerIndex(self.tdi, k)
+        self.n_residues = int(self.lengths.sum())
+        all3 = np.concatenate(self.tdi) if self.tdi else np.zeros(0, dtype=np.uint8)
+        alla = np.concatenate(self.aa) if self.aa else np.zeros(0, dtype=np.uint8)
+        freq3 = np.bincount(all3, minlength=UNKNOWN + 1) / max(len(all3), 1)
+        freqa = np.bincount(alla, minlength=UNKNOWN + 1) / max(len(alla), 1)
+        self.lam = karlin_lambda(mat3di, blosum, freq3, freqa)
+
+    def padded(self, idx):
+        lt = int(self.lengths[idx].max())
+        t3 = np.full((len(idx), lt), PAD, dtype=np.uint8)
+        ta = np.full((len(idx), lt), PAD, dtype=np.uint8)
+        for row, i in enumerate(idx):
+            t3[row, :self.lengths[i]] = self.tdi[i]
+            ta[row, :self.lengths[i]] = self.aa[i]
+        return t3, ta
+
+    def search(self, query_id, query_aa, query_tdi, evalue=10.0, min_hits=2, max_seqs=1000, batch=64):
+        q3, qa = encode(query_tdi), encode(query_aa)
+        prof3, profa = _profile(self.mat3di, self.blosum, q3, qa)
+        cand = self.index.candidates(q3, min_hits=min_hits, max_seqs=max_seqs)
+        # Length-sorted batches keep the padding per batch small
+        cand = cand[np.argsort(self.lengths[cand], kind="stable")]
+        results = []
+        for start in range(0, len(cand), batch):
+            idx = cand[start:start + batch]
+            t3, ta = self.padded(idx)
+            scores = smith_waterman(prof3, profa, t3, ta, self.gap_open, self.gap_extend)
+            bits = self.lam * scores / math.log(2)
+            evalues = len(qa) * self.n_residues * np.exp2(-bits)
+            for target, score, bit, ev in zip(idx, scores, bits, evalues):
+                if score > 0 and ev <= evalue:
+                    results.append((target, bit, ev))
+        rows = []
+        for target, bit, ev in sorted(results, key=lambda r: r[2]):
+            _, stats = traceback(prof3, profa, self.tdi[target], self.aa[target], qa,
+                                 self.gap_open, self.gap_extend)
+            rows.append((query_id, self.ids[target], f"{stats['fident']:.3f}", stats["alnlen"], stats["mismatch"],
+                         stats["gapopen"], stats["qstart"], stats["qend"], stats["tstart"], stats["tend"],
+                         f"{ev:.3E}", int(round(bit))))
+        return rows, len(cand)
+
+
+_WORKER_DB = None
+
+
+def _init_worker(db):
+    global _WORKER_DB
+    _WORKER_DB = db
+
+
+def _search_one(job):
+    query_id, query_aa, query_tdi, kwargs = job
+    return _WORKER_DB.search(query_id, query_aa, query_tdi, **kwargs)
+
+
+def native_3di_search(queries, db, out_path, n_workers=1, **kwargs):
+    '''
+    Searches (id, aa, 3Di) queries against a NativeSearchDB and writes a convertalis-style TSV to out_path.
+    Queries are spread over n_workers processes.
+    '''
+    jobs = [(query_id, aa, tdi, kwargs) for query_id, aa, tdi in queries]
+    start = time.time()
+    n_aligned = 0
+    with open(out_path, "w") as out:
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(db,)) as pool:
+                results = pool.map(_search_one, jobs, chunksize=max(1, len(jobs) // (4 * n_workers)))
+                for rows, n_cand in tqdm(results, total=len(jobs), desc="3Di search"):
+                    n_aligned += n_cand
+                    out.writelines("\t".join(map(str, row)) + "\n" for row in rows)
+        else:
+            _init_worker(db)
+            for job in tqdm(jobs, desc="3Di search"):
+                rows, n_cand = _search_one(job)
+                n_aligned += n_cand
+                out.writelines("\t".join(map(str, row)) + "\n" for row in rows)
+    elapsed = time.time() - start
+    logger.info(f"Searched {len(jobs)} queries against {len(db.ids)} targets in {elapsed:.1f}s "
+                f"({len(jobs) / max(elapsed, 1e-9):.1f} queries/s, {n_aligned / max(elapsed, 1e-9):.0f} alignments/s)")
+    return out_path
@@ -1,6 +1,17 @@
+import hashlib
+import json
+import os
+import resource
+import shutil
+import time
+
+import joblib
+import numpy as np
 import pandas as pd
+from bokeh.events import RangesUpdate
 from bokeh.layouts import column
-from bokeh.models import CustomJSFilter, CDSView, ColumnDataSource, TextInput, CustomJS, HoverTool, GroupFilter
+from bokeh.models import CustomJSFilter, CDSView, ColumnDataSource, TextInput, CustomJS, HoverTool, GroupFilter, Div, \
+    IntersectionFilter
 from bokeh.plotting import figure
 # from bokeh.models import ColumnDataSource, HoverTool, CustomJS, TextInput, CDSView, CustomJSFilter, GroupFilter
 # from bokeh.io import output_notebook, show
@@ -9,70 +20,279 @@ from bokeh.plotting import figure
 # from bokeh.plotting import figure
 # hv.extension('bokeh')
 # import holoviews as hv
-from sklearn.decomposition import PCA
+from loguru import logger
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
 from umap import UMAP
 
+from trill.utils.cache import CACHE_DIR
+from trill.utils.download import sha256sum
+from trill.utils.embedding_store import is_embedding_store, load_embeddings, store_paths
+
+# Fitted reducers are cached under ~/.trill_cache/visualize_reducers/<method>_<sha256 of input and parameters>.joblib,
+# together with the coordinate table they produced, so they can project new embeddings onto the same map. A bundle is
+# never modified once written: embeddings projected onto it later go to its <bundle>_projected.csv sidecar table.
+# tSNE has no out-of-sample transform, so its bundle also keeps the (PCA-reduced) embeddings it was fit on to
+# interpolate between. Without --landmarks that is a copy of the whole embedding matrix.
+REDUCER_CACHE = os.path.join(CACHE_DIR, "visualize_reducers")
+
+PALETTE = ['#68023F', '#008169', '#EF0096', '#00DCB5', '#FFCFE2', '#003C86', '#9400E6', '#009FFA', '#FF71FD',
+           '#7CFFFA', '#6A0213', '#008607', '#F60239', '#00E307', '#FFDC3D']
+
+# Maps with more than --max_points points are drawn by viz_density() as a density image, aggregated once here into
+# DENSITY_BINS x DENSITY_BINS cells. The points themselves are split into a grid of tiles, written as JS files next
+# to the HTML and loaded by the browser only once the view is zoomed in far enough to hold at most --max_points of
+# them. The grid is refined until dense regions can be loaded too. Label search uses sorted label shards (by first
+# character) that are loaded on first use.
+DENSITY_BINS = 1024
+TILE_POINTS = 5000
+MAX_TILES = 256
+MAX_SEARCH_HITS = 5000
+
+
+def _log_stage(stage, start):
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logger.info(f"{stage} took {time.time() - start:.2f}s (peak memory so far {peak:.0f} MiB)")
+
+
+def _chunk_bounds(n, chunk_rows, min_rows=1):
+    '''Row ranges of at most chunk_rows, with a short last chunk merged into the one before it'''
+    starts = list(range(0, n, chunk_rows))
+    if len(starts) > 1 and n - starts[-1] < min_rows:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [n]))
+
+
+def fit_pca(X, n_components, solver='auto', chunk_rows=65536, seed=123):
+    '''
+    Fits PCA on X. 'incremental' streams X in chunks (the default for memory-mapped embedding stores), 'randomized'
+    uses a randomized SVD and 'full' an exact one. 'auto' otherwise lets scikit-learn choose.
+    '''
+    if solver == 'auto' and isinstance(X, np.memmap):
+        solver = 'incremental'
+    if solver == 'incremental':
+        reducer = IncrementalPCA(n_components=n_components)
+        for start, stop in _chunk_bounds(len(X), chunk_rows, min_rows=n_components):
+            reducer.partial_fit(np.asarray(X[start:stop], dtype=np.float32))
+        return reducer
+    return PCA(n_components=n_components, svd_solver=solver, random_state=seed).fit(X)
+
+
+def transform_in_chunks(reducer, X, chunk_rows=65536):
+    return np.vstack([reducer.transform(np.asarray(X[start:stop], dtype=np.float32))
+                      for start, stop in _chunk_bounds(len(X), chunk_rows)])
+
 
+def landmark_sample(labels, n_landmarks, key=None, seed=123):
+    '''Indices of n_landmarks rows, stratified by the groups in key (label, group CSV) if given, otherwise uniform'''
+    rng = np.random.default_rng(seed)
+    if n_landmarks >= len(labels):
+        return np.arange(len(labels))
+    if not key:
+        return np.sort(rng.choice(len(labels), n_landmarks, replace=False))
+    key_df = pd.read_csv(key)
+    groups = dict(zip(key_df.iloc[:, 0].astype(str), key_df.iloc[:, 1].astype(str)))
+    group_of = pd.Series([groups.get(str(label), "") for label in labels])
+    picked = []
+    for _, rows in group_of.groupby(group_of).indices.items():
+        take = min(len(rows), max(1, int(round(n_landmarks * len(rows) / len(labels)))))
+        picked.append(rng.choice(rows, take, replace=False))
+    return np.sort(np.concatenate(picked))
 
 
+def knn_interpolate(landmark_X, landmark_coords, X, k=10, chunk_rows=65536):
+    '''Places each row of X at the inverse-distance weighted mean of the coordinates of its k nearest landmarks'''
+    nn = NearestNeighbors(n_neighbors=min(k, len(landmark_X))).fit(landmark_X)
+    placed = []
+    for start, stop in _chunk_bounds(len(X), chunk_rows):
+        dist, idx = nn.kneighbors(np.asarray(X[start:stop], dtype=np.float32))
+        weights = 1 / (dist + 1e-8)
+        placed.append((weights[..., None] * landmark_coords[idx]).sum(axis=1) / weights.sum(axis=1, keepdims=True))
+    return np.vstack(placed)
 
 
-def reduce_dims(name, data, method = 'PCA'):
-    incsv = data.split('.csv')[0].split('/')[-1]
-    data = pd.read_csv(data)
-    labels = data.iloc[:,-1:]
-    data = data.iloc[:,:-1]
+def input_sha256(data):
+    if is_embedding_store(data):
+        sha = hashlib.sha256()
+        for path in store_paths(data):
+            sha.update(sha256sum(path).encode())
+        return sha.hexdigest()
+    return sha256sum(data)
+
+
+def reducer_cache_path(data, method, params):
+    '''Cache entry of the reducer fitted on data with method and params, keyed by their SHA256'''
+    sha = hashlib.sha256(input_sha256(data).encode())
+    sha.update(json.dumps({'method': method, **params}, sort_keys=True).encode())
+    return os.path.join(REDUCER_CACHE, f"{method}_{sha.hexdigest()}.joblib")
+
+
+def fit_reducer(data, labels, method, pca_solver='auto', pca_dims=0, landmarks=0, key=None, chunk_rows=65536):
+    '''
+    Fits method on data and returns its 2D coordinates and a reducer dict that project() can reuse for new
+    embeddings. With pca_dims, UMAP/tSNE run on a PCA projection to that many dimensions. With landmarks, UMAP/tSNE
+    are fit on a sample of that many embeddings (stratified by key) and the rest are projected onto the map:
+    through UMAP's transform, or by kNN interpolation between landmarks for tSNE.
+    '''
     if method == 'PCA':
-        reducer = PCA(n_components=2, random_state=123)
-        reduced = reducer.fit_transform(data.values)
+        start = time.time()
+        reducer = fit_pca(data, 2, solver=pca_solver, chunk_rows=chunk_rows)
+        reduced = transform_in_chunks(reducer, data, chunk_rows)
+        _log_stage(f"PCA ({type(reducer).__name__})", start)
         var_1, var_2 = reducer.explained_variance_ratio_
-        reduced_df = pd.DataFrame(reduced, columns=[f'PCA 1: {var_1}', f'PCA 2: {var_2}'])
-        reduced_df['Label'] = labels
-        reduced_df.to_csv(f'{name}_{method}_{incsv}.csv', index=False)
+        return reduced, {'method': method, 'columns': [f'PCA 1: {var_1}', f'PCA 2: {var_2}'], 'pca': None,
+                         'reducer': reducer}
+
+    pca = None
+    if pca_dims and pca_dims < data.shape[1]:
+        start = time.time()
+        pca = fit_pca(data, pca_dims, solver=pca_solver, chunk_rows=chunk_rows)
+        data = transform_in_chunks(pca, data, chunk_rows)
+        _log_stage(f"PCA to {pca_dims} dimensions ({type(pca).__name__})", start)
 
-    elif method == 'tSNE':
-        if len(data) <= 30:
-            reduced = TSNE(n_jobs=-1, random_state=123, perplexity=(len(data)-1)).fit_transform(data.values)
+    fit_rows = landmark_sample(labels, landmarks, key) if landmarks else np.arange(len(labels))
+    fit_data = np.asarray(data[fit_rows], dtype=np.float32)
+    start = time.time()
+    if method == 'tSNE':
+        if len(fit_data) <= 30:
+            reducer = TSNE(n_jobs=-1, random_state=123, perplexity=(len(fit_data)-1))
         else:
-            reduced = TSNE(n_jobs=-1, random_state=123).fit_transform(data.values)
-        reduced_df = pd.DataFrame(reduced, columns = ['tSNE 1', 'tSNE 2'])
-        reduced_df['Label'] = labels
-        reduced_df.to_csv(f'{name}_{method}_{incsv}.csv', index=False)
+            reducer = TSNE(n_jobs=-1, random_state=123)
+    else:
+        reducer = UMAP(random_state=123)
+    fit_reduced = reducer.fit_transform(fit_data)
+    _log_stage(f"{method} on {len(fit_data)} embeddings", start)
+    if method == 'tSNE':
+        # tSNE has no out-of-sample transform, new points are interpolated between the embeddings it was fit on
+        reducer = {'landmarks': fit_data, 'coords': fit_reduced}
+    fitted = {'method': method, 'columns': [f'{method} 1', f'{method} 2'], 'pca': pca, 'reducer': reducer}
 
-    elif method == 'UMAP':
-        reduced = UMAP(random_state=123).fit_transform(data.values)
-        reduced_df = pd.DataFrame(reduced, columns = ['UMAP 1', 'UMAP 2'])
-        reduced_df['Label'] = labels
-        reduced_df.to_csv(f'{name}_{method}_{incsv}.csv', index=False)
+    if len(fit_rows) == len(labels):
+        return fit_reduced, fitted
+    start = time.time()
+    rest = np.setdiff1d(np.arange(len(labels)), fit_rows)
+    reduced = np.empty((len(labels), 2), dtype=np.float32)
+    reduced[fit_rows] = fit_reduced
+    # Only chunk_rows embeddings are read out of a memory-mapped store at a time
+    for chunk_start, chunk_stop in _chunk_bounds(len(rest), chunk_rows):
+        rows = rest[chunk_start:chunk_stop]
+        reduced[rows] = project(fitted, data[rows], chunk_rows, reduced_input=True)
+    _log_stage(f"Projecting {len(rest)} embeddings onto the landmark map", start)
+    return reduced, fitted
 
-    else:
+
+def project(fitted, X, chunk_rows=65536, reduced_input=False):
+    '''2D coordinates of X on the map of a fitted reducer. reduced_input means X already went through its PCA'''
+    if fitted['pca'] is not None and not reduced_input:
+        X = transform_in_chunks(fitted['pca'], X, chunk_rows)
+    if fitted['method'] == 'tSNE':
+        return knn_interpolate(fitted['reducer']['landmarks'], fitted['reducer']['coords'], X, chunk_rows=chunk_rows)
+    return transform_in_chunks(fitted['reducer'], X, chunk_rows)
+
+
+def reduce_dims(name, data, method = 'PCA', pca_solver='auto', pca_dims=0, landmarks=0, key=None, chunk_rows=65536):
+    '''
+    Reduces embeddings (a TRILL embedding CSV or an embedding store) to 2D and writes the coordinate table. The
+    fitted reducer is cached under the SHA256 of the input and parameters, so the same map is never fit twice and
+    new embeddings can be projected onto it with project_onto().
+    '''
+    if method not in ('PCA', 'tSNE', 'UMAP'):
         raise Exception(f'Dimensionality reduction method {method} needs to be either PCA, tSNE or UMAP')
+    incsv = os.path.splitext(os.path.basename(data))[0]
+    table = os.path.abspath(f'{name}_{method}_{incsv}.csv')
+    # chunk_rows only changes the fit of incremental PCA, everything else is computed the same for any chunk size
+    incremental = pca_solver == 'incremental' or (pca_solver == 'auto' and is_embedding_store(data))
+    params = {'pca_solver': pca_solver, 'pca_dims': pca_dims, 'landmarks': landmarks,
+              'chunk_rows': chunk_rows if incremental and (method == 'PCA' or pca_dims) else None,
+              'key': sha256sum(key) if key and landmarks else None}
+    start = time.time()
+    cache_path = reducer_cache_path(data, method, params)
+    _log_stage("Hashing the input", start)
 
+    if os.path.exists(cache_path):
+        fitted = joblib.load(cache_path)
+        logger.info(f"Using the {method} reducer fitted on the same input and parameters at {cache_path}")
+        reduced_df = fitted['coordinates']
+        reduced_df.to_csv(table, index=False)
+    else:
+        start = time.time()
+        data, labels = load_embeddings(data)
+        _log_stage(f"Loading {len(labels)} embeddings", start)
+        reduced, fitted = fit_reducer(data, labels, method, pca_solver, pca_dims, landmarks, key, chunk_rows)
+        reduced_df = pd.DataFrame(reduced, columns=fitted['columns'])
+        reduced_df['Label'] = labels
+        reduced_df.to_csv(table, index=False)
+        fitted.update(coordinates=reduced_df, incsv=incsv)
+        os.makedirs(REDUCER_CACHE, exist_ok=True)
+        # Written to a temporary file first, so concurrent runs never load a half-written bundle
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        joblib.dump(fitted, tmp_path)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"Saved the fitted reducer to {cache_path}")
+    logger.info(f"Add new embeddings to this map with --project_onto {cache_path}")
 
     return reduced_df, incsv
 
 
+def projected_path(saved_reducer):
+    '''Sidecar table of the embeddings projected onto the map of saved_reducer after it was fit'''
+    return f"{os.path.splitext(saved_reducer)[0]}_projected.csv"
+
+
+def project_onto(saved_reducer, data, outdir, name, chunk_rows=65536):
+    '''
+    Projects the embeddings in data onto the map of saved_reducer without refitting it. They are appended to the
+    map's projected_path() sidecar, and the whole map is written to a coordinate table in outdir, named like the
+    HTML of this run. Embeddings whose label is already on the map are skipped. Returns the whole table, the name of
+    the input the map was fit on and its method.
+    '''
+    fitted = joblib.load(saved_reducer)
+    sidecar = projected_path(saved_reducer)
+    projected = pd.read_csv(sidecar) if os.path.exists(sidecar) else fitted['coordinates'].iloc[:0]
+    data, labels = load_embeddings(data)
+    mapped = set(fitted['coordinates']['Label'].astype(str)) | set(projected['Label'].astype(str))
+    new = np.array([i for i, label in enumerate(labels) if str(label) not in mapped], dtype=int)
+    if len(new) < len(labels):
+        logger.warning(f"Skipping {len(labels) - len(new)} embeddings that are already on the map")
+    start = time.time()
+    reduced_df = pd.DataFrame(project(fitted, data[new], chunk_rows) if len(new) else np.empty((0, 2)),
+                              columns=fitted['columns'])
+    reduced_df['Label'] = [labels[i] for i in new]
+    _log_stage(f"Projecting {len(new)} embeddings onto the {fitted['method']} map", start)
 
+    reduced_df.to_csv(sidecar, mode='a', header=not os.path.exists(sidecar), index=False)
+    coordinates = pd.concat([fitted['coordinates'], projected, reduced_df], ignore_index=True)
+    table = os.path.join(outdir, f"{name}_{fitted['method']}_{fitted['incsv']}.csv")
+    coordinates.to_csv(table, index=False)
+    logger.info(f"Added {len(new)} embeddings to the map in {table}, projected embeddings are kept in {sidecar}")
+    return coordinates, fitted['incsv'], fitted['method']
 
 
 # def create_group(row):
 #     return row.split('_')[-1]
 
-def viz(df, args):
+def viz(df, args, tile_dir=None):
+    '''
+    Interactive Bokeh scatter plot of a coordinate table. Maps larger than args.max_points are handed to
+    viz_density(), which writes its point tiles and search index to tile_dir.
+    '''
+    if tile_dir is not None and len(df) > int(args.max_points):
+        return viz_density(df, args, tile_dir)
     col1, col2, _ = df.columns
     
     # Check if grouped is True
     if not args.key:
         source = ColumnDataSource(df)
         # Create a simple scatter plot without grouping
-        fig = figure(title=args.name, width=600, height=600, x_axis_label=col1, y_axis_label=col2)
-        # Create a CustomJSFilter
-        # Create a CustomJSFilter
+        fig = figure(title=args.name, width=600, height=600, x_axis_label=col1, y_axis_label=col2,
+                     output_backend='webgl')
+        # Create a CustomJSFilter, which is handed the renderer's data source as source
         text_input = TextInput(value='', title='Search:')
-        custom_filter = CustomJSFilter(args=dict(text_input=text_input, data=dict(source.data)), code="""
+        custom_filter = CustomJSFilter(args=dict(text_input=text_input), code="""
             var indices = [];
-            var names = data['Label'];
+            var names = source.data['Label'];
             var value = text_input.value;  // get the value from TextInput widget
 
             // Iterate over the data and select the indices of points to keep based on the filter value
@@ -83,8 +303,8 @@ def viz(df, args):
             }
             return indices;
         """)
-        view = CDSView(source=source, filters=[custom_filter])
-        scatter_renderer = fig.circle(col1, col2, source=source, view=view, color='#68023F')
+        view = CDSView(filter=custom_filter)
+        scatter_renderer = fig.scatter(col1, col2, source=source, view=view, color='#68023F')
         # Add hover tool
         fig.add_tools(HoverTool(renderers=[scatter_renderer], tooltips=[('Protein', '@Label')]))
         # Update the CustomJS callback when the input value changes
@@ -105,25 +325,9 @@ def viz(df, args):
         df = df.merge(key_df, how='left', left_on='Label', right_on='Label')
         source = ColumnDataSource(df)
         
-        # Define the palette for coloring groups
-        palette = ['#68023F',
-                '#008169',
-                '#EF0096',
-                '#00DCB5',
-                '#FFCFE2',
-                '#003C86',
-                '#9400E6',
-                '#009FFA',
-                '#FF71FD',
-                '#7CFFFA',
-                '#6A0213',
-                '#008607',
-                '#F60239',
-                '#00E307',
-                '#FFDC3D']
-        
         # Create a figure
-        fig = figure(title=args.name, width=600, height=600, x_axis_label=col1, y_axis_label=col2)
+        fig = figure(title=args.name, width=600, height=600, x_axis_label=col1, y_axis_label=col2,
+                     output_backend='webgl')
         # Create a TextInput widget for the search feature
         text_input = TextInput(value='', title='Search:')
         custom_filter = CustomJSFilter(args=dict(text_input=text_input), code="""
@@ -143,12 +347,13 @@ def viz(df, args):
         
         # Create a scatter plot for each group and add them to the figure
         scatter_renderers = []
-        for group, color in zip(df['Class'].unique(), palette):
+        for group, color in zip(df['Class'].dropna().unique(), PALETTE):
             # Create a GroupFilter for the group
             group_filter = GroupFilter(column_name='Class', group=group)
             
             # Create a scatter plot for the group
-            scatter_renderer = fig.circle(col1, col2, source=source, color=color, legend_label=group, view=CDSView(source=source, filters=[custom_filter, group_filter]))
+            view = CDSView(filter=IntersectionFilter(operands=[custom_filter, group_filter]))
+            scatter_renderer = fig.scatter(col1, col2, source=source, color=color, legend_label=str(group), view=view)
             scatter_renderers.append(scatter_renderer)
         
         # Add hover tool
@@ -171,5 +376,200 @@ def viz(df, args):
         return layout
 
 
+def _write_js(path, callback, *payload):
+    with open(path, 'w') as f:
+        f.write(f"window.{callback}({', '.join(json.dumps(p) for p in payload)});\n")
+
+
+def _tile_ids(x, y, extent, n_tiles):
+    x0, x1, y0, y1 = extent
+    tx = np.clip(((x - x0) / (x1 - x0) * n_tiles).astype(int), 0, n_tiles - 1)
+    ty = np.clip(((y - y0) / (y1 - y0) * n_tiles).astype(int), 0, n_tiles - 1)
+    return tx * n_tiles + ty
+
+
+def write_tiles(df, colors, tile_dir, extent, max_points):
+    '''
+    Writes the points of df as a grid of JS tiles, refined until no tile holds more than a quarter of max_points,
+    and returns the grid size and the number of points in each tile
+    '''
+    x, y = df.iloc[:, 0].to_numpy(), df.iloc[:, 1].to_numpy()
+    n_tiles = int(np.clip(np.ceil(np.sqrt(len(df) / TILE_POINTS)), 1, MAX_TILES))
+    counts = np.bincount(_tile_ids(x, y, extent, n_tiles), minlength=n_tiles * n_tiles)
+    while counts.max() > max(max_points // 4, 1) and n_tiles < MAX_TILES:
+        n_tiles = min(2 * n_tiles, MAX_TILES)
+        counts = np.bincount(_tile_ids(x, y, extent, n_tiles), minlength=n_tiles * n_tiles)
+    tile_ids = _tile_ids(x, y, extent, n_tiles)
+    order = np.argsort(tile_ids, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    labels = df['Label'].astype(str).to_numpy()
+    for tile in np.flatnonzero(counts):
+        rows = order[bounds[tile]:bounds[tile + 1]]
+        _write_js(os.path.join(tile_dir, f'tile_{tile}.js'), 'trillTile', int(tile),
+                  {'x': np.round(x[rows], 4).tolist(), 'y': np.round(y[rows], 4).tolist(),
+                   'Label': labels[rows].tolist(), 'color': colors[rows].tolist()})
+    return n_tiles, counts
+
+
+def write_search_index(df, tile_dir):
+    '''Writes the lowercased labels, sorted and sharded by first character, and returns the shard names'''
+    index = pd.DataFrame({'key': df['Label'].astype(str).str.lower(), 'Label': df['Label'].astype(str),
+                          'x': np.round(df.iloc[:, 0].to_numpy(), 4), 'y': np.round(df.iloc[:, 1].to_numpy(), 4)})
+    index = index[index['key'] != ''].sort_values('key', kind='stable')
+    shards = index['key'].str[0].map(lambda c: format(ord(c), 'x'))
+    for shard, rows in index.groupby(shards, sort=False):
+        _write_js(os.path.join(tile_dir, f'search_{shard}.js'), 'trillSearchShard', shard,
+                  {column: rows[column].tolist() for column in ('key', 'Label', 'x', 'y')})
+    return sorted(shards.unique())
+
+
+def _load_script_js(url):
+    return f"""
+        const script = document.createElement('script');
+        script.src = {url};
+        document.head.appendChild(script);
+    """
+
+
+def viz_density(df, args, tile_dir):
+    '''
+    Level-of-detail plot of a large map. Shows a log-scaled density image of the whole map, and the points of the
+    visible tiles, colored by their --key class, once the view holds at most args.max_points of them. The search box
+    does a prefix search over the precomputed label index and marks the matches. Everything is drawn with WebGL.
+    '''
+    col1, col2, _ = df.columns[:3]
+    max_points = int(args.max_points)
+    colors = np.full(len(df), PALETTE[0], dtype=object)
+    classes = []
+    if args.key:
+        key_df = pd.read_csv(args.key)
+        df = df.merge(key_df, how='left', left_on='Label', right_on='Label')
+        classes = list(df['Class'].dropna().unique())
+        for group, color in zip(classes, PALETTE):
+            colors[(df['Class'] == group).to_numpy()] = color
+
+    start = time.time()
+    x, y = df[col1].to_numpy(), df[col2].to_numpy()
+    pad_x, pad_y = (x.max() - x.min()) * 1e-3 or 1, (y.max() - y.min()) * 1e-3 or 1
+    extent = [float(x.min() - pad_x), float(x.max() + pad_x), float(y.min() - pad_y), float(y.max() + pad_y)]
+    density, _, _ = np.histogram2d(x, y, bins=DENSITY_BINS, range=[extent[:2], extent[2:]])
+    density = np.log1p(density.T).astype(np.float32)
+    density[density == 0] = np.nan
+
+    if os.path.exists(tile_dir):
+        shutil.rmtree(tile_dir)
+    os.makedirs(tile_dir)
+    n_tiles, counts = write_tiles(df, colors, tile_dir, extent, max_points)
+    shards = write_search_index(df, tile_dir)
+    _log_stage(f"Aggregating {len(df)} points into a density image and {n_tiles}x{n_tiles} tiles", start)
+    tile_url = json.dumps(os.path.basename(os.path.normpath(tile_dir)))
+
+    fig = figure(title=args.name, width=600, height=600, x_axis_label=col1, y_axis_label=col2,
+                 output_backend='webgl', x_range=extent[:2], y_range=extent[2:])
+    fig.image(image=[density], x=extent[0], y=extent[2], dw=extent[1] - extent[0], dh=extent[3] - extent[2],
+              palette='Greys256', global_alpha=0.6)
+    points = ColumnDataSource(data={'x': [], 'y': [], 'Label': [], 'color': []})
+    point_renderer = fig.scatter('x', 'y', source=points, color='color', size=4)
+    hits = ColumnDataSource(data={'x': [], 'y': [], 'Label': []})
+    hit_renderer = fig.scatter('x', 'y', source=hits, color='#F60239', size=9, marker='diamond')
+    for group, color in zip(classes, PALETTE):
+        fig.scatter([], [], color=color, legend_label=str(group))
+    fig.add_tools(HoverTool(renderers=[point_renderer, hit_renderer], tooltips=[('Protein', '@Label')]))
+    status = Div(text=f'{len(df)} proteins. Zoom in to see individual points')
+
+    fig.js_on_event(RangesUpdate, CustomJS(
+        args=dict(source=points, xr=fig.x_range, yr=fig.y_range, counts=counts.tolist(), extent=extent,
+                  n_tiles=n_tiles, max_points=max_points, status=status, total=len(df)), code=f"""
+        window.trillTiles = window.trillTiles || {{}};
+        window.trillRequested = window.trillRequested || {{}};
+        window.trillTile = function(id, data) {{
+            window.trillTiles[id] = data;
+            window.trillUpdate();
+        }};
+        function tileRange(lo, hi, a, b) {{
+            return [Math.max(0, Math.floor((lo - a) / (b - a) * n_tiles)),
+                    Math.min(n_tiles - 1, Math.floor((hi - a) / (b - a) * n_tiles))];
+        }}
+        window.trillUpdate = function() {{
+            const [i0, i1] = tileRange(xr.start, xr.end, extent[0], extent[1]);
+            const [j0, j1] = tileRange(yr.start, yr.end, extent[2], extent[3]);
+            const visible = [];
+            let in_view = 0;
+            for (let i = i0; i <= i1; i++) {{
+                for (let j = j0; j <= j1; j++) {{
+                    if (counts[i * n_tiles + j] > 0) {{
+                        visible.push(i * n_tiles + j);
+                        in_view += counts[i * n_tiles + j];
+                    }}
+                }}
+            }}
+            if (in_view > max_points) {{
+                source.data = {{x: [], y: [], Label: [], color: []}};
+                status.text = total + ' proteins. Zoom in to see individual points (about ' + in_view + ' in view)';
+                return;
+            }}
+            const missing = visible.filter(id => !(id in window.trillTiles));
+            for (const id of missing) {{
+                if (window.trillRequested[id]) continue;
+                window.trillRequested[id] = true;
+                {_load_script_js(f"{tile_url} + '/tile_' + id + '.js'")}
+            }}
+            if (missing.length) {{
+                status.text = 'Loading ' + missing.length + ' tiles...';
+                return;
+            }}
+            const data = {{x: [], y: [], Label: [], color: []}};
+            for (const id of visible) {{
+                const tile = window.trillTiles[id];
+                for (const column in data) {{
+                    for (const value of tile[column]) data[column].push(value);
+                }}
+            }}
+            source.data = data;
+            status.text = total + ' proteins, showing ' + data.x.length;
+        }};
+        window.trillUpdate();
+    """))
+
+    text_input = TextInput(value='', title='Search (label prefix):')
+    text_input.js_on_change('value', CustomJS(
+        args=dict(hits=hits, text_input=text_input, shards=shards, max_hits=MAX_SEARCH_HITS), code=f"""
+        window.trillSearch = window.trillSearch || {{}};
+        const query = text_input.value.toLowerCase();
+        window.trillSearchShard = function(shard, index) {{
+            window.trillSearch[shard] = index;
+            if (window.trillSearchPending) window.trillSearchPending();
+        }};
+        if (!query) {{
+            hits.data = {{x: [], y: [], Label: []}};
+            return;
+        }}
+        const shard = query.codePointAt(0).toString(16);
+        window.trillSearchPending = function() {{
+            const index = window.trillSearch[shard];
+            const data = {{x: [], y: [], Label: []}};
+            if (index && text_input.value.toLowerCase() === query) {{
+                let lo = 0, hi = index.key.length;
+                while (lo < hi) {{
+                    const mid = (lo + hi) >> 1;
+                    if (index.key[mid] < query) lo = mid + 1; else hi = mid;
+                }}
+                for (let i = lo; i < index.key.length && index.key[i].startsWith(query) && data.x.length < max_hits; i++) {{
+                    data.x.push(index.x[i]);
+                    data.y.push(index.y[i]);
+                    data.Label.push(index.Label[i]);
+                }}
+                hits.data = data;
+            }}
+        }};
+        if (!shards.includes(shard)) {{
+            hits.data = {{x: [], y: [], Label: []}};
+        }} else if (shard in window.trillSearch) {{
+            window.trillSearchPending();
+        }} else {{
+            {_load_script_js(f"{tile_url} + '/search_' + shard + '.js'")}
+        }}
+    """))
+
+    return column(text_input, status, fig)
 
-    